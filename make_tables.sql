@@ -21,6 +21,16 @@ create table Y6A2_COADD_FILEPATH as
 -- 111859
 
 
+-- Global temporary table used by tilefinder.find_tilenames_radec_batch() to
+-- upload all positions with executemany() and match them in a single join
+create global temporary table DESTHUMBS_RADEC (
+  IDX    NUMBER(10),
+  RA     BINARY_DOUBLE,
+  DEC    BINARY_DOUBLE,
+  RA180  BINARY_DOUBLE
+) on commit delete rows;
+
+
 --- build table with info for finalcut files
 create table Y6A2_FINALCUT_FILEPATH as
 select i.FILENAME, f.PATH, i.BAND, i.EXPTIME, i.AIRMASS, i.FWHM, i.NITE, i.EXPNUM, i.CCDNUM, e.DATE_OBS, e.MJD_OBS,
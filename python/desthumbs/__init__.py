@@ -1,2 +1,14 @@
 from . thumbslib  import *
 from . tilefinder import *
+from . catalog import *
+from . colorlib import *
+from . backends import *
+from . dbpool import *
+from . scheduler import *
+from . handoff import *
+from . manifest import *
+from . streaming import *
+from . cutoutcache import *
+from . metrics import *
+from . profiling import *
+from . tracing import *
@@ -0,0 +1,368 @@
+"""
+Metadata backends used by makeDESthumbs to get the archive root, match
+positions or COADD_OBJECTS_ID to tiles and list the coadd files. The
+Oracle backend runs the queries in tilefinder, while the SQLite backend
+works on a local file with the layout of catalog.CATALOG_TABLES, so the
+whole pipeline can run without a live database.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import numpy
+
+from . import tilefinder
+from . import catalog
+from . import metrics
+
+SOUT = sys.stdout
+
+# The metrics stages of the backend calls
+BACKEND_STAGES = {'find_tilenames_radec': 'tile_lookup',
+                  'find_tilenames_id': 'tile_lookup',
+                  'get_coaddfiles': 'file_listing'}
+
+
+class MetadataBackend(object):
+
+    """
+    Interface for the metadata lookups. The time spent on each call is
+    kept in self.timings as {name: [ncalls, seconds]} so that backends
+    can be compared directly with report_timings()
+    """
+
+    name = None
+    schema = None
+
+    def __init__(self):
+        self.timings = {}
+        self.tilegeom_index = None
+
+    def record(self,name,t0):
+        """ Add the time since t0 to the call name """
+        ncalls, seconds = self.timings.get(name,[0,0.0])
+        self.timings[name] = [ncalls+1, seconds+time.time()-t0]
+        if name in BACKEND_STAGES:
+            metrics.METRICS.since(BACKEND_STAGES[name],t0)
+
+    def report_timings(self,sout=None):
+        sout = sout or SOUT
+        for name in sorted(self.timings.keys()):
+            ncalls, seconds = self.timings[name]
+            sout.write("# %s backend %-20s %6d calls %10.3fs\n" % (self.name,name,ncalls,seconds))
+        return
+
+    def get_archive_root(self,verb=False):
+        raise NotImplementedError
+
+    def get_tilegeom(self,verb=False):
+        raise NotImplementedError
+
+    def find_tilenames_radec(self,ra,dec,method='local',verb=False):
+
+        """
+        Find the tilename for each ra,dec, returns (tilenames, indices,
+        tilenames_matched) as tilefinder.find_tilenames_radec(). With
+        method='local' the tile geometry is loaded only once per backend
+        """
+        t0 = time.time()
+        if method == 'local':
+            if self.tilegeom_index is None:
+                self.tilegeom_index = tilefinder.TileGeomIndex(self.get_tilegeom(verb=verb))
+            result = self.tilegeom_index.find_tilenames(ra,dec)
+        elif method == 'db':
+            result = self.find_tilenames_radec_batch(ra,dec,verb=verb)
+        elif method == 'byobject':
+            result = self.find_tilenames_radec_byobject(ra,dec)
+        else:
+            raise ValueError("ERROR: tile matching method not defined: %s" % method)
+        self.record('find_tilenames_radec',t0)
+        return result
+
+    def find_tilenames_radec_batch(self,ra,dec,verb=False):
+        raise NotImplementedError
+
+    def find_tilenames_radec_byobject(self,ra,dec):
+        raise NotImplementedError
+
+    def find_tilenames_id(self,id,tablename,verb=False):
+        raise NotImplementedError
+
+    def get_coaddfiles(self,tilenames,tag,bands='all',verb=False):
+        raise NotImplementedError
+
+    def prefetch_coaddfiles(self,tilenames,tag,bands='all',batchsize=200,verb=False):
+        """
+        Get the files for all tilenames, as a dictionary-like object.
+        Backends with a pool of sessions fetch them in the background
+        """
+        return self.get_coaddfiles(tilenames,tag,bands=bands,verb=verb)
+
+    def close(self):
+        pass
+
+
+class CoaddFilesPrefetch(object):
+
+    """
+    Dictionary-like access to the coadd files of a list of tilenames,
+    fetched in batches by the worker threads of an OraclePool. get()
+    only blocks until the batch holding the requested tilename is done
+    """
+
+    def __init__(self,backend,tilenames,tag,bands='all',batchsize=200):
+        self.batch = {}
+        self.results = []
+        tilenames = list(tilenames)
+        for k in range(0,len(tilenames),batchsize):
+            for tilename in tilenames[k:k+batchsize]:
+                self.batch[tilename] = len(self.results)
+            kwargs = {'tag': tag, 'bands': bands, 'schema': backend.schema}
+            self.results.append(backend.pool.apply_async(tilefinder.get_coaddfiles_tilenames_bytag,
+                                                         (tilenames[k:k+batchsize],),kwargs))
+
+    def get(self,tilename,default=False):
+        if tilename not in self.batch:
+            return default
+        return self.results[self.batch[tilename]].get().get(tilename,default)
+
+
+class OracleBackend(MetadataBackend):
+
+    """
+    Backend for the DESDM Oracle DBs, for the prod/des_admin/dr1
+    schemas. If a dbpool.OraclePool is given, each lookup runs on a
+    pooled session and the chunked lookups are split across its workers
+    """
+
+    name = 'oracle'
+
+    def __init__(self,dbh,schema='prod',tilegeom_snapshot=None,pool=None):
+        MetadataBackend.__init__(self)
+        self.dbh = dbh
+        self.schema = schema
+        self.tilegeom_snapshot = tilegeom_snapshot
+        self.pool = pool
+
+    def call(self,func,*args,**kwargs):
+        """ Call func with the backend DB handle, or with a pooled session """
+        if self.pool is not None:
+            return self.pool.call(func,*args,**kwargs)
+        kwargs['dbh'] = self.dbh
+        return func(*args,**kwargs)
+
+    def split(self,items):
+        """ Split items in one part per pool worker """
+        nparts = min(self.pool.nworkers,len(items))
+        return [items[k::nparts] for k in range(nparts)] if nparts > 0 else []
+
+    def get_archive_root(self,verb=False):
+        t0 = time.time()
+        archive_root = self.call(tilefinder.get_archive_root,schema=self.schema,verb=verb)
+        self.record('get_archive_root',t0)
+        return archive_root
+
+    def get_tilegeom(self,verb=False):
+        t0 = time.time()
+        tilegeom = self.call(tilefinder.load_tilegeom,schema=self.schema,snapshot=self.tilegeom_snapshot,verb=verb)
+        self.record('get_tilegeom',t0)
+        return tilegeom
+
+    def find_tilenames_radec_batch(self,ra,dec,verb=False):
+        return self.call(tilefinder.find_tilenames_radec_batch,ra,dec,schema=self.schema,verb=verb)
+
+    def find_tilenames_radec_byobject(self,ra,dec):
+        return self.call(tilefinder.find_tilenames_radec,ra,dec,schema=self.schema)
+
+    def find_tilenames_id(self,id,tablename,verb=False):
+        t0 = time.time()
+        if self.pool is None:
+            result = tilefinder.find_tilenames_id(id,tablename,self.dbh,schema=self.schema,verb=verb)
+        else:
+            # Resolve the ids in contiguous parts on concurrent sessions
+            id = numpy.asarray(id)
+            parts = numpy.array_split(numpy.arange(len(id)),max(1,min(self.pool.nworkers,len(id))))
+            resolved = self.pool.map(tilefinder.query_tilenames_id,[id[p] for p in parts],
+                                     tablename=tablename,schema=self.schema,verb=verb)
+            tilenames_matched = numpy.concatenate([r[0] for r in resolved]).tolist()
+            ras = numpy.concatenate([r[1] for r in resolved])
+            decs = numpy.concatenate([r[2] for r in resolved])
+            tilenames, indices = tilefinder.group_by_tilename(tilenames_matched)
+            result = tilenames, ras, decs, indices, tilenames_matched
+        self.record('find_tilenames_id',t0)
+        return result
+
+    def get_coaddfiles(self,tilenames,tag,bands='all',verb=False):
+        t0 = time.time()
+        if self.pool is None:
+            coaddfiles = tilefinder.get_coaddfiles_tilenames_bytag(tilenames,self.dbh,tag,bands=bands,
+                                                                   schema=self.schema,verb=verb)
+        else:
+            coaddfiles = {}
+            for part in self.pool.map(tilefinder.get_coaddfiles_tilenames_bytag,self.split(list(tilenames)),
+                                      tag=tag,bands=bands,schema=self.schema,verb=verb):
+                coaddfiles.update(part)
+        self.record('get_coaddfiles',t0)
+        return coaddfiles
+
+    def prefetch_coaddfiles(self,tilenames,tag,bands='all',batchsize=200,verb=False):
+        if self.pool is None:
+            return self.get_coaddfiles(tilenames,tag,bands=bands,verb=verb)
+        return CoaddFilesPrefetch(self,tilenames,tag,bands=bands,batchsize=batchsize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.dbh is not None:
+            self.dbh.close()
+
+
+class SQLiteBackend(MetadataBackend):
+
+    """
+    Local stand-in backend on a SQLite file with the catalog.CATALOG_TABLES
+    layout, as written by catalog.export_catalog(). For ID searches, the
+    table passed as --coaddtable needs the columns of prod.COADD_OBJECT:
+    ID, TILENAME, ALPHAWIN_J2000, DELTAWIN_J2000
+    """
+
+    name = 'sqlite'
+    # Records from the snapshot have the prod file layout for all schemas
+    schema = 'catalog'
+
+    def __init__(self,filename):
+        MetadataBackend.__init__(self)
+        self.filename = filename
+        self.dbh = catalog.connect_catalog(filename)
+        self.tag, self.source_schema = catalog.get_catalog_info(self.dbh)
+
+    @staticmethod
+    def create(filename,tag,schema='prod',archive_root=''):
+        """ Create an empty SQLite backend file, to be filled by hand or by a benchmark """
+        if os.path.exists(filename):
+            os.remove(filename)
+        con = sqlite3.connect(filename)
+        con.executescript(catalog.CATALOG_TABLES)
+        con.execute("insert into SNAPSHOT_INFO values (?,?,?)",(tag,schema,time.strftime('%Y-%m-%dT%H:%M:%S')))
+        con.execute("insert into OPS_ARCHIVE values (?,?)",('desar2home',archive_root))
+        con.commit()
+        con.close()
+        return SQLiteBackend(filename)
+
+    def get_archive_root(self,verb=False):
+        t0 = time.time()
+        archive_root = catalog.get_archive_root_catalog(self.dbh)
+        self.record('get_archive_root',t0)
+        return archive_root
+
+    def get_tilegeom(self,verb=False):
+        t0 = time.time()
+        tilegeom = catalog.get_tilegeom_catalog(self.dbh)
+        self.record('get_tilegeom',t0)
+        return tilegeom
+
+    def find_tilenames_radec_batch(self,ra,dec,verb=False):
+
+        """ Same as tilefinder.find_tilenames_radec_batch() on a SQLite temporary table """
+
+        ra = numpy.atleast_1d(numpy.asarray(ra,dtype=numpy.float64))
+        dec = numpy.atleast_1d(numpy.asarray(dec,dtype=numpy.float64))
+        ra180 = numpy.where(ra > 180,ra-360,ra)
+
+        QUERY_TILENAME_RADEC = """
+        select p.IDX, g.TILENAME from temp.DESTHUMBS_RADEC p, COADDTILE_GEOM g
+               where (g.CROSSRA0='N' AND (p.RA BETWEEN g.RACMIN and g.RACMAX) AND
+                                          (p.DEC BETWEEN g.DECCMIN and g.DECCMAX)) OR
+                     (g.CROSSRA0='Y' AND (p.RA180 BETWEEN g.RACMIN-360 and g.RACMAX) AND
+                                          (p.DEC BETWEEN g.DECCMIN and g.DECCMAX))
+               order by g.TILENAME, p.IDX
+        """
+        self.dbh.execute("create temp table if not exists DESTHUMBS_RADEC (IDX integer, RA real, DEC real, RA180 real)")
+        self.dbh.execute("delete from temp.DESTHUMBS_RADEC")
+        self.dbh.executemany("insert into temp.DESTHUMBS_RADEC values (?,?,?,?)",
+                             zip(range(len(ra)),ra.tolist(),dec.tolist(),ra180.tolist()))
+
+        # When tiles overlap the first TILENAME wins
+        itile = numpy.zeros(len(ra),dtype=int) - 1
+        names = []
+        for idx,tilename in self.dbh.execute(QUERY_TILENAME_RADEC):
+            if not names or names[-1] != tilename:
+                names.append(tilename)
+            if itile[idx] < 0:
+                itile[idx] = len(names)-1
+        self.dbh.execute("delete from temp.DESTHUMBS_RADEC")
+
+        names = numpy.array(names,dtype=object)
+        matched = numpy.empty(len(ra),dtype=object)
+        matched[:] = False
+        matched[itile >= 0] = names[itile[itile >= 0]]
+        for k in numpy.nonzero(itile < 0)[0]:
+            SOUT.write("# WARNING: No tile found at ra:%s, dec:%s\n" % (ra[k],dec[k]))
+        tilenames, indices = tilefinder.group_by_tileindex(itile,names)
+        return tilenames, indices, matched.tolist()
+
+    def find_tilenames_radec_byobject(self,ra,dec):
+
+        """ One query per position, same as tilefinder.find_tilenames_radec() """
+
+        QUERY_TILENAME_RADEC = """
+        select TILENAME from COADDTILE_GEOM
+               where (CROSSRA0='N' AND (? BETWEEN RACMIN and RACMAX) AND (? BETWEEN DECCMIN and DECCMAX)) OR
+                     (CROSSRA0='Y' AND (? BETWEEN RACMIN-360 and RACMAX) AND (? BETWEEN DECCMIN and DECCMAX))
+        """
+        tilenames_matched = []
+        for k in range(len(ra)):
+            ra180 = ra[k]-360 if ra[k] > 180 else ra[k]
+            row = self.dbh.execute(QUERY_TILENAME_RADEC,
+                                   (float(ra[k]),float(dec[k]),float(ra180),float(dec[k]))).fetchone()
+            if row is None:
+                SOUT.write("# WARNING: No tile found at ra:%s, dec:%s\n" % (ra[k],dec[k]))
+                tilenames_matched.append(False)
+            else:
+                tilenames_matched.append(row[0])
+        tilenames, indices = tilefinder.group_by_tilename(tilenames_matched)
+        return tilenames, indices, tilenames_matched
+
+    def find_tilenames_id(self,id,tablename,verb=False):
+
+        """ Same as tilefinder.find_tilenames_id(), on a local objects table """
+
+        QUERY_TILENAME_IDS = """
+        select ID,TILENAME,ALPHAWIN_J2000 as RA,DELTAWIN_J2000 as DEC from {TABLENAME}
+               where ID in ({BINDS})"""
+
+        t0 = time.time()
+        uids, inverse = numpy.unique(numpy.asarray(id),return_inverse=True)
+        tilename = numpy.empty(len(uids),dtype=object)
+        tilename[:] = False
+        ra = numpy.zeros(len(uids)) + numpy.nan
+        dec = numpy.zeros(len(uids)) + numpy.nan
+        for k in range(0,len(uids),catalog.SQLITE_CHUNKSIZE):
+            chunk = uids[k:k+catalog.SQLITE_CHUNKSIZE].tolist()
+            query = QUERY_TILENAME_IDS.format(TABLENAME=tablename,BINDS=",".join(["?"]*len(chunk)))
+            for rid,rtilename,rra,rdec in self.dbh.execute(query,chunk):
+                j = numpy.searchsorted(uids,rid)
+                tilename[j] = rtilename
+                ra[j] = rra
+                dec[j] = rdec
+
+        missing = uids[numpy.array([t is False for t in tilename],dtype=bool)]
+        if len(missing) > 0:
+            SOUT.write("# WARNING: %s COADD_OBJECTS_ID not found in %s: %s\n" %
+                       (len(missing),tablename,",".join([str(m) for m in missing])))
+
+        tilenames_matched = tilename[inverse].tolist()
+        tilenames, indices = tilefinder.group_by_tilename(tilenames_matched)
+        self.record('find_tilenames_id',t0)
+        return tilenames, ra[inverse], dec[inverse], indices, tilenames_matched
+
+    def get_coaddfiles(self,tilenames,tag,bands='all',verb=False):
+        """ The snapshot holds the files of a single TAG (self.tag), so tag is not used """
+        t0 = time.time()
+        coaddfiles = catalog.get_coaddfiles_tilenames_catalog(tilenames,self.dbh,bands=bands)
+        self.record('get_coaddfiles',t0)
+        return coaddfiles
+
+    def close(self):
+        self.dbh.close()
@@ -0,0 +1,3 @@
+from . synthetic import *
+from . cutouts import *
+from . tilematch import *
@@ -0,0 +1,193 @@
+"""
+Benchmark of fitscutter and the color images on synthetic tiles, across
+tile variants, stamp sizes, object densities and worker counts. Each
+case is run through the TileScheduler as makeDESthumbs does, and its
+throughput and per-stage metrics are written as JSON lines, which can
+be compared against the results of an earlier run to catch regressions.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import numpy
+from despyastro import wcsutil
+
+from .. import thumbslib
+from .. import scheduler
+from .. import metrics
+from . import synthetic
+
+SOUT = sys.stdout
+
+# The throughput that identifies each case, to compare with a baseline
+CASE_KEYS = ('variant','stamp','nobjects','nprocs','stage')
+
+
+def get_random_positions(filename,nobjects,seed=1):
+    """ Random ra,dec uniform over the SCI image of a tile """
+    header, hdu = thumbslib.get_headers_hdus(filename)
+    naxis1, naxis2 = thumbslib.get_image_size(header['SCI'])
+    rng = numpy.random.RandomState(seed)
+    x = rng.uniform(0.5,naxis1+0.5,nobjects)
+    y = rng.uniform(0.5,naxis2+0.5,nobjects)
+    ra, dec = wcsutil.WCS(header['SCI']).image2sky(x,y)
+    return numpy.asarray(ra), numpy.asarray(dec)
+
+
+def run_stage(tilename,cut_tasks,color_tasks,nprocs):
+    """ Run the tasks of a stage on a new scheduler, returns (wall, errors, metrics) """
+    thumbslib.set_fits_cache()
+    tasks = scheduler.TileScheduler(nprocs=nprocs)
+    t0 = time.time()
+    tasks.add_tile(tilename,cut_tasks,color_tasks)
+    errors = tasks.join()
+    return time.time()-t0, errors, tasks.metrics
+
+
+def bench_case(files,ra,dec,stamp,nprocs,outdir,tilename='DES0000+0000',color_engine='numpy',color_chunk=50):
+
+    """
+    Cut the stamps of side stamp (arcmin) at ra,dec from the files of
+    each band, split in nprocs tasks per band, and make their color
+    images, returns the records of the 'cut' and 'color' stages
+    """
+    casedir = tempfile.mkdtemp(prefix='bench_',dir=outdir)
+    bands = list(files.keys())
+    chunks = [c for c in numpy.array_split(numpy.arange(len(ra)),nprocs) if len(c) > 0]
+    cut_tasks = []
+    for band in bands:
+        for c in chunks:
+            kw = {'xsize': stamp, 'ysize': stamp, 'units': 'arcmin', 'prefix': 'DES',
+                  'outdir': casedir, 'tilename': tilename}
+            cut_tasks.append((thumbslib.fitscutter,(files[band],ra[c],dec[c]),kw))
+    color_tasks = []
+    for k in range(0,len(ra),color_chunk):
+        kw = {'engine': color_engine, 'prefix': 'DES', 'outdir': casedir}
+        if color_engine == 'numpy':
+            kw['ext'] = 'png'
+        color_tasks.append((scheduler.color_radec_list,(ra[k:k+color_chunk],dec[k:k+color_chunk],bands),kw))
+
+    records = []
+    for stage, tasks in (('cut',(cut_tasks,[])), ('color',([],color_tasks))):
+        wall, errors, stage_metrics = run_stage(tilename,tasks[0],tasks[1],nprocs)
+        records.append({'stage': stage, 'stamp': stamp, 'nobjects': len(ra), 'nprocs': nprocs,
+                        'wall': round(wall,6), 'per_sec': round(len(ra)/max(wall,1e-9),3),
+                        'errors': len(errors), 'stages': stage_metrics.summary()})
+    shutil.rmtree(casedir)
+    return records
+
+
+def bench_cutouts(files,stamps=[0.5,1.0,3.0],densities=[100,1000],nprocs_list=[1,2,4],outdir='.',
+                  color_engine='numpy',seed=1,results=None,sout=None):
+
+    """
+    Run bench_case() for all of the tile variants in files, as returned
+    by synthetic.make_synthetic_tiles(), stamp sizes, number of objects
+    per tile and worker counts. Returns the list of records, also
+    written as JSON lines to results if given
+    """
+    sout = sout or SOUT
+    records = []
+    sout.write("# %-12s %6s %8s %6s %6s %10s %12s\n" %
+               ('variant','stamp','nobjects','nprocs','stage','wall[s]','objects/sec'))
+    for variant in sorted(files.keys()):
+        first = files[variant][sorted(files[variant].keys())[0]]
+        for nobjects in densities:
+            ra, dec = get_random_positions(first,nobjects,seed=seed)
+            for stamp in stamps:
+                for nprocs in nprocs_list:
+                    for record in bench_case(files[variant],ra,dec,stamp,nprocs,outdir,color_engine=color_engine):
+                        record['variant'] = variant
+                        records.append(record)
+                        if results is not None:
+                            metrics.write_json_line(results,record)
+                        sout.write("# %-12s %6.2f %8d %6d %6s %10.3f %12.1f\n" %
+                                   (variant,stamp,nobjects,nprocs,record['stage'],record['wall'],record['per_sec']))
+    return records
+
+
+def read_results(filename):
+    """ Read the records of a benchmark from its JSON lines """
+    return [json.loads(line) for line in open(filename) if line.strip()]
+
+
+def compare_results(records,baseline,tolerance=0.2,sout=None):
+
+    """
+    Compare the throughput of each case with the baseline records,
+    returns the list of the cases slower by more than tolerance
+    """
+    sout = sout or SOUT
+    base = dict([(tuple(r[key] for key in CASE_KEYS),r) for r in baseline])
+    regressions = []
+    for r in records:
+        case = tuple(r[key] for key in CASE_KEYS)
+        if case not in base:
+            continue
+        ratio = r['per_sec']/max(base[case]['per_sec'],1e-9)
+        if ratio < 1.0 - tolerance:
+            regressions.append((case,ratio))
+            sout.write("# REGRESSION: %s at %.2f of the baseline throughput\n" % (dict(zip(CASE_KEYS,case)),ratio))
+    return regressions
+
+
+def cmdline():
+
+     import argparse
+     parser = argparse.ArgumentParser(description="Benchmarks fitscutter and the color images "
+                                      "on synthetic DES-like coadd tiles")
+
+     parser.add_argument("--outdir", type=str, action='store', default=os.getcwd(),
+                         help="Directory for the synthetic tiles and the temporary outputs [default='./']")
+     parser.add_argument("--tile_size", type=int, action='store', default=synthetic.TILE_SIZE,
+                         help="Size in pixels of the square synthetic tiles [default=%s]" % synthetic.TILE_SIZE)
+     parser.add_argument("--variants", type=str, action='store', nargs='+',
+                         default=['fits','fz','fits_noext','fz_noext'],
+                         choices=sorted(synthetic.TILE_VARIANTS.keys()),
+                         help="Tile variants: plain or Rice-compressed, with or without EXTNAME [default=all]")
+     parser.add_argument("--bands", type=str, action='store', nargs='+', default=['g','r','i'],
+                         help="Bands of the synthetic tiles [default=g r i]")
+     parser.add_argument("--stamps", type=float, action='store', nargs='+', default=[0.5,1.0,3.0],
+                         help="Stamp sizes in arcmin [default=0.5 1 3]")
+     parser.add_argument("--densities", type=int, action='store', nargs='+', default=[100,1000],
+                         help="Number of objects per tile [default=100 1000]")
+     parser.add_argument("--nprocs", type=int, action='store', nargs='+', default=[1,2,4],
+                         help="Worker counts [default=1 2 4]")
+     parser.add_argument("--color_engine", type=str, action='store', default='numpy', choices=['numpy','stiff'],
+                         help="Engine for the color images [default=numpy]")
+     parser.add_argument("--seed", type=int, action='store', default=1,
+                         help="Seed for the synthetic tiles and positions [default=1]")
+     parser.add_argument("--results", type=str, action='store', default='bench_cutouts.jsonl',
+                         help="JSON lines output file with the results [default=bench_cutouts.jsonl]")
+     parser.add_argument("--baseline", type=str, action='store', default=None,
+                         help="JSON lines results of an earlier run to compare with")
+     parser.add_argument("--tolerance", type=float, action='store', default=0.2,
+                         help="Fraction of the baseline throughput lost before a case is a regression [default=0.2]")
+     parser.add_argument("--verb", action='store_true', default=False,
+                         help="Turn on verbose mode [default=False]")
+     args = parser.parse_args()
+     args.sout = sys.stdout
+     return args
+
+
+def run(args):
+
+    """ Run the benchmark, returns the number of regressions against --baseline """
+    t0 = time.time()
+    tiledir = os.path.join(args.outdir,'synthetic_tiles')
+    files = synthetic.make_synthetic_tiles(tiledir,bands=args.bands,size=args.tile_size,variants=args.variants,
+                                           seed=args.seed,verb=args.verb)
+    with open(args.results,'w') as results:
+        records = bench_cutouts(files,stamps=args.stamps,densities=args.densities,nprocs_list=args.nprocs,
+                                outdir=args.outdir,color_engine=args.color_engine,seed=args.seed,
+                                results=results,sout=args.sout)
+    args.sout.write("# Wrote %s results to: %s\n" % (len(records),args.results))
+    regressions = []
+    if args.baseline:
+        regressions = compare_results(records,read_results(args.baseline),tolerance=args.tolerance,sout=args.sout)
+        args.sout.write("# %s regressions against: %s\n" % (len(regressions),args.baseline))
+    args.sout.write("# Total benchmark time: %s\n" % thumbslib.elapsed_time(t0))
+    return len(regressions)
@@ -0,0 +1,139 @@
+"""
+Synthetic DES-like coadd tiles for the benchmarks: SCI/MSK/WGT images
+with a TAN WCS at the DES pixel scale, sky noise, a power-law population
+of sources, saturated stars flagged in MSK and a weight map with the
+depth variations of a coadd. Tiles can be written as plain .fits or
+Rice-compressed .fits.fz, with or without EXTNAME, so that both ways of
+finding the extensions in thumbslib.get_headers_hdus() are exercised.
+"""
+
+import os
+import sys
+import time
+import numpy
+import fitsio
+
+from .. import thumbslib
+
+SOUT = sys.stdout
+
+# DES coadd pixel scale in arcsec/pixel and tile size in pixels
+PIXELSCALE = 0.263
+TILE_SIZE = 10000
+
+# The (compress, extname) variants of the tiles and their file extensions
+TILE_VARIANTS = {'fits':        ('.fits',    False, True),
+                 'fits_noext':  ('.fits',    False, False),
+                 'fz':          ('.fits.fz', True,  True),
+                 'fz_noext':    ('.fits.fz', True,  False)}
+
+# Rows of the images generated at a time, to bound the memory of the noise
+STRIP_ROWS = 1000
+
+
+def make_tile_header(tilename,band,ra0,dec0,size=TILE_SIZE,pixelscale=PIXELSCALE):
+    """ The header of a synthetic coadd tile centered on ra0,dec0, as a list of records """
+    cards = [('CTYPE1','RA---TAN'), ('CTYPE2','DEC--TAN'),
+             ('CRVAL1',ra0), ('CRVAL2',dec0),
+             ('CRPIX1',size/2.0+0.5), ('CRPIX2',size/2.0+0.5),
+             ('CD1_1',-pixelscale/3600.0), ('CD1_2',0.0),
+             ('CD2_1',0.0), ('CD2_2',pixelscale/3600.0),
+             ('EQUINOX',2000.0), ('RADESYS','ICRS'),
+             ('TILENAME',tilename), ('BAND',band), ('FILTER',band),
+             ('MAGZERO',30.0), ('EXPTIME',900.0)]
+    return [{'name': name, 'value': value} for name, value in cards]
+
+
+def make_synthetic_images(size=TILE_SIZE,seed=1,nsources=None,noise=10.0):
+
+    """
+    Make the SCI (float32), MSK (int16) and WGT (float32) images of a
+    sky-subtracted coadd tile, with nsources sources (size**2/1000 by
+    default), 1% of them saturated stars with their cores flagged in MSK
+    """
+    rng = numpy.random.RandomState(seed)
+    if nsources is None:
+        nsources = size*size//1000
+
+    # Depth variations of the coadd: a smooth gradient and a few shallow stripes
+    depth = numpy.linspace(0.8,1.2,size).astype('f4')
+    stripes = numpy.ones(size,dtype='f4')
+    for x in rng.randint(0,size,size//1000+1):
+        stripes[x:x+50] = 0.5
+
+    sci = numpy.empty((size,size),dtype='f4')
+    wgt = numpy.empty((size,size),dtype='f4')
+    for y in range(0,size,STRIP_ROWS):
+        ny = min(STRIP_ROWS,size-y)
+        wgt[y:y+ny] = depth[y:y+ny,numpy.newaxis]*stripes[numpy.newaxis,:]/noise**2
+        sci[y:y+ny] = rng.standard_normal((ny,size)).astype('f4')/numpy.sqrt(wgt[y:y+ny])
+    msk = numpy.zeros((size,size),dtype='i2')
+
+    # Gaussian sources with a power-law flux distribution
+    x = rng.uniform(0,size,nsources)
+    y = rng.uniform(0,size,nsources)
+    flux = 50.0*noise*(1.0 - rng.uniform(0,1,nsources))**(-1.0/1.5)
+    sigma = rng.uniform(1.0,3.0,nsources)
+    saturated = rng.uniform(0,1,nsources) < 0.01
+    flux[saturated] *= 1000.0
+    for k in range(nsources):
+        r = int(4*sigma[k]) + 1
+        x1, x2 = max(int(x[k])-r,0), min(int(x[k])+r+1,size)
+        y1, y2 = max(int(y[k])-r,0), min(int(y[k])+r+1,size)
+        yy, xx = numpy.mgrid[y1:y2,x1:x2]
+        stamp = numpy.exp(-0.5*((xx-x[k])**2 + (yy-y[k])**2)/sigma[k]**2)
+        sci[y1:y2,x1:x2] += (flux[k]/(2*numpy.pi*sigma[k]**2))*stamp
+        if saturated[k]:
+            msk[y1:y2,x1:x2][stamp > 0.1] |= 4
+    return sci, msk, wgt
+
+
+def write_synthetic_tile(filename,images,header,compress=False,extname=True):
+
+    """
+    Write the SCI, MSK and WGT images of a tile. Without extname, only
+    SCI and WGT are written, at the HDUs of the older DESDM coadds:
+    0 and 1 for .fits, 1 and 2 for .fits.fz
+    """
+    sci, msk, wgt = images
+    if extname:
+        hdus = [('SCI',sci,'IMAGE'), ('MSK',msk,'MASK'), ('WGT',wgt,'WEIGHT')]
+    else:
+        hdus = [('SCI',sci,'IMAGE'), ('WGT',wgt,'WEIGHT')]
+
+    tmpname = filename + '.tmp'
+    with fitsio.FITS(tmpname,'rw',clobber=True) as ofits:
+        for EXTNAME, image, des_ext in hdus:
+            h = list(header) + [{'name': 'DES_EXT', 'value': des_ext}]
+            if extname:
+                h.append({'name': 'EXTNAME', 'value': EXTNAME})
+            ofits.write(image,header=h,extname=EXTNAME if extname else None,
+                        compress='RICE' if compress else None)
+    os.rename(tmpname,filename)
+    return
+
+
+def make_synthetic_tiles(outdir,tilename='DES0000+0000',bands=['g','r','i'],ra0=10.0,dec0=0.0,
+                         size=TILE_SIZE,variants=['fits','fz'],seed=1,verb=False):
+
+    """
+    Write a synthetic tile for each variant in TILE_VARIANTS and band,
+    unless already there, and return {variant: {band: filename}}
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    files = {}
+    for variant in variants:
+        files[variant] = {}
+        ext, compress, extname = TILE_VARIANTS[variant]
+        for k, band in enumerate(bands):
+            filename = os.path.join(outdir,"%s_%s_%s_%s%s" % (tilename,band,size,variant,ext))
+            files[variant][band] = filename
+            if os.path.exists(filename):
+                continue
+            t0 = time.time()
+            images = make_synthetic_images(size=size,seed=seed+k)
+            header = make_tile_header(tilename,band,ra0,dec0,size=size)
+            write_synthetic_tile(filename,images,header,compress=compress,extname=extname)
+            if verb: SOUT.write("# Wrote %s in %s\n" % (filename,thumbslib.elapsed_time(t0)))
+    return files
@@ -0,0 +1,236 @@
+"""
+Benchmark of the ways to match positions to tiles, on a synthetic
+full-footprint COADDTILE_GEOM in a local SQLite stand-in (the layout of
+catalog.CATALOG_TABLES used by backends.SQLiteBackend): one query per
+position ('byobject', as tilefinder.find_tilenames_radec), a single
+batched query ('db') and the in-memory TileGeomIndex ('local'), on
+random or clustered position lists. All methods must return the same
+tilenames_matched for the same list, which is checked on a random
+subsample for the methods too slow to run on the whole list.
+"""
+
+import os
+import sys
+import time
+import numpy
+
+from .. import thumbslib
+from .. import backends
+from .. import metrics
+
+SOUT = sys.stdout
+
+# Side of the DES tiles in degrees
+TILE_SIDE = 0.7306
+
+# Declination range of the synthetic footprint
+FOOTPRINT_DEC = (-65.0,5.0)
+
+METHODS = ['byobject','db','local']
+
+
+def get_tilename(ra,dec):
+    """ DES-like tilename (DEShhmm+ddmm) for the center of a tile """
+    hours = (ra % 360.0)/15.0
+    hh, mm = int(hours), int(round((hours-int(hours))*60))
+    if mm == 60:
+        hh, mm = (hh+1) % 24, 0
+    sign = '-' if dec < 0 else '+'
+    dd, dm = int(abs(dec)), int(round((abs(dec)-int(abs(dec)))*60))
+    if dm == 60:
+        dd, dm = dd+1, 0
+    return "DES%02d%02d%s%02d%02d" % (hh,mm,sign,dd,dm)
+
+
+def make_tilegeom(ntiles=10000,side=TILE_SIDE,decrange=FOOTPRINT_DEC):
+
+    """
+    Make the rows (TILENAME, CROSSRA0, RACMIN, RACMAX, DECCMIN, DECCMAX)
+    of about ntiles tiles covering the dec range over an RA span
+    centered on RA=0, so that some of them cross RA=0. Adjacent tiles
+    share their boundaries. Returns the rows and the RA span
+    """
+    decs = numpy.arange(decrange[0],decrange[1],side)
+    # Tiles of a full ring of each row of tiles
+    nring = [360.0*numpy.cos(numpy.radians(d+side/2.0))/side for d in decs]
+    span = min(360.0,360.0*ntiles/sum(nring))
+    rows = []
+    names = set()
+    for d, n in zip(decs,nring):
+        nra = max(1,int(numpy.ceil(n*span/360.0)))
+        width = span/nra
+        for k in range(nra):
+            ra1 = -span/2.0 + k*width
+            ra2 = ra1 + width
+            if ra1 < 0 and ra2 > 0:
+                crossra0, racmin, racmax = 'Y', ra1+360.0, ra2
+            else:
+                crossra0, racmin, racmax = 'N', ra1 % 360.0, (ra2 % 360.0) or 360.0
+            tilename = get_tilename((ra1+ra2)/2.0,d+side/2.0)
+            while tilename in names:
+                tilename = tilename + 'X'
+            names.add(tilename)
+            rows.append((tilename,crossra0,racmin,racmax,d,d+side))
+    rows.sort()
+    return rows, span
+
+
+def make_backend(filename,ntiles=10000):
+    """ Write the synthetic tile geometry into a SQLite backend, returns (backend, span) """
+    rows, span = make_tilegeom(ntiles)
+    backend = backends.SQLiteBackend.create(filename,'SYNTHETIC')
+    backend.dbh.executemany("insert into COADDTILE_GEOM values (?,?,?,?,?,?)",rows)
+    backend.dbh.commit()
+    return backend, span
+
+
+def make_positions(npositions,span,distribution='random',nclusters=100,sigma=0.5,seed=1,decrange=FOOTPRINT_DEC):
+
+    """
+    Positions inside the synthetic footprint, uniform on the sphere
+    ('random') or in nclusters gaussian clusters of sigma degrees
+    ('clustered')
+    """
+    rng = numpy.random.RandomState(seed)
+    sin1, sin2 = numpy.sin(numpy.radians(decrange[0])), numpy.sin(numpy.radians(decrange[1]))
+
+    def uniform(n):
+        ra = rng.uniform(-span/2.0,span/2.0,n)
+        dec = numpy.degrees(numpy.arcsin(rng.uniform(sin1,sin2,n)))
+        return ra, dec
+
+    if distribution == 'random':
+        ra, dec = uniform(npositions)
+    elif distribution == 'clustered':
+        cra, cdec = uniform(nclusters)
+        ra = numpy.zeros(npositions)
+        dec = numpy.zeros(npositions)
+        todo = numpy.arange(npositions)
+        while len(todo) > 0:
+            c = rng.randint(0,nclusters,len(todo))
+            dec[todo] = cdec[c] + rng.normal(0,sigma,len(todo))
+            ra[todo] = cra[c] + rng.normal(0,sigma,len(todo))/numpy.cos(numpy.radians(dec[todo]))
+            # Draw again the ones that fell out of the footprint
+            todo = todo[(dec[todo] < decrange[0]) | (dec[todo] > decrange[1]) |
+                        (ra[todo] < -span/2.0) | (ra[todo] > span/2.0)]
+    else:
+        raise ValueError("ERROR: position distribution not defined: %s" % distribution)
+    return ra % 360.0, dec
+
+
+def bench_tilematch(backend,ra,dec,methods=METHODS,maxpositions={},seed=1):
+
+    """
+    Time each method on the same positions, skipping the methods with a
+    maxpositions below len(ra). Those are still run, untimed, on a
+    random subsample of maxpositions of the positions, so that every
+    method is checked against all of the others on the positions they
+    share. Returns the records of the timed methods, with identical
+    None when no other method ran
+    """
+    records = []
+    results = {}
+    rng = numpy.random.RandomState(seed)
+    for method in methods:
+        indices = None
+        if len(ra) > maxpositions.get(method,len(ra)):
+            indices = numpy.sort(rng.choice(len(ra),maxpositions[method],replace=False))
+        # Each method starts from scratch, 'local' builds its index in the timed call
+        backend.tilegeom_index = None
+        t0 = time.time()
+        if indices is None:
+            tilenames, _, tilenames_matched = backend.find_tilenames_radec(ra,dec,method=method)
+        else:
+            tilenames, _, tilenames_matched = backend.find_tilenames_radec(ra[indices],dec[indices],method=method)
+        wall = time.time() - t0
+        results[method] = (indices,numpy.asarray(tilenames_matched,dtype=object))
+        if indices is not None:
+            continue
+        records.append({'method': method, 'npositions': len(ra), 'wall': round(wall,6),
+                        'per_sec': round(len(ra)/max(wall,1e-9),3), 'ntiles_hit': len(tilenames),
+                        'nmatched': int(sum([t is not False for t in tilenames_matched]))})
+
+    # Check each timed method against the others, on the subsample if they ran on one
+    for record in records:
+        matched = results[record['method']][1]
+        mismatches, nchecked, checked = 0, 0, []
+        for other in methods:
+            if other == record['method']:
+                continue
+            indices, other_matched = results[other]
+            this = matched if indices is None else matched[indices]
+            mismatches += int((this != other_matched).sum())
+            nchecked = max(nchecked,len(this))
+            checked.append(other)
+        record.update({'checked_against': checked, 'nchecked': nchecked, 'mismatches': mismatches,
+                       'identical': mismatches == 0 if checked else None})
+    return records
+
+
+def cmdline():
+
+     import argparse
+     parser = argparse.ArgumentParser(description="Benchmarks the matching of positions to tiles "
+                                      "on a synthetic COADDTILE_GEOM")
+
+     parser.add_argument("--outdir", type=str, action='store', default=os.getcwd(),
+                         help="Directory for the SQLite stand-in [default='./']")
+     parser.add_argument("--ntiles", type=int, action='store', default=10000,
+                         help="Approximate number of tiles in the synthetic footprint [default=10000]")
+     parser.add_argument("--sizes", type=int, action='store', nargs='+', default=[1000,10000,100000,1000000,10000000],
+                         help="Number of positions of the lists [default=1k 10k 100k 1M 10M]")
+     parser.add_argument("--distributions", type=str, action='store', nargs='+', default=['random','clustered'],
+                         choices=['random','clustered'],
+                         help="Distributions of the positions [default=random clustered]")
+     parser.add_argument("--methods", type=str, action='store', nargs='+', default=METHODS, choices=METHODS,
+                         help="Matching methods [default=byobject db local]")
+     parser.add_argument("--byobject_max", type=int, action='store', default=10000,
+                         help="Largest list timed for the one query per position method, "
+                              "larger ones are checked on a subsample of this size [default=10000]")
+     parser.add_argument("--db_max", type=int, action='store', default=10000,
+                         help="Largest list timed for the batched query method, "
+                              "larger ones are checked on a subsample of this size [default=10000]")
+     parser.add_argument("--seed", type=int, action='store', default=1,
+                         help="Seed for the positions [default=1]")
+     parser.add_argument("--results", type=str, action='store', default='bench_tilematch.jsonl',
+                         help="JSON lines output file with the results [default=bench_tilematch.jsonl]")
+     args = parser.parse_args()
+     args.sout = sys.stdout
+     return args
+
+
+def run(args):
+
+    """ Run the benchmark, returns the number of cases where the methods disagree """
+    t0 = time.time()
+    sout = args.sout
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    backend, span = make_backend(os.path.join(args.outdir,'bench_tilegeom.sqlite'),ntiles=args.ntiles)
+    ntiles, ncross = backend.dbh.execute("select count(*), sum(CROSSRA0='Y') from COADDTILE_GEOM").fetchone()
+    sout.write("# Synthetic footprint: %s tiles, %s crossing RA=0, RA span %.1f deg\n" % (ntiles,ncross,span))
+
+    maxpositions = {'byobject': args.byobject_max, 'db': args.db_max}
+    ndisagree = 0
+    sout.write("# %-10s %10s %10s %10s %14s %10s\n" %
+               ('positions','npositions','method','wall[s]','positions/sec','identical'))
+    with open(args.results,'w') as results:
+        for distribution in args.distributions:
+            for size in args.sizes:
+                ra, dec = make_positions(size,span,distribution=distribution,seed=args.seed)
+                records = bench_tilematch(backend,ra,dec,methods=args.methods,maxpositions=maxpositions,
+                                          seed=args.seed)
+                for record in records:
+                    record.update({'distribution': distribution, 'ntiles': ntiles})
+                    metrics.write_json_line(results,record)
+                    sout.write("# %-10s %10d %10s %10.3f %14.1f %10s\n" %
+                               (distribution,size,record['method'],record['wall'],record['per_sec'],
+                                record['identical']))
+                if any([record['identical'] is False for record in records]):
+                    ndisagree += 1
+    backend.close()
+    sout.write("# Wrote results to: %s\n" % args.results)
+    if ndisagree > 0:
+        sout.write("# ERROR: The methods disagree in %s cases\n" % ndisagree)
+    sout.write("# Total benchmark time: %s\n" % thumbslib.elapsed_time(t0))
+    return ndisagree
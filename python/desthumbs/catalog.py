@@ -0,0 +1,160 @@
+"""
+Set of functions to export a snapshot of the file-path catalog (the
+flattened {TAG}_COADD_FILEPATH table in make_tables.sql), the tile
+geometry and the archive root for a frozen release into a local SQLite
+file, and to resolve tiles and files from it without a DB connection.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import numpy
+
+from . import tilefinder
+from .thumbslib import elapsed_time
+
+SOUT = sys.stdout
+
+# Layout of the snapshot -- mirrors the tables in make_tables.sql
+CATALOG_TABLES = """
+create table SNAPSHOT_INFO (TAG text, SCHEMA text, CREATED text);
+create table OPS_ARCHIVE (NAME text, ROOT text);
+create table COADDTILE_GEOM (TILENAME text, CROSSRA0 text,
+                             RACMIN real, RACMAX real, DECCMIN real, DECCMAX real);
+create table COADD_FILEPATH (FILENAME text, TILENAME text, BAND text,
+                             FILETYPE text, PATH text, COMPRESSION text);
+create index COADD_FILEPATH_TILENAME_BAND on COADD_FILEPATH (TILENAME, BAND);
+"""
+
+# SQLite default limit on the number of host parameters is 999
+SQLITE_CHUNKSIZE = 500
+
+
+def coaddfiles_to_rows(coaddfiles,schema='prod'):
+
+    """
+    Flatten the dictionary of record arrays from
+    get_coaddfiles_tilenames_bytag() into (FILENAME, TILENAME, BAND,
+    FILETYPE, PATH, COMPRESSION) rows, whatever the schema layout
+    """
+    rows = []
+    for tilename in sorted(coaddfiles.keys()):
+        rec = coaddfiles[tilename]
+        names = rec.dtype.names
+        if schema == 'dr1':
+            # One column per band, with the URL of the file
+            for name in names:
+                url = rec[name][0]
+                if url is None:
+                    continue
+                filename = url.replace('http://desdr-server.ncsa.illinois.edu','/des004')
+                rows.append((os.path.basename(filename),tilename,name.split('_')[-1].lower(),None,
+                             os.path.dirname(filename),''))
+        elif 'FILENAME' in names:
+            for k in range(len(rec)):
+                filetype = rec['FILETYPE'][k] if 'FILETYPE' in names else None
+                rows.append((rec['FILENAME'][k],tilename,rec['BAND'][k],filetype,
+                             rec['PATH'][k],rec['COMPRESSION'][k]))
+        else:
+            # Old des_admin schema only has the full relative path
+            for k in range(len(rec)):
+                rows.append((os.path.basename(rec['PATH'][k]),tilename,rec['BAND'][k],None,
+                             os.path.dirname(rec['PATH'][k]),''))
+    return rows
+
+
+def export_catalog(filename,dbh,tag,schema='prod',verb=False):
+
+    """
+    Export the file-path catalog for all tiles in tag, the tile geometry
+    and the archive root into a SQLite snapshot
+    """
+
+    t0 = time.time()
+    archive_root = tilefinder.get_archive_root(dbh,schema=schema,verb=verb)
+    tilegeom = tilefinder.get_tilegeom(dbh,schema=schema,verb=verb)
+    coaddfiles = tilefinder.get_coaddfiles_tilenames_bytag(tilegeom['TILENAME'].tolist(),dbh,tag,
+                                                           schema=schema,verb=verb)
+    rows = coaddfiles_to_rows(coaddfiles,schema=schema)
+    # DR1 keeps absolute paths
+    if schema == 'dr1':
+        archive_root = ''
+
+    # Write into a temporary file and move it in place when done
+    tmpname = filename + '.tmp'
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    con = sqlite3.connect(tmpname)
+    con.executescript(CATALOG_TABLES)
+    con.execute("insert into SNAPSHOT_INFO values (?,?,?)",(tag,schema,time.strftime('%Y-%m-%dT%H:%M:%S')))
+    con.execute("insert into OPS_ARCHIVE values (?,?)",('desar2home',archive_root))
+    geom_rows = zip(tilegeom['TILENAME'].tolist(),tilegeom['CROSSRA0'].tolist(),
+                    tilegeom['RACMIN'].tolist(),tilegeom['RACMAX'].tolist(),
+                    tilegeom['DECCMIN'].tolist(),tilegeom['DECCMAX'].tolist())
+    con.executemany("insert into COADDTILE_GEOM values (?,?,?,?,?,?)",geom_rows)
+    con.executemany("insert into COADD_FILEPATH values (?,?,?,?,?,?)",rows)
+    con.commit()
+    con.close()
+    os.rename(tmpname,filename)
+    SOUT.write("# Wrote %s tiles and %s files for TAG:%s to: %s in %s\n" %
+               (len(tilegeom),len(rows),tag,filename,elapsed_time(t0)))
+    return
+
+
+def connect_catalog(filename):
+    """ Open a snapshot written by export_catalog() """
+    if not os.path.exists(filename):
+        raise IOError("ERROR: Cannot find catalog snapshot: %s" % filename)
+    return sqlite3.connect(filename)
+
+
+def get_catalog_info(con):
+    """ Return the TAG and SCHEMA the snapshot was made from """
+    tag, schema = con.execute("select TAG, SCHEMA from SNAPSHOT_INFO").fetchone()
+    return tag, schema
+
+
+def get_archive_root_catalog(con):
+    return con.execute("select ROOT from OPS_ARCHIVE where NAME='desar2home'").fetchone()[0]
+
+
+def get_tilegeom_catalog(con):
+    """ Get the tile geometry from the snapshot, same as tilefinder.get_tilegeom() """
+    cur = con.execute("select TILENAME, CROSSRA0, RACMIN, RACMAX, DECCMIN, DECCMAX "
+                      "from COADDTILE_GEOM order by TILENAME")
+    rec = numpy.rec.array(cur.fetchall(),names=[d[0] for d in cur.description])
+    return tilefinder.fix_tilegeom(rec)
+
+
+def get_coaddfiles_tilenames_catalog(tilenames,con,bands='all'):
+
+    """
+    Get the files for a list of tilenames from the snapshot, as a
+    dictionary of record arrays keyed by tilename, with the same layout
+    as tilefinder.get_coaddfiles_tilenames_bytag() for the prod schema
+    """
+
+    QUERY_COADDFILES = """
+    select FILENAME, TILENAME, BAND, PATH, COMPRESSION from COADD_FILEPATH
+           where {and_BANDS} TILENAME in ({BINDS})"""
+
+    if bands == 'all':
+        and_BANDS = ''
+    else:
+        sbands = "'" + "','".join(bands) + "'"  # trick to format
+        and_BANDS = "BAND in ({BANDS}) and".format(BANDS=sbands)
+
+    tilenames = list(tilenames)
+    coaddfiles = {}
+    for k in range(0,len(tilenames),SQLITE_CHUNKSIZE):
+        chunk = tilenames[k:k+SQLITE_CHUNKSIZE]
+        query = QUERY_COADDFILES.format(and_BANDS=and_BANDS,BINDS=",".join(["?"]*len(chunk)))
+        cur = con.execute(query,chunk)
+        names = [d[0] for d in cur.description]
+        tile_tuples = {}
+        for t in cur.fetchall():
+            tile_tuples.setdefault(t[1],[]).append(t)
+        for tilename in tile_tuples:
+            coaddfiles[tilename] = numpy.rec.array(tile_tuples[tilename],names=names)
+    return coaddfiles
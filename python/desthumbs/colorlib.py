@@ -0,0 +1,283 @@
+"""
+In-process color engine to make the color images of the thumbnails
+with numpy, without running stiff. The levels and stretch follow the
+settings in etc/default.stiff (sky level, MIN/MAX levels, GAMMA,
+GAMMA_FAC, COLOUR_SAT), with an optional asinh (Lupton et al. 2004)
+stretch. PNG is written with zlib, TIFF and JPEG need Pillow.
+"""
+
+import os
+import sys
+import time
+import zlib
+import struct
+import numpy
+import fitsio
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from . import thumbslib
+from . import cutoutcache
+from . import metrics
+
+SOUT = sys.stdout
+
+# The settings in etc/default.stiff used by the engine, in case the file
+# cannot be found
+STIFF_DEFAULTS = {
+    'SKY_TYPE'            : 'AUTO',
+    'SKY_LEVEL'           : 0.0,
+    'MIN_TYPE'            : 'GREYLEVEL',
+    'MIN_LEVEL'           : 0.001,
+    'MAX_TYPE'            : 'QUANTILE',
+    'MAX_LEVEL'           : 0.995,
+    'GAMMA'               : 2.2,
+    'GAMMA_FAC'           : 1.0,
+    'COLOUR_SAT'          : 1.0,
+    'NEGATIVE'            : 'N',
+    'COMPRESSION_TYPE'    : 'JPEG',
+    'COMPRESSION_QUALITY' : 90,
+    }
+
+# Formats written by the engine by extension, and the Pillow names
+IMAGE_FORMATS = {'tif': 'TIFF', 'tiff': 'TIFF', 'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG'}
+TIFF_COMPRESSION = {'JPEG': 'jpeg', 'LZW': 'tiff_lzw', 'DEFLATE': 'tiff_deflate',
+                    'ADOBE-DEFLATE': 'tiff_adobe_deflate', 'NONE': None}
+
+# zlib strategy of the PNG color images: Huffman coding only, as the
+# noise of the sky leaves little to match, it is ~8x faster than the
+# default and makes smaller files of the stamps
+PNG_ZLIB_STRATEGY = getattr(zlib,'Z_HUFFMAN_ONLY',2)
+
+# The parsed stiff configuration files, as {filename: (mtime, config)}
+STIFF_CONFIGS = {}
+
+
+def read_stiff_config(filename):
+    """ Read a stiff configuration file into a dictionary """
+    config = {}
+    for line in open(filename):
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        items = line.split(None,1)
+        if len(items) == 2:
+            config[items[0]] = items[1].strip().strip('"')
+    return config
+
+
+def get_stiff_config(filename):
+    """ read_stiff_config() once per process, and again only if the file changes """
+    mtime = os.path.getmtime(filename)
+    if filename not in STIFF_CONFIGS or STIFF_CONFIGS[filename][0] != mtime:
+        STIFF_CONFIGS[filename] = (mtime,read_stiff_config(filename))
+    return STIFF_CONFIGS[filename][1]
+
+
+def get_color_parameters(stiff_parameters={}):
+
+    """
+    Get the color parameters from etc/default.stiff, if found, updated
+    with stiff_parameters, and converted to the types of STIFF_DEFAULTS
+    """
+    pars = dict(STIFF_DEFAULTS)
+    if 'DESTHUMBS_DIR' in os.environ:
+        stiff_conf = os.path.join(os.environ['DESTHUMBS_DIR'],'etc','default.stiff')
+        if os.path.exists(stiff_conf):
+            config = get_stiff_config(stiff_conf)
+            pars.update([(key,config[key]) for key in STIFF_DEFAULTS if key in config])
+    pars.update(stiff_parameters)
+    for key in STIFF_DEFAULTS:
+        pars[key] = type(STIFF_DEFAULTS[key])(pars[key])
+    return pars
+
+
+def get_levels(image,pars):
+
+    """
+    Get the sky, minimum and maximum levels of an image the way stiff
+    does with the SKY_TYPE, MIN_TYPE and MAX_TYPE options
+    """
+    finite = numpy.isfinite(image)
+    good = image if finite.all() else image[finite]
+    if good.size == 0:
+        return 0.0, 0.0, 1.0
+
+    # All of the quantiles needed, from a single partition of the pixels
+    q = {}
+    if pars['SKY_TYPE'] == 'AUTO':
+        q['sky'] = 50.0
+    if pars['MAX_TYPE'] == 'QUANTILE':
+        q['max'] = 100*pars['MAX_LEVEL']
+    if pars['MIN_TYPE'] == 'QUANTILE':
+        q['min'] = 100*pars['MIN_LEVEL']
+    keys = sorted(q.keys())
+    if keys:
+        q = dict(zip(keys,[float(v) for v in numpy.percentile(good,[q[key] for key in keys])]))
+
+    sky = q.get('sky',pars['SKY_LEVEL'])
+    vmax = q.get('max',pars['MAX_LEVEL'])
+    if pars['MIN_TYPE'] == 'QUANTILE':
+        vmin = q['min']
+    elif pars['MIN_TYPE'] == 'GREYLEVEL':
+        # Put the sky at MIN_LEVEL grey level after the gamma correction
+        m = pars['MIN_LEVEL']**pars['GAMMA']
+        vmin = (sky - m*vmax)/(1.0 - m)
+    else:
+        vmin = pars['MIN_LEVEL']
+
+    if vmax <= vmin:
+        vmax = vmin + 1.0
+    return sky, vmin, vmax
+
+
+def make_color_image(images,stretch='power',asinh_q=8.0,pars=None,**stiff_parameters):
+
+    """
+    Combine three images, in (R, G, B) order, into an 8-bit (ny, nx, 3)
+    color image, flipped so that north is up. The stretch is either the
+    stiff POWER-LAW gamma correction or 'asinh' with softening asinh_q.
+    pars are the color parameters, from get_color_parameters() if None
+    """
+    if pars is None:
+        pars = get_color_parameters(stiff_parameters)
+    # Work on contiguous planes, much faster than on the channels of a (ny, nx, 3) array
+    rgb = []
+    for k in range(3):
+        sky, vmin, vmax = get_levels(images[k],pars)
+        rgb.append(((numpy.nan_to_num(images[k]) - vmin)/(vmax - vmin)).astype('f4',copy=False))
+
+    # Luminance and colour saturation
+    lum = (rgb[0] + rgb[1] + rgb[2])/3
+    lum = numpy.where(lum > 0, lum, 0)
+    if stretch == 'asinh':
+        flum = numpy.arcsinh(asinh_q*lum)/numpy.arcsinh(asinh_q)
+    elif pars['GAMMA_FAC'] != 1.0:
+        flum = lum**pars['GAMMA_FAC']
+    else:
+        # flum/lum is exactly 1
+        flum = None
+    if flum is None:
+        ratio = (lum > 0).astype('f4')
+    else:
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            ratio = numpy.where(lum > 0, flum/lum, 0)
+    for k in range(3):
+        rgb[k] = (lum + pars['COLOUR_SAT']*(rgb[k] - lum))*ratio
+
+    if stretch == 'asinh':
+        # Keep the colors of saturated pixels
+        norm = numpy.maximum(numpy.maximum(numpy.maximum(rgb[0],rgb[1]),rgb[2]),1.0)
+        rgb = [plane/norm for plane in rgb]
+    color = numpy.empty(images[0].shape+(3,),dtype='u1')
+    for k in range(3):
+        plane = numpy.clip(rgb[k],0,1)
+        if stretch != 'asinh':
+            plane **= 1.0/pars['GAMMA']
+        if pars['NEGATIVE'].upper().startswith('Y'):
+            plane = 1 - plane
+        color[:,:,k] = 255*plane + 0.5
+    return numpy.flipud(color)
+
+
+def write_png(rgb,filename):
+    """ Write an 8-bit (ny, nx, 3) image as PNG, with zlib only """
+    ny, nx = rgb.shape[0:2]
+    raw = numpy.zeros((ny,1+3*nx),dtype='u1')
+    raw[:,1:] = rgb.reshape(ny,3*nx)
+
+    def chunk(tag,data):
+        return struct.pack('>I',len(data)) + tag + data + struct.pack('>I',zlib.crc32(tag+data) & 0xffffffff)
+
+    with open(filename,'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n')
+        png.write(chunk(b'IHDR',struct.pack('>IIBBBBB',nx,ny,8,2,0,0,0)))
+        compressor = zlib.compressobj(6,zlib.DEFLATED,15,8,PNG_ZLIB_STRATEGY)
+        png.write(chunk(b'IDAT',compressor.compress(raw.tobytes())+compressor.flush()))
+        png.write(chunk(b'IEND',b''))
+
+
+def write_color_image(rgb,filename,quality=90,compression='JPEG'):
+
+    """
+    Write an 8-bit color image as TIFF, PNG or JPEG depending on the
+    extension of filename, with the stiff COMPRESSION_TYPE for TIFF
+    """
+    ext = os.path.splitext(filename)[-1][1:].lower()
+    if ext not in IMAGE_FORMATS:
+        raise ValueError("ERROR: Cannot write color image format: %s" % ext)
+    # PNG is always written with zlib, faster than Pillow
+    if ext == 'png':
+        return write_png(rgb,filename)
+    if Image is None:
+        raise ImportError("ERROR: Need Pillow to write %s color images" % IMAGE_FORMATS[ext])
+
+    kw = {}
+    if IMAGE_FORMATS[ext] == 'TIFF' and TIFF_COMPRESSION.get(compression):
+        kw['compression'] = TIFF_COMPRESSION[compression]
+    if IMAGE_FORMATS[ext] in ('TIFF','JPEG'):
+        kw['quality'] = quality
+    Image.fromarray(rgb,'RGB').save(filename,IMAGE_FORMATS[ext],**kw)
+
+
+def read_thumb_sci(ra,dec,BAND,prefix='DES',outdir=os.getcwd()):
+    """ Read the SCI of a FITS thumbnail, None if not found """
+    fitsthumb = thumbslib.get_thumbFitsName(ra,dec,BAND,prefix=prefix,ext='fits',outdir=outdir)
+    if not os.path.exists(fitsthumb):
+        SOUT.write("# WARNING: Cannot find %s for color image\n" % fitsthumb)
+        return None
+    return thumbslib.unscale_section(*fitsio.read(fitsthumb,ext='SCI',header=True))
+
+
+def color_radec_numpy(ra,dec,avail_bands,prefix='DES',colorset=['i','r','g'],stiff_parameters={},
+                      outdir=os.getcwd(),ext='tif',stretch='power',images=None,verb=False):
+
+    """
+    Make the color image for ra,dec from the FITS thumbnails of the
+    bands in colorset, same as thumbslib.color_radec() but in-process.
+    If given, images is a dictionary of the SCI sections by band to use
+    instead of the FITS thumbnails, which are read for the bands not in it
+    """
+    t0 = time.time()
+
+    # Get colorset or match with available bands
+    CSET = thumbslib.get_colorset(avail_bands,colorset)
+    if CSET is False:
+        SOUT.write("# WARNING: Could not find a suitable filter set for color image for ra,dec: %s,%s\n" % (ra,dec))
+        return
+
+    # The SCI of the thumbnails, in R, G, B order
+    if images is None:
+        images = {}
+    images = [images[BAND] if BAND in images else read_thumb_sci(ra,dec,BAND,prefix,outdir) for BAND in CSET]
+    if any([image is None for image in images]):
+        return
+    if len(set([image.shape for image in images])) > 1:
+        SOUT.write("# WARNING: Thumbnails for ra,dec: %s,%s have different shapes, no color image\n" % (ra,dec))
+        return
+
+    pars = get_color_parameters(stiff_parameters)
+    colorname = thumbslib.get_thumbColorName(ra,dec,prefix=prefix,ext=ext,outdir=outdir)
+
+    # Serve the color image from the cutout cache, keyed on the sections and the settings
+    cache = cutoutcache.CUTOUT_CACHE
+    if cache is not None:
+        key = cache.key('color',[cutoutcache.digest_array(image) for image in images],
+                        sorted(pars.items()),stretch,ext)
+        if cache.get(key,colorname):
+            if verb: SOUT.write("# Served %s from the cutout cache\n" % colorname)
+            return
+
+    rgb = make_color_image(images,stretch=stretch,pars=pars)
+    # Write under a temporary name and move it into place once complete
+    tmpname = cutoutcache.get_tmpname(colorname)
+    write_color_image(rgb,tmpname,quality=pars['COMPRESSION_QUALITY'],compression=pars['COMPRESSION_TYPE'])
+    os.rename(tmpname,colorname)
+    metrics.METRICS.since('color',t0,os.path.getsize(colorname))
+    if cache is not None:
+        cache.put(key,colorname)
+    if verb: SOUT.write("# Wrote %s in %s\n" % (colorname,thumbslib.elapsed_time(t0)))
+    return
@@ -0,0 +1,164 @@
+"""
+Content-addressed cache of cutouts and color images, shared across runs
+and users. Each output is stored once under the SHA1 of its key (tag,
+input file, pixel window, extensions and output options for cutouts,
+the input sections and parameters for color images) in an on-disk
+store, with a SQLite index used to serve hits and to evict the least
+recently used entries over a size budget. Hits are served by hard link,
+or by copy across filesystems, and all writes are atomic renames.
+"""
+
+import os
+import time
+import errno
+import shutil
+import sqlite3
+import hashlib
+
+CACHE_INDEX = 'index.db'
+
+CACHE_TABLES = """
+create table if not exists CUTOUTS (KEY text primary key, PATH text, BYTES integer, ATIME real);
+create index if not exists CUTOUTS_ATIME on CUTOUTS (ATIME);
+"""
+
+# The cache used by fitscutter/color_radec, None when disabled
+CUTOUT_CACHE = None
+
+
+def link_or_copy(src,dst):
+    """ Hard link src to dst, or copy it across filesystems, replacing dst atomically """
+    if os.path.exists(dst) and os.path.samefile(src,dst):
+        return
+    tmpname = "%s.tmp%s" % (dst,os.getpid())
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    try:
+        os.link(src,tmpname)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK):
+            raise
+        shutil.copyfile(src,tmpname)
+    os.rename(tmpname,dst)
+
+
+def get_tmpname(filename):
+    """ A temporary name for filename in the same directory, and with the same extension """
+    base, ext = os.path.splitext(filename)
+    return "%s.tmp%s%s" % (base,os.getpid(),ext)
+
+
+def get_file_id(filename):
+    """ Identify an input file by its path, size and mtime """
+    st = os.stat(filename)
+    return (os.path.abspath(filename),st.st_size,int(st.st_mtime))
+
+
+def digest_file(filename):
+    with open(filename,'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def digest_array(image):
+    return (image.shape,image.dtype.str,hashlib.sha1(image.tobytes()).hexdigest())
+
+
+class CutoutCache(object):
+
+    """
+    On-disk store of outputs in dirname, keyed by the SHA1 of the key
+    parts and namespaced by tag, holding at most maxbytes. The SQLite
+    connection belongs to one process and is reopened after a fork.
+    """
+
+    def __init__(self,dirname,maxbytes=10*1024**3,tag=''):
+        self.dirname = dirname
+        self.maxbytes = maxbytes
+        self.tag = tag
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+        self.con = None
+        if not os.path.exists(os.path.join(dirname,'objects')):
+            os.makedirs(os.path.join(dirname,'objects'))
+
+    def connect(self):
+        if self.pid != os.getpid():
+            self.con = sqlite3.connect(os.path.join(self.dirname,CACHE_INDEX),timeout=60)
+            self.con.executescript(CACHE_TABLES)
+            self.pid = os.getpid()
+        return self.con
+
+    def key(self,*parts):
+        """ The key of an output from its parts, within the tag """
+        return hashlib.sha1(repr((self.tag,)+parts).encode()).hexdigest()
+
+    def get(self,key,outname):
+        """ Serve the output for key to outname, returns False on a miss """
+        con = self.connect()
+        row = con.execute("select PATH from CUTOUTS where KEY=?",(key,)).fetchone()
+        if row is not None:
+            try:
+                link_or_copy(os.path.join(self.dirname,row[0]),outname)
+            except (IOError,OSError):
+                # Evicted by another process in the meantime
+                row = None
+        if row is None:
+            self.misses += 1
+            return False
+        with con:
+            con.execute("update CUTOUTS set ATIME=? where KEY=?",(time.time(),key))
+        self.hits += 1
+        return True
+
+    def put(self,key,filename):
+        """ Add the output in filename under key, and evict over maxbytes """
+        if not os.path.exists(filename):
+            return
+        ext = os.path.splitext(filename)[-1]
+        path = os.path.join('objects',key[0:2],key+ext)
+        fullpath = os.path.join(self.dirname,path)
+        if not os.path.exists(os.path.dirname(fullpath)):
+            try:
+                os.makedirs(os.path.dirname(fullpath))
+            except OSError:
+                pass
+        link_or_copy(filename,fullpath)
+        con = self.connect()
+        with con:
+            con.execute("insert or replace into CUTOUTS values (?,?,?,?)",
+                        (key,path,os.path.getsize(fullpath),time.time()))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used outputs while over maxbytes """
+        con = self.connect()
+        nbytes = con.execute("select coalesce(sum(BYTES),0) from CUTOUTS").fetchone()[0]
+        if nbytes <= self.maxbytes:
+            return
+        removed = []
+        with con:
+            for key, path, size in con.execute("select KEY, PATH, BYTES from CUTOUTS order by ATIME").fetchall():
+                if nbytes <= self.maxbytes:
+                    break
+                con.execute("delete from CUTOUTS where KEY=?",(key,))
+                removed.append(path)
+                nbytes -= size
+        for path in removed:
+            try:
+                os.remove(os.path.join(self.dirname,path))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def set_cutout_cache(dirname,maxbytes=10*1024**3,tag=''):
+    """ Set the cutout cache used by fitscutter and the color engines, None disables it """
+    global CUTOUT_CACHE
+    if dirname is None:
+        CUTOUT_CACHE = None
+    else:
+        CUTOUT_CACHE = CutoutCache(dirname,maxbytes=maxbytes,tag=tag)
+    return CUTOUT_CACHE
@@ -0,0 +1,88 @@
+"""
+Oracle session pool shared by the worker threads doing DB lookups, so
+that lookups for the next tiles can overlap with the cutting of the
+current ones without opening ad-hoc connections. Sessions are handed
+out with statement caching enabled, so repeated statements (the
+chunked IN-list queries in tilefinder) are only parsed once per session.
+"""
+
+import sys
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import oracledb
+except ImportError:
+    oracledb = None
+try:
+    import cx_Oracle
+except ImportError:
+    cx_Oracle = None
+
+from . import profiling
+
+SOUT = sys.stdout
+
+
+class OraclePool(object):
+
+    """
+    Pool of nworkers Oracle sessions plus nworkers threads to run
+    lookups on them. Uses oracledb if present, otherwise cx_Oracle.
+    Pools cannot be shared across processes, each process needs its own.
+    """
+
+    def __init__(self,user,password,dsn,nworkers=4,stmtcachesize=50):
+
+        self.nworkers = nworkers
+        if oracledb is not None:
+            self.pool = oracledb.create_pool(user=user,password=password,dsn=dsn,
+                                             min=1,max=nworkers,increment=1,
+                                             stmtcachesize=stmtcachesize,
+                                             getmode=oracledb.POOL_GETMODE_WAIT)
+        elif cx_Oracle is not None:
+            self.pool = cx_Oracle.SessionPool(user,password,dsn,min=1,max=nworkers,increment=1,
+                                              threaded=True,getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+        else:
+            raise ImportError("ERROR: Need oracledb or cx_Oracle to create a session pool")
+        self.stmtcachesize = stmtcachesize
+        self.threads = ThreadPool(nworkers)
+
+    def acquire(self):
+        dbh = self.pool.acquire()
+        # cx_Oracle sets the statement cache per session
+        if oracledb is None:
+            dbh.stmtcachesize = self.stmtcachesize
+        return dbh
+
+    def release(self,dbh):
+        self.pool.release(dbh)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Hand out a pooled session for the duration of a with block """
+        dbh = self.acquire()
+        try:
+            yield dbh
+        finally:
+            self.release(dbh)
+
+    def call(self,func,*args,**kwargs):
+        """ Call func(*args, dbh=<pooled session>, **kwargs), under the profile of the thread when profiling """
+        with self.connection() as dbh:
+            kwargs['dbh'] = dbh
+            return profiling.profile_call(func,*args,**kwargs)
+
+    def apply_async(self,func,args=(),kwargs={}):
+        """ Run func in one of the worker threads with its own pooled session """
+        return self.threads.apply_async(self.call,(func,)+tuple(args),kwargs)
+
+    def map(self,func,items,**kwargs):
+        """ Run func(item, dbh=<pooled session>, **kwargs) for all items concurrently """
+        results = [self.apply_async(func,(item,),kwargs) for item in items]
+        return [r.get() for r in results]
+
+    def close(self):
+        self.threads.close()
+        self.threads.join()
+        self.pool.close()
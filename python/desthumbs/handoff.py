@@ -0,0 +1,138 @@
+"""
+Hand off the SCI sections cut by fitscutter to the color stage without
+writing the FITS thumbnails and reading them back. Within a process the
+arrays are passed as they are. From a worker process they are copied
+once into a multiprocessing.shared_memory block (Python 3.8+), so that
+only a small descriptor goes through the pool and the color tasks map
+the same memory, otherwise they are pickled with the task result. Each
+color task only gets the sections of its own objects.
+"""
+
+import sys
+import numpy
+import multiprocessing as mp
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+from . import thumbslib
+
+SOUT = sys.stdout
+
+
+def init_sharing():
+    """
+    Start the shared memory tracker before the workers are forked, so
+    that they all share it with the process that unlinks the blocks
+    """
+    if shared_memory is not None:
+        resource_tracker.ensure_running()
+
+
+def can_share(nprocs,output):
+    """
+    Whether to hand off the SCI sections: always within a process, and
+    from workers only through shared memory, unless there are no FITS
+    thumbnails for the color tasks to read instead
+    """
+    return nprocs == 1 or shared_memory is not None or output != 'fits'
+
+
+def cut_and_share(filename,ra,dec,**kwargs):
+    """ Run fitscutter and hand off the SCI sections it cuts -- one cutting task """
+    stamps = thumbslib.fitscutter(filename,ra,dec,return_sci=True,**kwargs)
+    if shared_memory is None or mp.current_process().name == 'MainProcess':
+        return stamps
+    return share_stamps(stamps)
+
+
+def share_stamps(stamps):
+
+    """
+    Move the sci arrays of the stamps returned by fitscutter into a
+    shared memory block, replaced by its name, dtype, shapes and offsets
+    """
+    sci = stamps.pop('sci')
+    dtype = numpy.dtype(sci[0].dtype if sci else 'f4')
+    sizes = [image.size for image in sci]
+    offsets = numpy.concatenate([[0],numpy.cumsum(sizes)]).astype(int).tolist()
+    shm = shared_memory.SharedMemory(create=True,size=max(1,offsets[-1]*dtype.itemsize))
+    buf = numpy.ndarray((offsets[-1],),dtype=dtype,buffer=shm.buf)
+    for k,image in enumerate(sci):
+        buf[offsets[k]:offsets[k+1]] = image.ravel()
+    del buf
+    stamps.update({'shm': shm.name, 'dtype': dtype.str,
+                   'shapes': [image.shape for image in sci], 'offsets': offsets[:-1]})
+    shm.close()
+    return stamps
+
+
+def select_stamps(stamps_list,names):
+
+    """
+    The stamps of the objects in names only, with just what the color
+    tasks need: the band, names and sci arrays or their place in the
+    shared memory block
+    """
+    names = set(names)
+    selected = []
+    for stamps in stamps_list:
+        keep = [k for k,name in enumerate(stamps['names']) if name in names]
+        sub = {'band': stamps['band'], 'names': [stamps['names'][k] for k in keep]}
+        if 'shm' in stamps:
+            sub.update({'shm': stamps['shm'], 'dtype': stamps['dtype'],
+                        'shapes': [stamps['shapes'][k] for k in keep],
+                        'offsets': [stamps['offsets'][k] for k in keep]})
+        else:
+            sub['sci'] = [stamps['sci'][k] for k in keep]
+        selected.append(sub)
+    return selected
+
+
+class SharedStamps(object):
+
+    """
+    The SCI sections handed off by the cutting tasks of a tile, as a
+    dictionary of {band: image} by thumbnail name. Views into shared
+    memory are only valid until close()
+    """
+
+    def __init__(self,stamps_list):
+        self.images = {}
+        self.blocks = []
+        for stamps in stamps_list:
+            if 'shm' in stamps:
+                shm = shared_memory.SharedMemory(name=stamps['shm'])
+                self.blocks.append(shm)
+                dtype = numpy.dtype(stamps['dtype'])
+                buf = numpy.ndarray((shm.size//dtype.itemsize,),dtype=dtype,buffer=shm.buf)
+                sci = [buf[start:start+int(numpy.prod(shape))].reshape(shape)
+                       for start,shape in zip(stamps['offsets'],stamps['shapes'])]
+            else:
+                sci = stamps['sci']
+            for name,image in zip(stamps['names'],sci):
+                self.images.setdefault(name,{})[stamps['band']] = image
+
+    def get(self,name):
+        return self.images.get(name)
+
+    def close(self):
+        self.images = {}
+        for shm in self.blocks:
+            shm.close()
+        self.blocks = []
+
+
+def release_stamps(stamps):
+    """ Free the shared memory of the stamps, once all of the color tasks are done """
+    if 'shm' not in stamps:
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=stamps['shm'])
+    except OSError:
+        return
+    shm.close()
+    shm.unlink()
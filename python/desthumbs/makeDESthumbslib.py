@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 import os,sys
-import pandas
 import numpy
 import time
+import itertools
 import multiprocessing as mp
 
 import desthumbs 
@@ -21,7 +21,7 @@ def cmdline():
      parser = argparse.ArgumentParser(description="Retrieves FITS images within DES given the file and other parameters")
      
      # The positional arguments
-     parser.add_argument("inputList", help="Input CSV file with positions (RA,DEC) and optional (XSIZE,YSIZE) in arcmins")
+     parser.add_argument("inputList", help="Input CSV or Parquet file with positions (RA,DEC) and optional (XSIZE,YSIZE) in arcmins")
      
      # The optional arguments for image retrieval
      parser.add_argument("--xsize", type=float, action="store", default=None,
@@ -38,8 +38,52 @@ def cmdline():
                          help="Prefix for thumbnail filenames [default='DES']")
      parser.add_argument("--colorset", type=str, action='store', nargs = '+', default=['i','r','g'],
                          help="Color Set to use for creation of color image [default=i r g]")
+     parser.add_argument("--color_engine", type=str, action='store', default='numpy', choices=['numpy','stiff'],
+                         help="Make the color images in-process with numpy, or by running stiff [default=numpy]")
+     parser.add_argument("--color_format", type=str, action='store', default='tif', choices=['tif','png','jpg'],
+                         help="Format of the color images made with --color_engine numpy, tif and jpg need Pillow [default=tif]")
+     parser.add_argument("--color_stretch", type=str, action='store', default='power', choices=['power','asinh'],
+                         help="Stretch of the color images made with --color_engine numpy: the stiff power-law or asinh [default=power]")
+     parser.add_argument("--stiff_jobs", type=int, action='store', default=None,
+                         help="Number of stiff processes run at the same time by each color task with --color_engine stiff [default=cores/nprocs]")
+     parser.add_argument("--stiff_threads", type=int, action='store', default=1,
+                         help="NTHREADS for each stiff process [default=1]")
+     parser.add_argument("--stiff_mem_max", type=int, action='store', default=None,
+                         help="MEM_MAX in MB for each stiff process [default=from etc/default.stiff]")
      parser.add_argument("--MP", action='store_true', default=False,
-                         help="Run in multiple core [default=False]")
+                         help="Run in multiple core, same as --nprocs <number of cores> [default=False]")
+     parser.add_argument("--nprocs", type=int, action='store', default=None,
+                         help="Number of worker processes to run the cutting and color tasks of all tiles [default=1]")
+     parser.add_argument("--color_chunk", type=int, action='store', default=50,
+                         help="Number of objects per color task [default=50]")
+     parser.add_argument("--fits_cache_files", type=int, action='store', default=8,
+                         help="Number of input FITS files kept open per process, ~0.2MB each [default=8]")
+     parser.add_argument("--cutout_cache", type=str, action='store', default=None,
+                         help="Directory of a cutout cache shared across runs, to serve the cutouts and color images already made by hard link or copy [default=no cache]")
+     parser.add_argument("--cutout_cache_gb", type=float, action='store', default=10,
+                         help="Size in GB of the cutout cache, the least recently used outputs are evicted over it [default=10]")
+     parser.add_argument("--output", type=str, action='store', default='fits', choices=['fits','mef','hdf5','none'],
+                         help="Write each cutout to its own FITS file, or all cutouts of a tile/band into a single multi-extension FITS or HDF5 file with an INDEX table, or 'none' to only make the color images with --color_engine numpy; color images with stiff need 'fits' [default=fits]")
+     parser.add_argument("--compress", type=str, action='store', nargs='+', default=[],
+                         help="Tile-compress the output extensions, as EXTNAME=RICE|GZIP|GZIP_2|PLIO|HCOMPRESS, e.g.: SCI=GZIP WGT=RICE")
+     parser.add_argument("--qlevel", type=str, action='store', nargs='+', default=[],
+                         help="Quantization level for the compressed floating point extensions, as EXTNAME=Q, or EXTNAME=none for lossless GZIP, e.g.: SCI=none WGT=4 [default=4]")
+     parser.add_argument("--dtype", type=str, action='store', nargs='+', default=[],
+                         help="Cast the output extensions, as EXTNAME=float32|int16, int16 is scaled with BSCALE/BZERO for floating point data, e.g.: WGT=int16")
+     parser.add_argument("--read_block_mb", type=float, action='store', default=32,
+                         help="Memory cap in MB for the blocks read to cut nearby cutouts from a single section read, 0 reads each cutout on its own [default=32]")
+     parser.add_argument("--chunksize", type=int, action='store', default=None,
+                         help="Read the input list in chunks of this many rows, spilling them to per-tile partitions in outdir, to keep the memory flat for very large lists [default=read all at once]")
+     parser.add_argument("--metrics", type=str, action='store', default=None,
+                         help="JSON lines file for the per-stage timing metrics of each tile and of the run [default=outdir/desthumbs_metrics.jsonl]")
+     parser.add_argument("--profile", action='store_true', default=False,
+                         help="Profile the run and each worker process with cProfile into outdir/profile, and merge the profiles into one report at the end [default=False]")
+     parser.add_argument("--profile_memory", action='store_true', default=False,
+                         help="With --profile, also record the memory high-water mark of each cutting and color task [default=False]")
+     parser.add_argument("--trace", action='store_true', default=False,
+                         help="Trace the stages of the run on the timeline of each process, tagged with tile and band, into outdir/desthumbs_trace.json in the Chrome trace format, to load in chrome://tracing or ui.perfetto.dev [default=False]")
+     parser.add_argument("--resume", action='store_true', default=False,
+                         help="Only make the cutouts and color images not yet recorded in the manifest of outdir [default=False]")
      parser.add_argument("--verb", action='store_true', default=False,
                          help="Turn on verbose mode [default=False]")
      parser.add_argument("--outdir", type=str, action='store', default=os.getcwd(),
@@ -50,6 +94,16 @@ def cmdline():
      parser.add_argument("--password", type=str, action='store', help="password")
      parser.add_argument("--logfile", type=str, action='store', default=None,
                          help="Output logfile")
+     parser.add_argument("--tilematch", type=str, action='store', default='local', choices=['local','db','byobject'],
+                         help="How to match positions to tiles: 'local' loads the tile geometry once and matches in memory, 'db' uploads all positions and matches them in a single DB query, 'byobject' runs one query per position [default=local]")
+     parser.add_argument("--tilegeom", type=str, action='store', default=None,
+                         help="Snapshot file (.npy) of the tile geometry to read, or to write if it does not exist yet")
+     parser.add_argument("--db_workers", type=int, action='store', default=1,
+                         help="Number of pooled DB sessions/threads for lookups; with more than 1 the file lookups for the next tiles run while cutting [default=1]")
+     parser.add_argument("--offline_catalog", type=str, action='store', default=None,
+                         help="SQLite snapshot written by makeDESthumbsCatalog to resolve tiles and files without a DB connection. "
+                              "It has no objects table: for COADD_OBJECTS_ID input, add the --coaddtable table "
+                              "(ID, TILENAME, ALPHAWIN_J2000, DELTAWIN_J2000) to it by hand [default=None]")
 
      args = parser.parse_args()
 
@@ -65,6 +119,33 @@ def cmdline():
          sout.write("# \t--%-10s\t%s\n" % (key,vars(args)[key]))
      return args
 
+def cmdline_catalog():
+     import argparse
+     parser = argparse.ArgumentParser(description="Exports the file-path catalog, tile geometry and archive root of a TAG into a SQLite snapshot for makeDESthumbs --offline_catalog")
+
+     # The positional arguments
+     parser.add_argument("catalog", help="Output SQLite snapshot filename")
+
+     # The optional arguments
+     parser.add_argument("--tag", type=str, action="store", default = 'Y1A1_COADD',
+                         help="Tag used for retrieving files [default=Y1A1_COADD]")
+     parser.add_argument("--verb", action='store_true', default=False,
+                         help="Turn on verbose mode [default=False]")
+     parser.add_argument("--db_section", type=str, action='store',default='db-desoper',
+                         help="Database section to connect to")
+     parser.add_argument("--user", type=str, action='store',help="Username")
+     parser.add_argument("--password", type=str, action='store', help="password")
+     parser.add_argument("--logfile", type=str, action='store', default=None,
+                         help="Output logfile")
+     args = parser.parse_args()
+
+     if args.logfile:
+          sout = open(args.logfile,'w')
+     else:
+          sout = sys.stdout
+     args.sout = sout
+     return args
+
 def check_xysize(df,args,nobj):
 
     # Check if  xsize,ysize are set from command-line or read from csv file
@@ -99,15 +180,206 @@ def get_base_names(tilenames, ra, dec, prefix='DES'):
         names.append(name)
     return names
 
+def partition_input(args,backend,chunks,searchbyID,matched_list):
+
+    """
+    Find the tilenames of the input list one chunk at a time, spilling
+    the matched rows to per-tile partitions in outdir and writing the
+    unmatched ones to the matched list
+    """
+    partitions = desthumbs.TilePartitions(os.path.join(args.outdir,'partitions'))
+    nobj = 0
+    for df in chunks:
+        if searchbyID:
+            tilenames,ra,dec,indices,tilenames_matched = backend.find_tilenames_id(df.COADD_OBJECTS_ID.values,args.coaddtable,verb=args.verb)
+            df['RA'] = ra
+            df['DEC'] = dec
+        else:
+            ra = df.RA.values
+            dec = df.DEC.values
+            tilenames,indices,tilenames_matched = backend.find_tilenames_radec(ra,dec,method=args.tilematch,verb=args.verb)
+        df['TILENAME'] = tilenames_matched
+        df['THUMBNAME'] = get_base_names(tilenames_matched, ra, dec, prefix=args.prefix)
+        matched = numpy.array([bool(tilename) for tilename in tilenames_matched],dtype=bool)
+        desthumbs.append_csv(df[~matched],matched_list,first=(nobj == 0))
+        partitions.add(df[matched])
+        nobj = nobj + len(df)
+        if args.verb: args.sout.write("# Partitioned %s positions into %s tiles\n" % (nobj,len(partitions.tilenames)))
+    return partitions
+
+def get_cut_outputs(args,tilename,BAND,ra,dec):
+    """ The (THUMBNAME, BAND, PATH) outputs of a cutting task for the manifest """
+    if args.output == 'none':
+        return []
+    names = [desthumbs.get_thumbBaseName(ra[k],dec[k],prefix=args.prefix) for k in range(len(ra))]
+    if args.output == 'fits':
+        paths = [desthumbs.get_thumbFitsName(ra[k],dec[k],BAND,prefix=args.prefix,outdir=args.outdir) for k in range(len(ra))]
+    else:
+        ext = desthumbs.CUTOUT_CONTAINERS[args.output].ext
+        paths = [desthumbs.get_thumbContainerName(tilename,BAND,prefix=args.prefix,ext=ext,outdir=args.outdir)]*len(ra)
+    return [(name,BAND,path) for name,path in zip(names,paths)]
+
+def get_color_outputs(args,ra,dec):
+    """ The (THUMBNAME, 'color', PATH) outputs of a color task for the manifest """
+    if args.color_engine == 'numpy':
+        ext = args.color_format
+    else:
+        ext = 'tif'
+    outputs = []
+    for k in range(len(ra)):
+        name = desthumbs.get_thumbBaseName(ra[k],dec[k],prefix=args.prefix)
+        path = desthumbs.get_thumbColorName(ra[k],dec[k],prefix=args.prefix,ext=ext,outdir=args.outdir)
+        outputs.append((name,desthumbs.COLOR_BAND,path))
+    return outputs
+
+def get_db_server(db_section):
+
+    """ Get the host, port and service name for a db_section """
+    if db_section == 'desoper' or db_section == 'db-desoper':
+      host = 'desdb.ncsa.illinois.edu'
+      port = '1521'
+      name = 'desoper'
+    elif db_section == 'oldsci' or db_section == 'db-oldsci':
+      host = 'desdb-dr.ncsa.illinois.edu'
+      port = '1521'
+      name = 'desdr'
+    else:
+      raise Exception("ERROR: No DB server defined for section: %s" % db_section)
+    return host, port, name
+
+def get_dbh(args):
+
+    """ Get the DB handle from desdbi, or connect directly with cx_Oracle """
+    try:
+      dbh = desdbi.DesDbi(section=args.db_section)
+    except:
+      host, port, name = get_db_server(args.db_section)
+      kwargs = {'host': host, 'port': port, 'service_name': name}
+      dsn = cx_Oracle.makedsn(**kwargs)
+      dbh = cx_Oracle.connect(args.user, args.password, dsn=dsn)
+    return dbh
+
+def get_db_credentials(args):
+
+    """
+    Get the user, password and dsn to create a session pool, from the
+    command-line or from the DES services file used by desdbi
+    """
+    if args.user and args.password:
+      host, port, name = get_db_server(args.db_section)
+      return args.user, args.password, "%s:%s/%s" % (host, port, name)
+
+    try:
+      import configparser
+    except ImportError:
+      import ConfigParser as configparser
+    services = os.environ.get('DES_SERVICES',os.path.join(os.environ['HOME'],'.desservices.ini'))
+    config = configparser.ConfigParser()
+    config.read(services)
+    section = dict(config.items(args.db_section))
+    dsn = "%s:%s/%s" % (section['server'], section['port'], section['name'])
+    return section['user'], section['passwd'], dsn
+
+def get_schema(tag):
+
+    """ Define the schema for a given tag """
+    if tag[0:4] == 'SVA1' or tag[0:4] == 'Y1A1':
+        schema = 'des_admin'
+    elif tag[0:3] == 'DR1':
+        schema = 'dr1'
+    elif tag[0:3] == 'DR2':
+        schema = 'dr2'
+    else:
+        schema = 'prod'
+    return schema
+
+def get_ext_options(args):
+
+    """
+    Collect the --compress, --qlevel and --dtype EXTNAME=VALUE options
+    into a dictionary of write options per EXTNAME
+    """
+    ext_options = {}
+    for option in ['compress','qlevel','dtype']:
+        for item in getattr(args,option):
+            if '=' not in item:
+                sys.exit("ERROR: --%s needs EXTNAME=VALUE, got: %s" % (option,item))
+            EXTNAME, value = item.split('=',1)
+            if option == 'qlevel':
+                value = None if value.lower() == 'none' else float(value)
+            elif option == 'dtype' and value not in ['float32','int16']:
+                sys.exit("ERROR: --dtype must be float32 or int16, got: %s" % value)
+            ext_options.setdefault(EXTNAME.upper(),{})[option] = value
+    for EXTNAME in sorted(ext_options):
+        if 'qlevel' in ext_options[EXTNAME] and not ext_options[EXTNAME].get('compress'):
+            sys.exit("ERROR: --qlevel %s needs --compress %s=..." % (EXTNAME,EXTNAME))
+    return ext_options
+
+def get_backend(args):
+
+    """
+    Get the metadata backend: the local SQLite snapshot if
+    --offline_catalog is given, otherwise the Oracle DB
+    """
+    if args.offline_catalog:
+        backend = desthumbs.SQLiteBackend(args.offline_catalog)
+        args.sout.write("# Using offline catalog: %s for TAG:%s\n" % (args.offline_catalog,backend.tag))
+    elif args.db_workers > 1:
+        user, password, dsn = get_db_credentials(args)
+        pool = desthumbs.OraclePool(user,password,dsn,nworkers=args.db_workers)
+        backend = desthumbs.OracleBackend(None,schema=get_schema(args.tag),tilegeom_snapshot=args.tilegeom,pool=pool)
+    else:
+        backend = desthumbs.OracleBackend(get_dbh(args),schema=get_schema(args.tag),tilegeom_snapshot=args.tilegeom)
+    return backend
+
+def run_catalog(args):
+
+    """ Export a catalog snapshot for --offline_catalog runs """
+    desthumbs.tilefinder.SOUT = args.sout
+    desthumbs.catalog.SOUT = args.sout
+    dbh = get_dbh(args)
+    schema = get_schema(args.tag)
+    desthumbs.export_catalog(args.catalog,dbh,args.tag,schema=schema,verb=args.verb)
+    return
+
 def run(args):
 
     # The write log handle
     sout = args.sout
     desthumbs.tilefinder.SOUT = args.sout
     desthumbs.thumbslib.SOUT = args.sout
+    desthumbs.catalog.SOUT = args.sout
+    desthumbs.backends.SOUT = args.sout
+    desthumbs.scheduler.SOUT = args.sout
+    desthumbs.colorlib.SOUT = args.sout
+    desthumbs.handoff.SOUT = args.sout
+    desthumbs.manifest.SOUT = args.sout
+    desthumbs.metrics.SOUT = args.sout
+    desthumbs.profiling.SOUT = args.sout
+    desthumbs.tracing.SOUT = args.sout
+    desthumbs.METRICS.swap({})
+    t_run = time.time()
+
+    # Profile this process from here on, and the workers once they start
+    if args.profile:
+         profile_dir = os.path.join(args.outdir,'profile')
+         desthumbs.set_profiling(profile_dir,memory=args.profile_memory)
+         desthumbs.get_profiler().start()
+    else:
+         desthumbs.set_profiling(None)
+
+    # Trace the stages of this process and of the workers on a common timeline
+    if args.trace:
+         desthumbs.set_tracing(os.path.join(args.outdir,'trace'))
+    else:
+         desthumbs.set_tracing(None)
      
-    # Read in CSV file with pandas
-    df = pandas.read_csv(args.inputList)
+    # Read in CSV file with pandas, or only its first chunk when streaming
+    if args.chunksize:
+         chunks = desthumbs.read_input_chunks(args.inputList,args.chunksize)
+         df = next(chunks)
+    else:
+         df = desthumbs.read_input(args.inputList)
     
     # Decide if we do search by RA,DEC or by COADD_ID
     if 'COADD_OBJECTS_ID' in df.columns:
@@ -130,74 +402,134 @@ def run(args):
     # Check the xsize and ysizes
     xsize,ysize = check_xysize(df,args,nobj)
     
-    # Get DB handle
-    try:
-      dbh = desdbi.DesDbi(section=args.db_section)
-    except:
-      if args.db_section == 'desoper' or args.db_section == 'db-desoper':
-        host = 'desdb.ncsa.illinois.edu'
-        port = '1521'
-        name = 'desoper'
-      elif args.db_section == 'oldsci' or args.db_section == 'db-oldsci':
-        host = 'desdb-dr.ncsa.illinois.edu'
-        port = '1521'
-        name = 'desdr'
-
-      kwargs = {'host': host, 'port': port, 'service_name': name}
-      dsn = cx_Oracle.makedsn(**kwargs)
-      dbh = cx_Oracle.connect(args.user, args.password, dsn=dsn)
+    # Make sure that outdir exists
+    if not os.path.exists(args.outdir):
+         if args.verb: sout.write("# Creating: %s\n" % args.outdir)
+         os.makedirs(args.outdir)
 
-    # Define the schema
-    if args.tag[0:4] == 'SVA1' or args.tag[0:4] == 'Y1A1':
-        schema = 'des_admin'
-    elif args.tag[0:3] == 'DR1':
-        schema = 'dr1'
-    elif args.tag[0:3] == 'DR2':
-        schema = 'dr2'
+    # The scheduler for the cutting and color tasks on --nprocs processes,
+    # started before the DB sessions and threads are, as they must not be
+    # forked into the workers
+    if args.nprocs:
+        nprocs = args.nprocs
+    elif args.MP:
+        nprocs = mp.cpu_count()
     else:
-        schema = 'prod'
+        nprocs = 1
+    # Size of the cache of open input files, set before the workers start
+    desthumbs.set_fits_cache(maxfiles=args.fits_cache_files)
+    desthumbs.set_cutout_cache(args.cutout_cache,maxbytes=int(args.cutout_cache_gb*1024**3),tag=args.tag)
+
+    # The manifest of the outputs, with the outputs planned for each task of
+    # each tile, recorded once all of the tasks of the tile are done
+    manifest = desthumbs.Manifest(os.path.join(args.outdir,desthumbs.MANIFEST_NAME))
+    planned = {}
+    def checkpoint(tilename,ok_cuts,ok_colors,failed):
+        cut_outputs, color_outputs = planned.pop(tilename)
+        outputs = []
+        for k in ok_cuts:
+            outputs.extend(cut_outputs[k])
+        for k in ok_colors:
+            outputs.extend(color_outputs[k])
+        manifest.checkpoint(tilename,outputs,failed=failed)
+
+    # The per-stage metrics of each tile, as JSON lines
+    if args.metrics:
+        metrics_file = args.metrics
+    else:
+        metrics_file = os.path.join(args.outdir,'desthumbs_metrics.jsonl')
+    # Keep the metrics of the tiles done before when resuming
+    metrics_log = open(metrics_file,'a' if args.resume else 'w')
 
+    scheduler = desthumbs.TileScheduler(nprocs=nprocs,verb=args.verb,checkpoint=checkpoint,metrics_log=metrics_log)
+
+    # Get the metadata backend
+    backend = get_backend(args)
+    schema = backend.schema
     print "SCHEMA is",schema
     # Get archive_root
-    archive_root = desthumbs.get_archive_root(dbh,schema=schema,verb=True)
-
-    # Make sure that outdir exists
-    if not os.path.exists(args.outdir):
-         if args.verb: sout.write("# Creating: %s\n" % args.outdir)
-         os.makedirs(args.outdir)
+    archive_root = backend.get_archive_root(verb=True)
 
     # Find all of the tilenames, indices grouped per tile
     if args.verb: sout.write("# Finding tilename for each input position\n")
-    if searchbyID:
-         tilenames,ra,dec,indices, tilenames_matched = desthumbs.find_tilenames_id(coadd_id,args.coaddtable,dbh,schema=schema)
-    else:
-         tilenames,indices, tilenames_matched = desthumbs.find_tilenames_radec(ra,dec,dbh,schema=schema)
-
-    # Add them back to pandas dataframe and write a file
-    df['TILENAME'] = tilenames_matched
-    # Get the thumbname base names and the them the pandas dataframe too
-    df['THUMBNAME'] = get_base_names(tilenames_matched, ra, dec, prefix=args.prefix)
     matched_list = os.path.join(args.outdir,'matched_'+os.path.basename(args.inputList))
-    df.to_csv(matched_list,index=False)
-    sout.write("# Wrote matched tilenames list to: %s\n" % matched_list)
+    if args.chunksize:
+         # The matched rows go into the list as their tiles are done
+         partitions = partition_input(args,backend,itertools.chain([df],chunks),searchbyID,matched_list)
+         tilenames = partitions.tilenames
+         del df
+    else:
+         partitions = None
+         if searchbyID:
+              tilenames,ra,dec,indices, tilenames_matched = backend.find_tilenames_id(coadd_id,args.coaddtable,verb=args.verb)
+         else:
+              tilenames,indices, tilenames_matched = backend.find_tilenames_radec(ra,dec,method=args.tilematch,verb=args.verb)
+
+         # Add them back to pandas dataframe and write a file
+         df['TILENAME'] = tilenames_matched
+         # Get the thumbname base names and the them the pandas dataframe too
+         df['THUMBNAME'] = get_base_names(tilenames_matched, ra, dec, prefix=args.prefix)
+         df.to_csv(matched_list,index=False)
+         sout.write("# Wrote matched tilenames list to: %s\n" % matched_list)
     
     # Make sure that all found tilenames *are* in the tag (aka data exists for them)
     #tilenames_intag = desthumbs.get_tilenames_in_tag(dbh,args.tag)
 
 
+    # Get the files for all of the tilenames at once -- or in the
+    # background with --db_workers, while cutting the first tiles
+    if args.verb: sout.write("# Getting the files for %s tilenames\n" % len(tilenames))
+    coaddfiles = backend.prefetch_coaddfiles(tilenames,args.tag,bands=args.bands,verb=args.verb)
+
+    ext_options = get_ext_options(args)
+    if args.color_engine == 'numpy' and args.color_format != 'png' and desthumbs.colorlib.Image is None:
+        sout.write("# WARNING: No Pillow to write %s color images, will use stiff\n" % args.color_format)
+        args.color_engine = 'stiff'
+
+    # Share the cores between the workers and the stiff processes of their color tasks
+    stiff_parameters = {'NTHREADS':args.stiff_threads}
+    if args.stiff_mem_max:
+        stiff_parameters['MEM_MAX'] = args.stiff_mem_max
+    if args.stiff_jobs:
+        stiff_jobs = args.stiff_jobs
+    else:
+        stiff_jobs = max(1,mp.cpu_count()//(nprocs*args.stiff_threads))
+
+    # The numpy color engine takes the SCI sections of the colorset bands
+    # straight from the cutting tasks, when they can be handed off cheaply
+    share = args.color_engine == 'numpy' and desthumbs.handoff.can_share(nprocs,args.output)
+    if args.output == 'none':
+        output = None
+        if args.color_engine != 'numpy':
+            sys.exit("ERROR: --output none needs --color_engine numpy")
+    else:
+        output = args.output
+    if args.output != 'fits' and args.color_engine != 'numpy':
+        sout.write("# WARNING: No color images with --output %s, stiff needs the single FITS cutouts\n" % args.output)
+
     # Loop over all of the tilenames
     t0 = time.time()
     Ntile = 0
     for tilename in tilenames:
 
-        t1 = time.time()
         Ntile = Ntile+1
         sout.write("# ----------------------------------------------------\n")
         sout.write("# Doing: %s [%s/%s]\n" % (tilename,Ntile,len(tilenames)) )
         sout.write("# ----------------------------------------------------\n")
 
+        # Read the positions of the tile from its partition when streaming
+        if partitions is not None:
+            tile_df = partitions.read(tilename)
+            desthumbs.append_csv(tile_df,matched_list)
+            partitions.remove(tilename)
+            ra = tile_df.RA.values
+            dec = tile_df.DEC.values
+            xsize,ysize = check_xysize(tile_df,args,len(tile_df))
+            indices = {tilename: numpy.arange(len(tile_df))}
+            del tile_df
+
         # 1. Get all of the filenames for a given tilename
-        filenames = desthumbs.get_coaddfiles_tilename_bytag(tilename,dbh,args.tag,bands=args.bands,schema=schema)
+        filenames = coaddfiles.get(tilename,False)
 
         # ------------------
         # IMPORTANT NOTE
@@ -205,24 +537,54 @@ def run(args):
         # but for DR1, we get all entries independently, so the shape of the record arrays are different
         # ------------------
 
+        # The COMPRESSION for SV1/Y2A1/Y3A1 releases is already fixed
         if filenames is False:
             sout.write("# Skipping: %s -- not in TAG:%s \n" % (tilename,args.tag))
             continue
-        # Fix compression for SV1/Y2A1/Y3A1 releases
-        else:
-            filenames = desthumbs.fix_compression(filenames)
-            
+
         indx      = indices[tilename]
         if schema == 'dr1':
           avail_bands = desthumbs.get_avail_bands_dr1(filenames)
         else:
           avail_bands = filenames.BAND
 
-        # 2. Loop over all of the filename -- We could use multi-processing
-        p={}
+        # The outputs already done, with --resume
+        names = [desthumbs.get_thumbBaseName(ra[i],dec[i],prefix=args.prefix) for i in indx]
+        if args.resume:
+            done = manifest.get_done(tilename)
+        else:
+            done = set()
+
+        # The objects missing their color image, none with stiff and single file outputs
+        if args.output != 'fits' and args.color_engine != 'numpy':
+            indx_color = []
+        else:
+            indx_color = [i for i,name in zip(indx,names) if (name,desthumbs.COLOR_BAND) not in done]
+
+        # 2. One cutting task per filename (band) of the tile
+        cset = desthumbs.get_colorset(avail_bands,args.colorset) if share and indx_color else False
+        cut_tasks = []
+        cut_outputs = []
         n_filenames = len(avail_bands) 
         for k in range(n_filenames):
 
+            # The objects to cut: the ones missing their FITS thumbnail, all of
+            # them when the single file is rewritten, or the ones missing their
+            # color image with no output
+            BAND = avail_bands[k]
+            missing = [i for i,name in zip(indx,names) if (name,BAND) not in done]
+            if args.output == 'fits':
+                indx_cut = missing
+            elif args.output == 'none':
+                indx_cut = indx_color
+            elif missing or indx_color:
+                indx_cut = indx
+            else:
+                indx_cut = []
+            if len(indx_cut) == 0:
+                if args.verb: sout.write("# Skipping: %s/%s -- done\n" % (tilename,BAND))
+                continue
+
             # Rebuild the full filename with COMPRESSION if present
             if 'COMPRESSION' in filenames.dtype.names:
                 filename = os.path.join(archive_root,filenames.PATH[k],filenames.FILENAME[k])+filenames.COMPRESSION[k]
@@ -233,33 +595,75 @@ def run(args):
                 filename = os.path.join(archive_root,filenames.PATH[k])
 
             print filename
-            ar = (filename, ra[indx], dec[indx])
-            kw = {'xsize':xsize[indx], 'ysize':ysize[indx],
+            ar = (filename, ra[indx_cut], dec[indx_cut])
+            kw = {'xsize':xsize[indx_cut], 'ysize':ysize[indx_cut],
                   'units':'arcmin', 'prefix':args.prefix, 'outdir':args.outdir,
-                  'tilename':tilename, 'verb':args.verb}
+                  'tilename':tilename, 'read_block_mb':args.read_block_mb, 'output':output,
+                  'ext_options':ext_options, 'verb':args.verb}
             if args.verb: sout.write("# Cutting: %s\n" % filename)
-            if args.MP:
-                NP = len(avail_bands)
-                p[filename] = mp.Process(target=desthumbs.fitscutter, args=ar, kwargs=kw)
-                p[filename].start()
+            cutter = desthumbs.cut_and_share if cset and BAND in cset else desthumbs.fitscutter
+            cut_tasks.append((cutter, ar, kw))
+            cut_outputs.append(get_cut_outputs(args,tilename,BAND,ra[indx_cut],dec[indx_cut]))
+
+        # 3. Create color images using stiff for each ra,dec, in chunks of objects
+        color_tasks = []
+        color_outputs = []
+        for k in range(0,len(indx_color),args.color_chunk):
+            indx_chunk = indx_color[k:k+args.color_chunk]
+            ar = (ra[indx_chunk], dec[indx_chunk], avail_bands)
+            kw = {'prefix':args.prefix, 'colorset':args.colorset, 'outdir':args.outdir,
+                  'verb':args.verb, 'stiff_parameters':stiff_parameters, 'engine':args.color_engine}
+            if args.color_engine == 'numpy':
+                kw.update({'ext':args.color_format, 'stretch':args.color_stretch})
+                if share:
+                    kw['stamps'] = None
             else:
-                NP = 1
-                desthumbs.fitscutter(*ar,**kw)
-
-        # Make sure all process are closed before proceeding
-        if args.MP:
-            for filename in p.keys(): p[filename].join()
-
-        # 3. Create color images using stiff for each ra,dec and loop over (ra,dec)
-        for k in range(len(ra[indx])):
-            desthumbs.color_radec(ra[indx][k],dec[indx][k],avail_bands,
-                                  prefix=args.prefix,
-                                  colorset=args.colorset,
-                                  outdir=args.outdir,
-                                  verb=args.verb,
-                                  stiff_parameters={'NTHREADS':NP})
-
-        if args.verb: sout.write("# Time %s: %s\n" % (tilename,desthumbs.elapsed_time(t1)))
+                kw['stiff_jobs'] = stiff_jobs
+            color_tasks.append((desthumbs.color_radec_list, ar, kw))
+            color_outputs.append(get_color_outputs(args,ra[indx_chunk],dec[indx_chunk]))
 
+        if len(cut_tasks) == 0 and len(color_tasks) == 0:
+            sout.write("# Skipping: %s -- all outputs done\n" % tilename)
+            continue
+        planned[tilename] = (cut_outputs,color_outputs)
+        scheduler.add_tile(tilename,cut_tasks,color_tasks)
+
+    # All of the lookups are done, release the DB sessions and threads
+    backend.close()
+
+    # Wait for all of the tasks to finish
+    scheduler.join()
+    if partitions is not None:
+        partitions.close()
+        sout.write("# Wrote matched tilenames list to: %s\n" % matched_list)
+    sout.write("# Outputs in manifest: %s\n" % manifest.summary())
+    manifest.close()
+
+    # The metrics of the run: the lookups done here and the tasks of all tiles
+    run_metrics = desthumbs.Metrics()
+    run_metrics.merge(desthumbs.METRICS.stages)
+    run_metrics.merge(scheduler.metrics.stages)
+    wall = time.time() - t_run
+    ncutouts = run_metrics.get_count('cutout')
+    desthumbs.write_json_line(metrics_log,{'summary': True, 'wall': round(wall,6), 'ncutouts': ncutouts,
+                                           'cutouts_per_sec': round(ncutouts/max(wall,1e-9),3),
+                                           'stages': run_metrics.summary()})
+    metrics_log.close()
+    desthumbs.report_metrics(run_metrics,wall,ncutouts,sout)
+    sout.write("# Wrote metrics to: %s\n" % metrics_file)
+
+    # Merge the profiles of this process and of the workers
+    if args.profile:
+         desthumbs.stop_profiling()
+         desthumbs.merge_profiles(profile_dir,sout=sout)
+         if args.profile_memory:
+              desthumbs.report_memory(profile_dir,sout=sout)
+
+    # Merge the spans of this process and of the workers into one trace
+    if args.trace:
+         desthumbs.get_tracer().flush()
+         desthumbs.merge_traces(os.path.join(args.outdir,'trace'),os.path.join(args.outdir,desthumbs.TRACE_NAME),sout=sout)
+
+    if args.verb: backend.report_timings(sout)
     sout.write("\n*** Grand Total time:%s ***\n" % desthumbs.elapsed_time(t0))
     return 
@@ -0,0 +1,94 @@
+"""
+Persistent manifest of the outputs of a run, in a SQLite file in the
+output directory, so that a run that died, or one with a few objects
+added to the input list, can be resumed with --resume and only make the
+missing cutouts and color images. The outputs of each tile are recorded
+in a single transaction once all of its tasks are done.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+
+SOUT = sys.stdout
+
+MANIFEST_NAME = 'desthumbs_manifest.db'
+
+MANIFEST_TABLES = """
+create table if not exists OUTPUTS (THUMBNAME text, TILENAME text, BAND text, PATH text,
+                                    STATUS text, BYTES integer, TIME text,
+                                    primary key (THUMBNAME, BAND));
+create index if not exists OUTPUTS_TILENAME on OUTPUTS (TILENAME);
+create table if not exists TILES (TILENAME text primary key, STATUS text, TIME text);
+"""
+
+# The BAND of the color images in OUTPUTS
+COLOR_BAND = 'color'
+
+
+class Manifest(object):
+
+    """
+    The (THUMBNAME, BAND) outputs of a run with their PATH, STATUS
+    ('ok' or 'missing') and BYTES, where BAND is 'color' for the color
+    images. Only the parent process writes to it.
+    """
+
+    def __init__(self,filename):
+        self.filename = filename
+        # Checkpoints come from the thread handling the pool results
+        self.con = sqlite3.connect(filename,check_same_thread=False)
+        self.con.executescript(MANIFEST_TABLES)
+        self.con.commit()
+
+    def get_done(self,tilename):
+
+        """
+        The set of (THUMBNAME, BAND) already done for a tile, the ones
+        recorded as 'ok' that are still on disk with their recorded size
+        """
+        cur = self.con.execute("select THUMBNAME, BAND, PATH, BYTES from OUTPUTS where TILENAME=? and STATUS='ok'",
+                               (tilename,))
+        sizes = {}
+        done = set()
+        nlost = 0
+        for thumbname, band, path, nbytes in cur.fetchall():
+            if path not in sizes:
+                sizes[path] = os.path.getsize(path) if os.path.exists(path) else -1
+            if sizes[path] == nbytes:
+                done.add((thumbname,band))
+            else:
+                nlost += 1
+        if nlost > 0:
+            SOUT.write("# WARNING: %s outputs of %s in the manifest are missing or changed, will make them again\n" %
+                       (nlost,tilename))
+        return done
+
+    def checkpoint(self,tilename,outputs,failed=False):
+
+        """
+        Record the outputs of a tile, a list of (THUMBNAME, BAND, PATH),
+        checking that they exist, and the status of the tile, in a single
+        transaction
+        """
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        sizes = {}
+        rows = []
+        for thumbname, band, path in outputs:
+            if path not in sizes:
+                sizes[path] = os.path.getsize(path) if os.path.exists(path) else -1
+            status = 'ok' if sizes[path] >= 0 else 'missing'
+            rows.append((thumbname,tilename,band,path,status,max(sizes[path],0),now))
+        with self.con:
+            self.con.executemany("insert or replace into OUTPUTS values (?,?,?,?,?,?,?)",rows)
+            self.con.execute("insert or replace into TILES values (?,?,?)",
+                             (tilename,'failed' if failed else 'done',now))
+        return
+
+    def summary(self):
+        """ Number of outputs by STATUS """
+        return dict(self.con.execute("select STATUS, count(*) from OUTPUTS group by STATUS").fetchall())
+
+    def close(self):
+        self.con.close()
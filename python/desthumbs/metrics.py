@@ -0,0 +1,140 @@
+"""
+Per-stage timing metrics: the number of calls, the time, the bytes and a
+histogram of the time of each stage of a run (tile lookup, file
+listing, file open/header parse, pixel read, cutting, FITS write and
+color generation). Each process adds to its own METRICS, the metrics of
+the tasks are sent back with their results, and the scheduler writes
+one JSON line per tile and the summary of the run.
+"""
+
+import sys
+import json
+import math
+import time
+
+from . import tracing
+
+SOUT = sys.stdout
+
+# Order of the stages in the summary
+STAGES = ['tile_lookup','file_listing','file_open','pixel_read','cutout','fits_write','color']
+
+# The histograms count the calls in powers of 2 of milliseconds
+HIST_MIN = -6
+HIST_MAX = 20
+
+
+def get_bucket(seconds):
+    """ The histogram bucket of a time: k for 2**(k-1) <= ms < 2**k """
+    if seconds <= 0:
+        return HIST_MIN
+    return min(max(math.frexp(seconds*1000.0)[1],HIST_MIN),HIST_MAX)
+
+
+class Metrics(object):
+
+    """
+    The count, time, max time, bytes and histogram of each stage, as
+    {stage: {'count', 'time', 'max', 'bytes', 'hist': {bucket: count}}}.
+    add() only updates a few numbers, so that it can be called on every
+    cutout
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self,stage,seconds,nbytes=0):
+        s = self.stages.get(stage)
+        if s is None:
+            s = self.stages[stage] = {'count': 0, 'time': 0.0, 'max': 0.0, 'bytes': 0, 'hist': {}}
+        s['count'] += 1
+        s['time'] += seconds
+        s['bytes'] += nbytes
+        if seconds > s['max']:
+            s['max'] = seconds
+        b = get_bucket(seconds)
+        s['hist'][b] = s['hist'].get(b,0) + 1
+
+    def since(self,stage,t0,nbytes=0,span=True):
+        """ Add the time since t0 to stage, and its span when tracing """
+        t1 = time.time()
+        self.add(stage,t1-t0,nbytes)
+        if span and tracing.TRACING is not None:
+            tracing.add_span(stage,t0,t1,nbytes=nbytes)
+
+    def swap(self,stages):
+        """ Replace the stages, returns the previous ones """
+        previous = self.stages
+        self.stages = stages
+        return previous
+
+    def merge(self,stages):
+        """ Add the stages of another Metrics """
+        for stage, other in stages.items():
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {'count': 0, 'time': 0.0, 'max': 0.0, 'bytes': 0, 'hist': {}}
+            s['count'] += other['count']
+            s['time'] += other['time']
+            s['bytes'] += other['bytes']
+            s['max'] = max(s['max'],other['max'])
+            for b, n in other['hist'].items():
+                s['hist'][b] = s['hist'].get(b,0) + n
+
+    def get_count(self,stage):
+        return self.stages.get(stage,{}).get('count',0)
+
+    def summary(self):
+        """ The count, time, mean, p50, p95, max (in s) and bytes of each stage """
+        summary = {}
+        for stage, s in self.stages.items():
+            summary[stage] = {'count': s['count'],
+                              'time': round(s['time'],6),
+                              'mean': round(s['time']/max(s['count'],1),6),
+                              'p50': min(get_percentile(s['hist'],0.50),round(s['max'],6)),
+                              'p95': min(get_percentile(s['hist'],0.95),round(s['max'],6)),
+                              'max': round(s['max'],6),
+                              'bytes': s['bytes']}
+        return summary
+
+
+def get_percentile(hist,q):
+    """ Upper edge in seconds of the histogram bucket of the q quantile """
+    total = sum(hist.values())
+    n = 0
+    for b in sorted(hist.keys()):
+        n += hist[b]
+        if n >= q*total:
+            return 2.0**b/1000.0
+    return 0.0
+
+
+def get_stage_names(stages):
+    """ The stages in STAGES order, then any others """
+    return [s for s in STAGES if s in stages] + sorted([s for s in stages if s not in STAGES])
+
+
+def write_json_line(out,record):
+    """ Write one JSON line and flush it, so that the file can be followed """
+    out.write(json.dumps(record,sort_keys=True) + "\n")
+    out.flush()
+
+
+def report_metrics(metrics,wall,ncutouts,sout=None):
+
+    """ Write the summary of the stages of a run as a table """
+    sout = sout or SOUT
+    summary = metrics.summary()
+    sout.write("# %-14s %8s %10s %10s %10s %10s %10s %10s\n" %
+               ('stage','count','time[s]','mean[ms]','p50[ms]','p95[ms]','max[ms]','MB'))
+    for stage in get_stage_names(summary):
+        s = summary[stage]
+        sout.write("# %-14s %8d %10.3f %10.3f %10.3f %10.3f %10.3f %10.2f\n" %
+                   (stage,s['count'],s['time'],1000*s['mean'],1000*s['p50'],1000*s['p95'],
+                    1000*s['max'],s['bytes']/1024.0**2))
+    sout.write("# %s cutouts in %.2fs: %.1f cutouts/sec\n" % (ncutouts,wall,ncutouts/max(wall,1e-9)))
+    return
+
+
+# The metrics of this process
+METRICS = Metrics()
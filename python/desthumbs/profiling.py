@@ -0,0 +1,241 @@
+"""
+Profiling of a run (--profile): cProfile of the parent process, where
+the inputs are read and the tiles and files looked up, of the DB lookup
+threads and of the cutting and color tasks in each worker process. Each
+profile is written as its own .pstats file in the profile directory,
+and they are merged into one report at the end of the run. Optionally,
+the memory high-water mark of each task is written as JSON lines.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import pstats
+import cProfile
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import metrics
+
+SOUT = sys.stdout
+
+# The (dirname, memory) settings of the run, None when not profiling.
+# Set before the workers start, so that they inherit them
+PROFILING = None
+
+# The profiles of this process, by thread
+PROFILERS = {}
+
+REPORT_NAME = 'desthumbs_profile'
+
+
+def get_peak_memory():
+    """ Peak resident memory of this process in bytes: VmHWM on Linux, ru_maxrss otherwise """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])*1024
+    except (IOError,OSError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+
+def reset_peak_memory():
+    """ Reset the VmHWM of this process to its current RSS (Linux >= 4.0), False if it cannot """
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except (IOError,OSError):
+        return False
+
+
+class Profiler(object):
+
+    """
+    The cProfile of one thread of a process, dumped to
+    desthumbs_<pid>_<k>.pstats in dirname, with the optional memory
+    high-water mark of each task in desthumbs_<pid>_<k>.memory.jsonl
+    """
+
+    def __init__(self,dirname,k=0,memory=False):
+        self.dirname = dirname
+        self.memory = memory
+        self.pid = os.getpid()
+        self.basename = os.path.join(dirname,"desthumbs_%s_%s" % (self.pid,k))
+        self.profile = cProfile.Profile()
+        self.active = False
+        self.memlog = None
+
+    def start(self):
+        """ Enable the profile, returns False if it was already on or another profile is """
+        if self.active:
+            return False
+        try:
+            self.profile.enable()
+        except ValueError:
+            # From python 3.12 only one profile can be on per process,
+            # the one already on covers all of its threads
+            return False
+        self.active = True
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        self.active = False
+        self.profile.dump_stats(self.basename + '.pstats')
+
+    def runcall(self,func,*args,**kwargs):
+
+        """
+        Run func under the profile, and dump it right after, as the
+        workers of a pool can exit without notice
+        """
+        started = self.start()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            if started:
+                self.stop()
+
+    def runtask(self,label,func,*args,**kwargs):
+        """ Same as runcall(), and with memory on, write the high-water mark of the task """
+        if not self.memory:
+            return self.runcall(func,*args,**kwargs)
+        reset = reset_peak_memory()
+        t0 = time.time()
+        try:
+            return self.runcall(func,*args,**kwargs)
+        finally:
+            self.write_memory(label,func.__name__,time.time()-t0,reset)
+
+    def write_memory(self,label,funcname,wall,reset):
+        if self.memlog is None:
+            self.memlog = open(self.basename + '.memory.jsonl','a')
+        peak = get_peak_memory()
+        record = {'pid': self.pid, 'func': funcname, 'wall': round(wall,6),
+                  'peak_mb': round(peak/1024.0**2,3) if peak is not None else None,
+                  # Without the reset the peak is the one since the process started
+                  'reset': reset}
+        record.update(label or {})
+        metrics.write_json_line(self.memlog,record)
+
+
+def set_profiling(dirname=None,memory=False):
+
+    """
+    Turn on profiling into dirname, or off if None. Must be called
+    before the worker processes are started
+    """
+    global PROFILING
+    stop_profiling()
+    if dirname is None:
+        PROFILING = None
+        return
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    # Remove the profiles of an earlier run
+    for pattern in ('desthumbs_*_*.pstats','desthumbs_*_*.memory.jsonl',REPORT_NAME+'.*'):
+        for filename in glob.glob(os.path.join(dirname,pattern)):
+            os.remove(filename)
+    PROFILING = (dirname,memory)
+
+
+def get_profiler():
+    """ The Profiler of this thread, None when not profiling """
+    if PROFILING is None:
+        return None
+    key = (os.getpid(),threading.current_thread().ident)
+    profiler = PROFILERS.get(key)
+    if profiler is None:
+        # The profiles of the parent are copied into forked workers, drop them
+        for other in list(PROFILERS.keys()):
+            if other[0] != key[0]:
+                if PROFILERS[other].active:
+                    PROFILERS[other].profile.disable()
+                del PROFILERS[other]
+        dirname, memory = PROFILING
+        profiler = PROFILERS[key] = Profiler(dirname,k=len(PROFILERS),memory=memory)
+    return profiler
+
+
+def profile_call(func,*args,**kwargs):
+    """ Call func under the profile of this thread when profiling """
+    profiler = get_profiler()
+    if profiler is None:
+        return func(*args,**kwargs)
+    return profiler.runcall(func,*args,**kwargs)
+
+
+def stop_profiling():
+    """ Stop and dump the profiles of this process """
+    for key, profiler in list(PROFILERS.items()):
+        if key[0] == os.getpid() and profiler.active:
+            profiler.stop()
+        if profiler.memlog is not None:
+            profiler.memlog.close()
+    PROFILERS.clear()
+
+
+def merge_profiles(dirname,sort='cumulative',nlines=40,sout=None):
+
+    """
+    Merge the .pstats of all of the processes and threads in dirname
+    into desthumbs_profile.pstats, write the report sorted by sort to
+    desthumbs_profile.txt, and the top nlines of it to sout
+    """
+    sout = sout or SOUT
+    files = sorted(glob.glob(os.path.join(dirname,'desthumbs_*_*.pstats')))
+    if len(files) == 0:
+        sout.write("# WARNING: No profiles found in: %s\n" % dirname)
+        return None
+    pstatsfile = os.path.join(dirname,REPORT_NAME + '.pstats')
+    reportfile = os.path.join(dirname,REPORT_NAME + '.txt')
+    with open(reportfile,'w') as report:
+        stats = pstats.Stats(files[0],stream=report)
+        for filename in files[1:]:
+            stats.add(filename)
+        stats.dump_stats(pstatsfile)
+        report.write("Merged profile of %s processes/threads: %s\n" % (len(files),' '.join(files)))
+        stats.sort_stats(sort).print_stats()
+    stats = pstats.Stats(pstatsfile,stream=sout)
+    sout.write("# Merged profile of %s processes/threads, top %s by %s:\n" % (len(files),nlines,sort))
+    stats.sort_stats(sort).print_stats(nlines)
+    sout.write("# Wrote merged profile to: %s and %s\n" % (pstatsfile,reportfile))
+    return pstatsfile
+
+
+def report_memory(dirname,ntop=5,sout=None):
+
+    """
+    Summarize the memory high-water marks of the tasks in dirname by
+    kind of task, with the ntop largest ones
+    """
+    sout = sout or SOUT
+    records = []
+    for filename in glob.glob(os.path.join(dirname,'desthumbs_*.memory.jsonl')):
+        records.extend([json.loads(line) for line in open(filename) if line.strip()])
+    records = [r for r in records if r['peak_mb'] is not None]
+    if len(records) == 0:
+        return
+    sout.write("# %-10s %8s %14s %14s\n" % ('task','count','mean peak[MB]','max peak[MB]'))
+    for kind in sorted(set([r.get('kind',r['func']) for r in records])):
+        peaks = [r['peak_mb'] for r in records if r.get('kind',r['func']) == kind]
+        sout.write("# %-10s %8d %14.1f %14.1f\n" % (kind,len(peaks),sum(peaks)/len(peaks),max(peaks)))
+    if not all([r['reset'] for r in records]):
+        sout.write("# WARNING: Could not reset the peak memory per task, "
+                   "the peaks include the earlier tasks of each worker\n")
+    for r in sorted(records,key=lambda r: -r['peak_mb'])[:ntop]:
+        sout.write("# %8.1f MB %-10s %s pid=%s\n" %
+                   (r['peak_mb'],r.get('kind',r['func']),r.get('tilename',''),r['pid']))
+    return
@@ -0,0 +1,266 @@
+"""
+Bounded scheduler to run the (tile, band) cutting tasks and the color
+tasks of all tiles on a pool of worker processes. The color tasks of a
+tile are only started once all of its cutting tasks are done, and they
+go ahead of the cutting of later tiles, so that the thumbnails they read
+are still hot.
+"""
+
+import os
+import sys
+import time
+import pickle
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+
+from . import thumbslib
+from . import colorlib
+from . import handoff
+from . import metrics
+from . import profiling
+from . import tracing
+
+SOUT = sys.stdout
+
+
+class Pickled(object):
+
+    """ A task result pickled in the worker, loaded back with load() """
+
+    def __init__(self,value):
+        self.data = pickle.dumps(value,pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        return pickle.loads(self.data)
+
+
+def run_task(func,args,kwargs,label=None):
+    """
+    Run a task and catch any error, so that a failed task is reported
+    instead of killing the run. Returns (ok, result or traceback,
+    metrics stages of the task). When profiling, the task runs under
+    the profile of its process, with label in its memory record. When
+    tracing, its spans are tagged with label and written once it is done
+    """
+    outer = metrics.METRICS.swap({})
+    profiler = profiling.get_profiler()
+    tracer = tracing.get_tracer()
+    if tracer is not None:
+        tracer.set_tags(**(label or {}))
+        t0 = time.time()
+    try:
+        if profiler is None:
+            result = True, func(*args,**kwargs)
+        else:
+            result = True, profiler.runtask(label,func,*args,**kwargs)
+    except Exception:
+        result = False, traceback.format_exc()
+    # A result that cannot be sent back from a worker is a failed task.
+    # It is sent back as pickled here, so that it is only pickled once
+    if result[0] and mp.current_process().name != 'MainProcess':
+        try:
+            result = True, Pickled(result[1])
+        except Exception:
+            result = False, "Cannot send back the result of %s:\n%s" % (func.__name__,traceback.format_exc())
+    if tracer is not None:
+        tracer.add('task',t0,func=func.__name__,ok=result[0])
+        tracer.clear_tags()
+        tracer.flush()
+    return result + (metrics.METRICS.swap(outer),)
+
+
+def color_radec_list(ra,dec,avail_bands,engine='stiff',stiff_jobs=1,stamps=None,**kwargs):
+    """
+    Make the color images for a list of ra,dec -- one color task, with
+    the in-process numpy engine in colorlib, from the SCI sections
+    handed off by the cutting tasks in stamps if given, or with up to
+    stiff_jobs stiff processes at a time, logging to stiff.log in outdir
+    """
+    if engine == 'numpy':
+        shared = handoff.SharedStamps(stamps) if stamps is not None else None
+        try:
+            for k in range(len(ra)):
+                if shared is not None:
+                    name = thumbslib.get_thumbBaseName(ra[k],dec[k],prefix=kwargs.get('prefix','DES'))
+                    kwargs['images'] = shared.get(name)
+                colorlib.color_radec_numpy(ra[k],dec[k],avail_bands,**kwargs)
+        finally:
+            kwargs.pop('images',None)
+            if shared is not None:
+                shared.close()
+        return
+
+    logfile = os.path.join(kwargs.get('outdir',os.getcwd()),'stiff.log')
+    executor = thumbslib.StiffExecutor(njobs=stiff_jobs,logfile=logfile)
+    for k in range(len(ra)):
+        thumbslib.color_radec(ra[k],dec[k],avail_bands,executor=executor,**kwargs)
+    failed = executor.join()
+    if failed:
+        raise RuntimeError("stiff failed for %s of %s color images, see: %s" % (len(failed),len(ra),logfile))
+    return
+
+
+class TileScheduler(object):
+
+    """
+    Runs the cutting and color tasks of tiles added with add_tile() on
+    nprocs worker processes, with at most 2*nprocs tasks queued in the
+    pool at any time. With nprocs=1 the tasks run in this process, in
+    the order they are added. Call join() to wait for all the tasks.
+    If given, checkpoint(tilename, ok_cuts, ok_colors, failed) is called
+    once all of the tasks of a tile are done, with the positions in
+    cut_tasks and color_tasks of the tasks that succeeded.
+    The metrics of the tasks are added up per tile, written as a JSON line
+    to metrics_log when the tile is done, and for the run in self.metrics
+    """
+
+    def __init__(self,nprocs=1,verb=False,checkpoint=None,metrics_log=None):
+
+        self.nprocs = nprocs
+        self.verb = verb
+        self.checkpoint = checkpoint
+        self.metrics_log = metrics_log
+        self.metrics = metrics.Metrics()
+        self.maxinflight = 2*nprocs
+        self.inflight = 0
+        self.cuts = collections.deque()
+        self.colors = collections.deque()
+        self.tiles = {}
+        self.errors = []
+        self.ntasks = 0
+        self.lock = threading.Condition()
+        if nprocs > 1:
+            handoff.init_sharing()
+            self.pool = mp.Pool(nprocs)
+        else:
+            self.pool = None
+
+    def add_tile(self,tilename,cut_tasks,color_tasks):
+
+        """
+        Add the tasks of a tile, where each task is a (func, args, kwargs)
+        tuple. The color_tasks are run after all of the cut_tasks are done
+        """
+        with self.lock:
+            self.tiles[tilename] = {'ncuts': len(cut_tasks), 'failed': False, 'stamps': [],
+                                    'color_tasks': color_tasks, 'ntasks': len(cut_tasks)+len(color_tasks),
+                                    'ok': {'cut': [], 'color': []}, 'metrics': metrics.Metrics(),
+                                    't0': time.time()}
+            for k,task in enumerate(cut_tasks):
+                self.cuts.append((tilename,'cut',task,k))
+            if len(cut_tasks) == 0:
+                self.release_colors(tilename)
+            self.dispatch()
+
+    def release_colors(self,tilename):
+        """ Queue the color tasks of a tile once its cuts are done """
+        tile = self.tiles[tilename]
+        if tile['failed']:
+            SOUT.write("# WARNING: Skipping color images for %s -- cutting failed\n" % tilename)
+            tile['ntasks'] -= len(tile['color_tasks'])
+            return
+        for k,(func, args, kwargs) in enumerate(tile['color_tasks']):
+            # Give the SCI sections of its objects handed off by the cuts
+            # to each color task that takes them
+            if 'stamps' in kwargs:
+                ra, dec = args[0], args[1]
+                names = [thumbslib.get_thumbBaseName(ra[i],dec[i],prefix=kwargs.get('prefix','DES'))
+                         for i in range(len(ra))]
+                kwargs = dict(kwargs,stamps=handoff.select_stamps(tile['stamps'],names))
+            self.colors.append((tilename,'color',(func,args,kwargs),k))
+
+    def dispatch(self):
+
+        """ Send ready tasks to the pool (or run them here), colors first """
+        while self.inflight < self.maxinflight or self.pool is None:
+            if self.colors:
+                task = self.colors.popleft()
+            elif self.cuts:
+                task = self.cuts.popleft()
+            else:
+                break
+            self.inflight += 1
+            tilename, kind, (func, args, kwargs), k = task
+            label = {'tilename': tilename, 'kind': kind}
+            if self.pool is None:
+                self.task_done(task,run_task(func,args,kwargs,label),locked=True)
+            else:
+                kw = {'callback': lambda result, task=task: self.task_done(task,result)}
+                # Any other error of the pool with the task is reported as its result
+                if sys.version_info[0] >= 3:
+                    kw['error_callback'] = lambda exc, task=task: self.task_done(task,(False,repr(exc)+"\n",{}))
+                self.pool.apply_async(run_task,(func,args,kwargs,label),**kw)
+
+    def task_done(self,task,result,locked=False):
+
+        """ Book-keeping after a task is done, called from the pool result thread """
+        if not locked:
+            self.lock.acquire()
+        try:
+            tilename, kind, (func, args, kwargs), k = task
+            ok, value, stages = result
+            if isinstance(value,Pickled):
+                value = value.load()
+            self.inflight -= 1
+            self.ntasks += 1
+            tile = self.tiles[tilename]
+            tile['ntasks'] -= 1
+            tile['metrics'].merge(stages)
+            self.metrics.merge(stages)
+            if not ok:
+                tile['failed'] = tile['failed'] or kind == 'cut'
+                self.errors.append((tilename,kind,func.__name__,args[0] if args else None,value))
+                SOUT.write("# ERROR in %s task %s for %s:\n%s" % (kind,func.__name__,tilename,value))
+            else:
+                tile['ok'][kind].append(k)
+            if kind == 'cut':
+                if ok and isinstance(value,dict) and 'names' in value:
+                    tile['stamps'].append(value)
+                tile['ncuts'] -= 1
+                if tile['ncuts'] == 0:
+                    self.release_colors(tilename)
+            self.check_tile_done(tilename)
+            if self.pool is not None:
+                self.dispatch()
+            self.lock.notify_all()
+        finally:
+            if not locked:
+                self.lock.release()
+
+    def check_tile_done(self,tilename):
+        tile = self.tiles[tilename]
+        if tile['ntasks'] != 0:
+            return
+        for stamps in tile['stamps']:
+            handoff.release_stamps(stamps)
+        tile['stamps'] = []
+        if self.checkpoint is not None:
+            try:
+                self.checkpoint(tilename,tile['ok']['cut'],tile['ok']['color'],tile['failed'])
+            except Exception:
+                SOUT.write("# ERROR: Cannot checkpoint %s:\n%s" % (tilename,traceback.format_exc()))
+        if self.metrics_log is not None:
+            wall = time.time() - tile['t0']
+            ncutouts = tile['metrics'].get_count('cutout')
+            metrics.write_json_line(self.metrics_log,{'tilename': tilename, 'failed': tile['failed'],
+                                                      'wall': round(wall,6), 'ncutouts': ncutouts,
+                                                      'cutouts_per_sec': round(ncutouts/max(wall,1e-9),3),
+                                                      'stages': tile['metrics'].summary()})
+        tile['metrics'] = None
+        if self.verb:
+            SOUT.write("# Time %s: %s\n" % (tilename,thumbslib.elapsed_time(tile['t0'])))
+
+    def join(self):
+
+        """ Wait for all of the tasks to be done, returns the list of errors """
+        with self.lock:
+            while self.inflight > 0 or self.cuts or self.colors:
+                self.lock.wait(1.0)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.errors:
+            SOUT.write("# WARNING: %s of %s tasks failed\n" % (len(self.errors),self.ntasks))
+        return self.errors
@@ -0,0 +1,86 @@
+"""
+Streaming input for very large position lists. The input CSV or Parquet
+file is read in chunks, the tiles of each chunk are found and its rows
+are spilled to one partition file per tile on disk, so that the tiles
+can then be cut one at a time, with the memory set by the chunk size
+and the largest tile instead of the size of the input list.
+"""
+
+import os
+import shutil
+import pandas
+from collections import OrderedDict
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+PARQUET_EXTENSIONS = ('.parquet','.pq')
+
+
+def is_parquet(filename):
+    return os.path.splitext(filename)[-1].lower() in PARQUET_EXTENSIONS
+
+
+def read_input(filename):
+    """ Read the whole CSV or Parquet input list into a DataFrame """
+    if is_parquet(filename):
+        return pandas.read_parquet(filename)
+    return pandas.read_csv(filename)
+
+
+def read_input_chunks(filename,chunksize):
+    """ Read a CSV or Parquet input list as DataFrames of chunksize rows """
+    if is_parquet(filename):
+        if pq is None:
+            raise ImportError("ERROR: Need pyarrow to read Parquet input in chunks: %s" % filename)
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for df in pandas.read_csv(filename,chunksize=chunksize):
+            yield df
+
+
+class TilePartitions(object):
+
+    """
+    The rows of the input list spilled to one CSV file per tile in
+    dirname, in the input order within each tile. Tiles are kept in the
+    order they are first found
+    """
+
+    def __init__(self,dirname):
+        self.dirname = dirname
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.makedirs(dirname)
+        self.counts = OrderedDict()
+
+    def filename(self,tilename):
+        return os.path.join(self.dirname,"%s.csv" % tilename)
+
+    def add(self,df):
+        """ Append the rows of a chunk to the partitions of their TILENAME """
+        for tilename, part in df.groupby('TILENAME',sort=False):
+            part.to_csv(self.filename(tilename),mode='a',header=tilename not in self.counts,index=False)
+            self.counts[tilename] = self.counts.get(tilename,0) + len(part)
+
+    @property
+    def tilenames(self):
+        return list(self.counts.keys())
+
+    def read(self,tilename):
+        """ Read the partition of a tile, with the positions as written """
+        return pandas.read_csv(self.filename(tilename),float_precision='round_trip')
+
+    def remove(self,tilename):
+        os.remove(self.filename(tilename))
+
+    def close(self):
+        shutil.rmtree(self.dirname,ignore_errors=True)
+
+
+def append_csv(df,filename,first=False):
+    """ Append the rows of a DataFrame to a CSV file, starting it when first """
+    df.to_csv(filename,mode='w' if first else 'a',header=first,index=False)
@@ -12,7 +12,16 @@ from despyastro import wcsutil
 import time
 import numpy
 import subprocess
+import tempfile
 from collections import OrderedDict
+from . import cutoutcache
+from . import metrics
+from . import tracing
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 def elapsed_time(t1,verbose=False):
     """ Formating of the elapsed time """
@@ -30,6 +39,7 @@ FITS_OUTNAME  = "{outdir}/{prefix}J{ra}{dec}_{filter}.{ext}"
 TIFF_OUTNAME  = "{outdir}/{prefix}J{ra}{dec}.{ext}"
 LOG_OUTNAME   = "{outdir}/{prefix}J{ra}{dec}.{ext}"
 BASE_OUTNAME  = "{prefix}J{ra}{dec}"
+CONTAINER_OUTNAME = "{outdir}/{prefix}{tilename}_{filter}_cutouts.{ext}"
 STIFF_EXE = 'stiff'
 
 # Definitions for the color filter sets we'd like to use, by priority
@@ -79,6 +89,122 @@ def update_wcs_matrix(header,x0,y0,naxis1,naxis2,ra,dec):
     h['DEC_CUTOUT'] = dec
     return h
 
+# The keywords updated in the header of each cutout
+CUTOUT_KEYS = ['CRVAL1','CRVAL2','CRPIX1','CRPIX2','RA_CUTOUT','DEC_CUTOUT']
+
+# The int16 value (BLANK) of the non-finite pixels of scaled extensions,
+# outside of the range used for the finite ones
+INT16_BLANK = -32768
+
+def get_header_templates(header,tilename=None,scaled=()):
+
+    """
+    Make a copy, once per file, of the header of each extension to be
+    used as template for the headers of all of the cutouts, adding the
+    TILENAME keyword if not already present. Returns a dictionary of
+    (header, cards) per EXTNAME, where cards are the records of the
+    CUTOUT_KEYS to be updated by update_header_template(). The
+    extensions in scaled also get BSCALE/BZERO, set by cast_section(),
+    and BLANK for their non-finite pixels
+    """
+    import copy
+    templates = OrderedDict()
+    for EXTNAME in header.keys():
+        h = copy.deepcopy(header[EXTNAME])
+        if tilename and 'TILENAME' not in header['SCI']:
+            tile_rec = {'name': 'TILENAME', 'value':tilename, 'comment':'Name of DES parent TILENAME'}
+            h.add_record(tile_rec)
+        # Set the keywords once, the same way update_wcs_matrix() does
+        for key in CUTOUT_KEYS:
+            h[key] = 0
+        if EXTNAME in scaled:
+            h['BSCALE'] = 1.0
+            h['BZERO'] = 0.0
+            h['BLANK'] = INT16_BLANK
+        cards = dict([(rec['name'],rec) for rec in h.records() if rec['name'] in CUTOUT_KEYS+['BSCALE','BZERO']])
+        templates[EXTNAME] = (h,cards)
+    return templates
+
+def update_header_template(template,crval1,crval2,naxis1,naxis2,ra,dec):
+
+    """
+    Update the header template of a cutout with the right CRPIX[1,2]
+    CRVAL[1,2], same as update_wcs_matrix() but without a deep copy and
+    with CRVAL[1,2] already computed. Returns a new FITSHDR with the
+    records of the template, as fitsio cleans the header it writes in
+    place, which would drop the reserved space of the next cutouts
+    """
+    h, cards = template
+    cards['CRVAL1']['value'] = crval1
+    cards['CRVAL2']['value'] = crval2
+    cards['CRPIX1']['value'] = int(naxis1/2.0)
+    cards['CRPIX2']['value'] = int(naxis2/2.0)
+    cards['RA_CUTOUT']['value'] = ra
+    cards['DEC_CUTOUT']['value'] = dec
+    return fitsio.FITSHDR(h)
+
+def is_scaled(header,options):
+    """ Whether a floating point extension is to be written as int16 with BSCALE/BZERO """
+    return options.get('dtype') == 'int16' and header.get('ZBITPIX',header['BITPIX']) < 0
+
+def cast_section(image,options,template=None):
+
+    """
+    Cast an image section to the dtype in options: 'float32', or
+    'int16', scaled to the full int16 range with the BSCALE/BZERO
+    updated in the header template when the input is floating point,
+    and the non-finite pixels set to INT16_BLANK
+    """
+    dtype = options.get('dtype')
+    if dtype is None:
+        return image
+    if dtype == 'int16' and image.dtype.kind == 'f':
+        h, cards = template
+        good = numpy.isfinite(image)
+        if good.any():
+            vmin, vmax = float(image[good].min()), float(image[good].max())
+        else:
+            vmin, vmax = 0.0, 0.0
+        bzero = 0.5*(vmax+vmin)
+        bscale = (vmax-vmin)/65000.0 if vmax > vmin else 1.0
+        cards['BSCALE']['value'] = bscale
+        cards['BZERO']['value'] = bzero
+        section = numpy.round((numpy.where(good,image,bzero)-bzero)/bscale).astype('i2')
+        section[~good] = INT16_BLANK
+        return section
+    return image.astype(dtype)
+
+def unscale_section(image,header):
+
+    """
+    Undo the int16 scaling of a section read back, as fitsio does on
+    read, and set its BLANK pixels to NaN, which fitsio does not. The
+    result has the floating point dtype of the original extension
+    """
+    if 'BSCALE' not in header:
+        return image
+    dtype = {-64: 'f8'}.get(header.get('ZBITPIX',header.get('BITPIX')),'f4')
+    if image.dtype.kind != 'f':
+        blank = image == header['BLANK'] if 'BLANK' in header else None
+        image = (image*header['BSCALE'] + header['BZERO']).astype(dtype)
+    else:
+        # Already scaled by fitsio, to the same value for all BLANK pixels
+        blank = None
+        if 'BLANK' in header:
+            blank = image == numpy.array(header['BLANK']*header['BSCALE'] + header['BZERO']).astype(image.dtype)
+    if blank is not None and blank.any():
+        image[blank] = numpy.nan
+    return image
+
+def write_section(ofits,image,EXTNAME,header,options):
+    """ Write a cutout extension with the compression in options, if any """
+    kw = {}
+    if options.get('compress'):
+        kw['compress'] = options['compress']
+        if 'qlevel' in options:
+            kw['qlevel'] = options['qlevel']
+    ofits.write(image,extname=EXTNAME,header=header,**kw)
+
 def check_inputs(ra,dec,xsize,ysize):
 
     """ Check and fix inputs for cutout"""
@@ -136,43 +262,354 @@ def get_thumbBaseName(ra,dec,prefix='DES'):
     outname = BASE_OUTNAME.format(**kw)
     return outname
 
+def get_thumbContainerName(tilename,filter,prefix='DES',ext='fits',outdir=os.getcwd()):
+    """ Common function to set the name of the file with all cutouts of a tile/band """
+    # DES tilenames already start with the prefix, do not double it
+    if tilename.startswith(prefix):
+        prefix = ''
+    kw = locals()
+    outname = CONTAINER_OUTNAME.format(**kw)
+    return outname
+
+
+def get_headers_hdus(filename,fits=None):
+
+    """
+    Get the headers and HDU numbers per EXTNAME. If fits, an already
+    open fitsio.FITS object for filename, is given it will be used
+    instead of opening the file again
+    """
+    if fits is None:
+        with fitsio.FITS(filename) as fits:
+            return get_headers_hdus(filename,fits=fits)
 
-def get_headers_hdus(filename):
-    
     header = OrderedDict()
     hdu = OrderedDict()   
 
     # Case 1 -- for well-defined fitsfiles with EXTNAME
-    with fitsio.FITS(filename) as fits:
-        for k in xrange(len(fits)):
-            h = fits[k].read_header()
-            
-            # Make sure that we can get the EXTNAME
-            if not h.get('EXTNAME'):
-                continue
-            extname = h['EXTNAME'].strip()
-            if extname == 'COMPRESSED_IMAGE':
-                continue
-            header[extname] = h
-            hdu[extname] = k
+    for k in xrange(len(fits)):
+        h = fits[k].read_header()
+
+        # Make sure that we can get the EXTNAME
+        if not h.get('EXTNAME'):
+            continue
+        extname = h['EXTNAME'].strip()
+        if extname == 'COMPRESSED_IMAGE':
+            continue
+        header[extname] = h
+        hdu[extname] = k
 
     # Case 2 -- older DESDM files without EXTNAME
     if len(header) < 1:
         (sci_hdu,wgt_hdu) = get_coadd_hdu_extensions_byfilename(filename)
-        fits = fitsio.FITS(filename)
         header['SCI'] = fits[sci_hdu].read_header()
         header['WGT'] = fits[wgt_hdu].read_header()
         hdu['SCI'] = sci_hdu
         hdu['WGT'] = wgt_hdu
 
     return header,hdu
+
+
+class FitsCache(object):
+
+    """
+    LRU cache of open fitsio.FITS objects and their parsed headers, HDU
+    numbers and WCS, keyed by filename and checked against the file
+    mtime. At most maxfiles files are kept open, the least recently
+    used ones are closed first. Each entry holds ~0.2MB (cfitsio buffers
+    and the parsed headers and WCS of a tile, compressed or not), so the
+    number of files is what bounds the memory of the cache. The cache
+    belongs to one process: after a fork the child starts with an empty
+    cache.
+    """
+
+    def __init__(self,maxfiles=8):
+        self.maxfiles = maxfiles
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.pid = os.getpid()
+
+    def get(self,filename):
+
+        """
+        Get the cached entry for filename as a dictionary with keys:
+        fits, header, hdu, wcs and mtime
+        """
+        # Never share open files with the parent process
+        if os.getpid() != self.pid:
+            self.entries = OrderedDict()
+            self.pid = os.getpid()
+
+        mtime = os.path.getmtime(filename)
+        entry = self.entries.pop(filename,None)
+        if entry is not None and entry['mtime'] == mtime:
+            self.hits += 1
+            self.entries[filename] = entry
+            return entry
+        if entry is not None:
+            self.close_entry(entry)
+
+        self.misses += 1
+        t0 = time.time()
+        fits = fitsio.FITS(filename,'r')
+        header, hdu = get_headers_hdus(filename,fits=fits)
+        metrics.METRICS.since('file_open',t0)
+        entry = {'fits': fits,
+                 'header': header,
+                 'hdu': hdu,
+                 'wcs': wcsutil.WCS(header['SCI']),
+                 'mtime': mtime}
+        self.entries[filename] = entry
+        self.evict()
+        return entry
+
+    def evict(self):
+        """ Close the least recently used files while over maxfiles """
+        while len(self.entries) > max(self.maxfiles,1):
+            filename, entry = self.entries.popitem(last=False)
+            self.close_entry(entry)
+
+    def close_entry(self,entry):
+        entry['fits'].close()
+
+    def clear(self):
+        while self.entries:
+            filename, entry = self.entries.popitem(last=False)
+            self.close_entry(entry)
+
+
+# The cache used by fitscutter in each process
+FITS_CACHE = FitsCache()
+
+
+def set_fits_cache(maxfiles=8):
+    """ Replace the cache used by fitscutter with one of the given size """
+    global FITS_CACHE
+    FITS_CACHE.clear()
+    FITS_CACHE = FitsCache(maxfiles=maxfiles)
+    return FITS_CACHE
         
 
-def fitscutter(filename, ra, dec, xsize=1.0, ysize=1.0, units='arcmin',prefix='DES',outdir=os.getcwd(),tilename=None,verb=False):
+# Layout of the pixel windows of the cutouts in a file
+WINDOW_DTYPE = [('x0','i4'),('y0','i4'),('x1','i4'),('x2','i4'),('y1','i4'),('y2','i4')]
+
+def get_image_size(header):
+    """ The size (NAXIS1, NAXIS2) of the image, also for tile-compressed HDUs """
+    if 'ZNAXIS1' in header:
+        return header['ZNAXIS1'], header['ZNAXIS2']
+    return header['NAXIS1'], header['NAXIS2']
+
+def get_cutout_windows(wcs,ra,dec,xsize,ysize,naxis1,naxis2,scale,pixelscale):
+
+    """
+    Compute the pixel windows of all cutouts at once, centered on the
+    nearest pixel of ra,dec and clipped symmetrically against the
+    edges of a naxis1 x naxis2 image. Returns a structured array with
+    the center (x0,y0) and the section [y1:y2,x1:x2] of each cutout
+    """
+    x0,y0 = wcs.sky2image(numpy.asarray(ra,dtype='f8'),numpy.asarray(dec,dtype='f8'))
+    # Round half away from zero, like round()
+    x0 = numpy.sign(x0)*numpy.floor(numpy.abs(x0)+0.5)
+    y0 = numpy.sign(y0)*numpy.floor(numpy.abs(y0)+0.5)
+    dx = (0.5*numpy.asarray(xsize,dtype='f8')*scale/pixelscale).astype(int)
+    dy = (0.5*numpy.asarray(ysize,dtype='f8')*scale/pixelscale).astype(int)
+
+    # Shrink the half-sizes of the windows that fall off the edges
+    dx = numpy.where(x0-dx < 0, x0, dx)
+    dx = numpy.where(x0+dx > naxis1, naxis1-x0, dx)
+    dy = numpy.where(y0-dy < 0, y0, dy)
+    dy = numpy.where(y0+dy > naxis2, naxis2-y0, dy)
+
+    windows = numpy.zeros(len(x0),dtype=WINDOW_DTYPE)
+    windows['x0'] = x0
+    windows['y0'] = y0
+    windows['x1'] = x0-dx
+    windows['x2'] = x0+dx
+    windows['y1'] = y0-dy
+    windows['y2'] = y0+dy
+    return windows
+
+
+class CutoutContainerMEF(object):
+
+    """
+    Writes all of the cutouts of a tile/band into a single
+    multi-extension FITS file. HDU 1 is an INDEX table with the NAME,
+    RA, DEC of each cutout and the HDU of its first extension, followed
+    by the extensions (SCI, WGT, ...) of every cutout in turn. Use
+    read_cutout_index() and read_cutout() to get them back.
+    """
+
+    ext = 'fits'
+
+    def __init__(self,filename,ncutouts,namelen=32):
+        self.filename = filename
+        self.index = numpy.zeros(ncutouts,dtype=[('NAME','S%d' % namelen),('RA','f8'),('DEC','f8'),
+                                                 ('HDU','i4'),('NEXT','i4')])
+        self.index['HDU'] = -1
+        self.ncutouts = 0
+        self.fits = fitsio.FITS(filename,'rw',clobber=True)
+        self.fits.write(None)
+        # Write the INDEX first so that it can be found right away, and
+        # fill it in on close()
+        self.fits.write(self.index,extname='INDEX')
+        self.nhdu = 2
+
+    def add(self,name,ra,dec,images,headers,ext_options={}):
+        """ Add the images and headers (dictionaries by EXTNAME) of one cutout """
+        k = self.ncutouts
+        self.index[k] = (name,ra,dec,self.nhdu,len(images))
+        for EXTNAME in images.keys():
+            write_section(self.fits,images[EXTNAME],EXTNAME,headers[EXTNAME],ext_options.get(EXTNAME,{}))
+        self.nhdu += len(images)
+        self.ncutouts += 1
+
+    def close(self):
+        self.fits[1].write(self.index)
+        self.fits.close()
+
+
+class CutoutContainerHDF5(object):
+
+    """
+    Writes all of the cutouts of a tile/band into a single HDF5 file,
+    with one group per cutout holding a dataset per EXTNAME (with the
+    FITS header as the 'header' attribute), and an INDEX dataset with
+    the same layout as for CutoutContainerMEF, where HDU is the group.
+    """
+
+    ext = 'h5'
+
+    def __init__(self,filename,ncutouts,namelen=32):
+        if h5py is None:
+            raise ImportError("ERROR: Need h5py to write cutouts to HDF5")
+        self.filename = filename
+        self.index = numpy.zeros(ncutouts,dtype=[('NAME','S%d' % namelen),('RA','f8'),('DEC','f8'),
+                                                 ('HDU','i4'),('NEXT','i4')])
+        self.index['HDU'] = -1
+        self.ncutouts = 0
+        self.h5 = h5py.File(filename,'w')
+
+    def add(self,name,ra,dec,images,headers,ext_options={}):
+        """ Add the images and headers (dictionaries by EXTNAME) of one cutout """
+        k = self.ncutouts
+        self.index[k] = (name,ra,dec,k,len(images))
+        group = self.h5.create_group(str(k))
+        group.attrs['EXTNAMES'] = ','.join(images.keys())
+        for EXTNAME in images.keys():
+            # Any compression maps to the gzip filter
+            if ext_options.get(EXTNAME,{}).get('compress'):
+                dset = group.create_dataset(EXTNAME,data=images[EXTNAME],compression='gzip')
+            else:
+                dset = group.create_dataset(EXTNAME,data=images[EXTNAME])
+            dset.attrs['header'] = str(headers[EXTNAME])
+        self.ncutouts += 1
+
+    def close(self):
+        self.h5.create_dataset('INDEX',data=self.index)
+        self.h5.close()
+
+
+# Formats for the cutouts of a tile/band in a single file
+CUTOUT_CONTAINERS = {'mef': CutoutContainerMEF,
+                     'hdf5': CutoutContainerHDF5}
+
+
+def read_cutout_index(filename):
+    """ Read the INDEX of a file written by CutoutContainerMEF/HDF5 """
+    if filename.endswith('.h5'):
+        with h5py.File(filename,'r') as h5:
+            return h5['INDEX'][:]
+    with fitsio.FITS(filename) as fits:
+        return fits[1].read()
+
+
+def read_cutout(filename,name,index=None):
+
+    """
+    Read one cutout by NAME (as in get_thumbBaseName) from a file
+    written by CutoutContainerMEF/HDF5. Returns an OrderedDict of
+    (image, header) by EXTNAME. Pass the index from read_cutout_index()
+    when reading many cutouts from the same file.
+    """
+    if index is None:
+        index = read_cutout_index(filename)
+    k = numpy.where(index['NAME'] == numpy.array(name,dtype=index['NAME'].dtype))[0]
+    if len(k) == 0:
+        raise KeyError("ERROR: Cannot find cutout %s in %s" % (name,filename))
+    hdu, next = index['HDU'][k[0]], index['NEXT'][k[0]]
+
+    cutout = OrderedDict()
+    if filename.endswith('.h5'):
+        with h5py.File(filename,'r') as h5:
+            group = h5[str(hdu)]
+            for EXTNAME in group.attrs['EXTNAMES'].split(','):
+                dset = group[EXTNAME]
+                cards = [card for card in dset.attrs['header'].split('\n') if card.strip()]
+                header = fitsio.FITSHDR(cards)
+                cutout[EXTNAME] = (unscale_section(dset[:],header),header)
+        return cutout
+    with fitsio.FITS(filename) as fits:
+        for n in range(hdu,hdu+next):
+            header = fits[n].read_header()
+            cutout[header['EXTNAME'].strip()] = (unscale_section(fits[n].read(),header),header)
+    return cutout
+
+
+def plan_section_reads(windows,maxpixels,gap=0):
+
+    """
+    Group the cutout windows into blocks to be read with a single
+    section read, so that overlapping or nearby cutouts do not read (and
+    decompress) the same pixels again. The windows are swept by row and
+    merged into an open block when they overlap it or are within gap
+    pixels of it, as long as the block stays under maxpixels. Returns a
+    list of ((y1,y2,x1,x2), indices) of the blocks and their windows
+    """
+    blocks = []
+    active = []
+    for k in numpy.lexsort((windows['x1'],windows['y1'])):
+        w = windows[k]
+        # Blocks that end above this row cannot be merged anymore
+        active = [b for b in active if b[1]+gap >= w['y1']]
+        for b in active:
+            if w['x1'] > b[3]+gap or w['x2']+gap < b[2]:
+                continue
+            y1,y2 = min(b[0],w['y1']), max(b[1],w['y2'])
+            x1,x2 = min(b[2],w['x1']), max(b[3],w['x2'])
+            if (y2-y1)*(x2-x1) > maxpixels:
+                continue
+            b[0:4] = [y1,y2,x1,x2]
+            b[4].append(k)
+            break
+        else:
+            b = [w['y1'],w['y2'],w['x1'],w['x2'],[k]]
+            blocks.append(b)
+            active.append(b)
+    return [(tuple(int(v) for v in b[0:4]),sorted(b[4])) for b in blocks]
+
+def get_pixel_bytes(header):
+    """ Number of bytes per pixel summed over all extensions """
+    nbytes = 0
+    for h in header.values():
+        nbytes += abs(h.get('ZBITPIX',h['BITPIX']))//8
+    return nbytes
+
+
+def fitscutter(filename, ra, dec, xsize=1.0, ysize=1.0, units='arcmin',prefix='DES',outdir=os.getcwd(),tilename=None,
+               read_block_mb=32,output='fits',ext_options={},return_sci=False,verb=False):
 
     """
     Makes cutouts around ra, dec for a give xsize and ysize
     ra,dec can be scalars or lists/arrays
+    With output='fits' each cutout is written to its own FITS file,
+    with output='mef' or 'hdf5' all of them go into a single file, and
+    with output=None nothing is written
+    ext_options has the compress/qlevel/dtype to write each EXTNAME with
+    With return_sci, returns the SCI sections as described in get_stamp_header()
+    With a cutoutcache.CUTOUT_CACHE set, single FITS cutouts already in
+    it are served from it without reading filename
     """
     # Check and fix inputs
     ra,dec,xsize,ysize = check_inputs(ra,dec,xsize,ysize)
@@ -187,23 +624,23 @@ def fitscutter(filename, ra, dec, xsize=1.0, ysize=1.0, units='arcmin',prefix='D
     else:
         sys.exit("ERROR: must define units as arcses/arcmin/degree only")
 
-    # Get header/extensions/hdu
-    header, hdunum = get_headers_hdus(filename)
+    # Get the open FITS object, header/extensions/hdu and WCS from the cache
+    cached = FITS_CACHE.get(filename)
+    ifits = cached['fits']
+    header = cached['header']
+    hdunum = cached['hdu']
+    wcs = cached['wcs']
     extnames = header.keys()
 
-    # Now we add the tilename to the headers -- if not already present
-    if tilename and 'TILENAME' not in header['SCI']:
-        if verb: SOUT.write("Will add TILENAME keyword to header for file: %s\n" % filename)
-        tile_rec = {'name': 'TILENAME', 'value':tilename, 'comment':'Name of DES parent TILENAME'}
-        for EXTNAME in extnames:
-            header[EXTNAME].add_record(tile_rec)
+    # The header templates, with the tilename added -- if not already present
+    if verb and tilename and 'TILENAME' not in header['SCI']:
+        SOUT.write("Will add TILENAME keyword to header for file: %s\n" % filename)
+    scaled = [EXTNAME for EXTNAME in extnames if is_scaled(header[EXTNAME],ext_options.get(EXTNAME,{}))]
+    templates = get_header_templates(header,tilename,scaled=scaled)
 
     # Get the pixel-scale of the input image
     pixelscale = astrometry.get_pixelscale(header['SCI'],units='arcsec')
 
-    # Read in the WCS with wcsutil
-    wcs = wcsutil.WCS(header['SCI'])
-
     # Extract the band/filter from the header
     if 'BAND' in header['SCI']:
         band = header['SCI']['BAND'].strip()
@@ -211,76 +648,142 @@ def fitscutter(filename, ra, dec, xsize=1.0, ysize=1.0, units='arcmin',prefix='D
         band = header['SCI']['FILTER'].strip()
     else:
         raise Exception("ERROR: Cannot provide suitable BAND/FILTER from SCI header")
-
-    # Intitialize the FITS object
-    ifits = fitsio.FITS(filename,'r')
+    tracing.set_tags(band=band)
+
+    # Compute the pixel windows of all cutouts against the size of the image
+    xL,yL = get_image_size(header['SCI'])
+    windows = get_cutout_windows(wcs,ra,dec,xsize,ysize,xL,yL,scale,pixelscale)
+
+    # Recompute CRVAL1/2 on the centers of the cutouts, the same for all extensions
+    crval1,crval2 = wcs.image2sky(windows['x0'].astype('f8'),windows['y0'].astype('f8'))
+    crval1 = numpy.asarray(crval1).tolist()
+    crval2 = numpy.asarray(crval2).tolist()
+
+    # Serve the single FITS cutouts already in the cutout cache
+    cache = cutoutcache.CUTOUT_CACHE
+    todo = numpy.arange(len(ra))
+    if cache is not None and output == 'fits':
+        file_id = cutoutcache.get_file_id(filename)
+        options = sorted([(EXTNAME,sorted(ext_options[EXTNAME].items())) for EXTNAME in ext_options])
+        keys = [cache.key('cutout',file_id,get_thumbBaseName(ra[k],dec[k],prefix=prefix),band,
+                          windows[k].tolist(),list(extnames),options,tilename) for k in range(len(ra))]
+        hits = numpy.array([cache.get(keys[k],get_thumbFitsName(ra[k],dec[k],band,prefix=prefix,outdir=outdir))
+                            for k in range(len(ra))],dtype=bool)
+        todo = todo[~hits]
+        if verb: SOUT.write("# Served %s cutouts from the cutout cache\n" % hits.sum())
+
+    # Plan the section reads, merging nearby cutouts into blocks
+    maxpixels = int(read_block_mb*1024**2)//get_pixel_bytes(header)
+    blocks = [(box,todo[indices].tolist()) for box,indices in plan_section_reads(windows[todo],maxpixels)]
+    if verb: SOUT.write("# Reading %s cutouts in %s sections\n" % (len(todo),len(blocks)))
+
+    # The SCI sections to return, in the order of ra,dec
+    if return_sci:
+        stamps = {'band': band,
+                  'names': [get_thumbBaseName(ra[k],dec[k],prefix=prefix) for k in range(len(ra))],
+                  'sci': [None]*len(ra),
+                  'header': get_header_templates(OrderedDict([('SCI',header['SCI'])]),tilename)['SCI'][0],
+                  'cards': [None]*len(ra)}
+        # The cutouts served from the cache are read back
+        for k in sorted(set(range(len(ra))) - set(todo.tolist())):
+            fitsthumb = get_thumbFitsName(ra[k],dec[k],band,prefix=prefix,outdir=outdir)
+            stamps['sci'][k] = unscale_section(*fitsio.read(fitsthumb,ext='SCI',header=True))
+            naxis2,naxis1 = stamps['sci'][k].shape
+            stamps['cards'][k] = [crval1[k],crval2[k],int(naxis1/2.0),int(naxis2/2.0),ra[k],dec[k]]
+
+    # The single file for all of the cutouts
+    if output not in ('fits',None):
+        if not tilename:
+            tilename = os.path.basename(filename).split('.')[0]
+        Container = CUTOUT_CONTAINERS[output]
+        outname = get_thumbContainerName(tilename,band,prefix=prefix,ext=Container.ext,outdir=outdir)
+        container = Container(outname,len(ra))
 
     ######################################
-    # Loop over ra/dec and xsize,ysize
-    for k in range(len(ra)):
-
-        # Define the geometry of the thumbnail
-        x0,y0 = wcs.sky2image(ra[k],dec[k])
-        yL = 10000
-        xL = 10000
-        x0 = round(x0)
-        y0 = round(y0)
-        dx = int(0.5*xsize[k]*scale/pixelscale)
-        dy = int(0.5*ysize[k]*scale/pixelscale)
-        naxis1 = 2*dx#+1
-        naxis2 = 2*dy#+1
-        y1 = y0-dy
-        y2 = y0+dy
-        x1 = x0-dx
-        x2 = x0+dx
-
-        if y1<0:
-            y1 = 0
-            dy = y0
-            y2 = y0 + dy
-        if y2 > yL:
-            y2 = yL
-            dy = yL - y0
-            y1 = y0-dy
-        
-        if x1<0:
-            x1 = 0
-            dx = x0
-            x2 = x0 + dx
-        if x2 > xL:
-            x2 = xL
-            dx = xL - x0
-            x1 = x0 - dx
-          
-
-        im_section = OrderedDict()
-        h_section  = OrderedDict()
-        for EXTNAME in extnames:
-            # The hdunum for that extname
-            HDUNUM = hdunum[EXTNAME]
-            # Create a canvas
-            im_section[EXTNAME] = numpy.zeros((naxis1,naxis2))
-            # Read in the image section we want for SCI/WGT
-            im_section[EXTNAME] = ifits[HDUNUM][int(y1):int(y2),int(x1):int(x2)]
-            # Correct NAXIS1 and NAXIS2
-            naxis1 = numpy.shape(im_section[EXTNAME])[1]
-            naxis2 = numpy.shape(im_section[EXTNAME])[0]
-            # Update the WCS in the headers and make a copy
-            h_section[EXTNAME] = update_wcs_matrix(header[EXTNAME],x0,y0,naxis1,naxis2,ra[k],dec[k])
-
-        # Construct the name of the Thumbmail using BAND/FILTER/prefix/etc
-        outname = get_thumbFitsName(ra[k],dec[k],band,prefix=prefix,outdir=outdir)
-
-        # Write out the file
-        ofits = fitsio.FITS(outname,'rw',clobber=True)
+    # Loop over the blocks and the cutout windows in each block
+    for (by1,by2,bx1,bx2),indices in blocks:
+
+        # Read in the block for all extensions
+        t0 = time.time()
+        im_block = OrderedDict()
         for EXTNAME in extnames:
-            ofits.write(im_section[EXTNAME],extname=EXTNAME,header=h_section[EXTNAME])
-            
-        ofits.close()
-        if verb: SOUT.write("# Wrote: %s\n" % outname)
-      
+            im_block[EXTNAME] = ifits[hdunum[EXTNAME]][by1:by2,bx1:bx2]
+        metrics.METRICS.since('pixel_read',t0,sum([im.nbytes for im in im_block.values()]))
+
+        for k in indices:
+
+            t0 = time.time()
+            x0,y0,x1,x2,y1,y2 = windows[k].tolist()
+            im_section = OrderedDict()
+            for EXTNAME in extnames:
+                # Cut the image section we want for SCI/WGT from the block
+                im_section[EXTNAME] = numpy.ascontiguousarray(im_block[EXTNAME][y1-by1:y2-by1,x1-bx1:x2-bx1])
+                if return_sci and EXTNAME == 'SCI':
+                    stamps['sci'][k] = im_section['SCI']
+                    naxis2,naxis1 = im_section['SCI'].shape
+                    stamps['cards'][k] = [crval1[k],crval2[k],int(naxis1/2.0),int(naxis2/2.0),ra[k],dec[k]]
+                im_section[EXTNAME] = cast_section(im_section[EXTNAME],ext_options.get(EXTNAME,{}),templates[EXTNAME])
+            metrics.METRICS.since('cutout',t0)
+
+            if output is None:
+                continue
+
+            t0 = time.time()
+            if output != 'fits':
+                # Update the WCS in the header templates and add to the container
+                h_section = OrderedDict()
+                for EXTNAME in extnames:
+                    naxis2,naxis1 = im_section[EXTNAME].shape
+                    h_section[EXTNAME] = update_header_template(templates[EXTNAME],crval1[k],crval2[k],
+                                                                naxis1,naxis2,ra[k],dec[k])
+                container.add(get_thumbBaseName(ra[k],dec[k],prefix=prefix),ra[k],dec[k],
+                              im_section,h_section,ext_options)
+                metrics.METRICS.since('fits_write',t0,sum([im.nbytes for im in im_section.values()]))
+                continue
+
+            # Construct the name of the Thumbmail using BAND/FILTER/prefix/etc
+            outname = get_thumbFitsName(ra[k],dec[k],band,prefix=prefix,outdir=outdir)
+
+            # Write out the file under a temporary name, and move it into
+            # place once complete, so that no partial file is ever cached
+            tmpname = cutoutcache.get_tmpname(outname)
+            ofits = fitsio.FITS(tmpname,'rw',clobber=True)
+            for EXTNAME in extnames:
+                # Update the WCS in the header template
+                naxis2,naxis1 = im_section[EXTNAME].shape
+                h = update_header_template(templates[EXTNAME],crval1[k],crval2[k],naxis1,naxis2,ra[k],dec[k])
+                write_section(ofits,im_section[EXTNAME],EXTNAME,h,ext_options.get(EXTNAME,{}))
+
+            ofits.close()
+            os.rename(tmpname,outname)
+            metrics.METRICS.since('fits_write',t0,os.path.getsize(outname))
+            if verb: SOUT.write("# Wrote: %s\n" % outname)
+            if cache is not None:
+                cache.put(keys[k],outname)
+
+    if output not in ('fits',None):
+        container.close()
+        if verb: SOUT.write("# Wrote %s cutouts to: %s\n" % (len(ra),container.filename))
+    if return_sci:
+        return stamps
     return
 
+def get_stamp_header(stamps,k):
+
+    """
+    Get the full header of the k-th SCI section returned by fitscutter
+    with return_sci=True, a dictionary with the band, the names of the
+    thumbnails (as get_thumbBaseName), the sci arrays, the SCI header
+    template and the values of the CUTOUT_KEYS for each section
+    """
+    import copy
+    h = copy.deepcopy(stamps['header'])
+    values = dict(zip(CUTOUT_KEYS,stamps['cards'][k]))
+    for rec in h.records():
+        if rec['name'] in values:
+            rec['value'] = values[rec['name']]
+    return h
+
 def get_stiff_parameter_set(tiffname,**kwargs):
     """
     Set the Stiff default options and have the options to
@@ -306,17 +809,82 @@ def make_stiff_call(fitsfiles,tiffname,stiff_parameters={},list=False):
     for fname in fitsfiles:
         cmd_list.append( "%s" % fname)
         
+    if list:
+        # One element per argument, to run without a shell
+        cmd_list.extend(["-c", stiff_conf])
+        for param,value in pars.items():
+            cmd_list.extend(["-%s" % param, "%s" % value])
+        return cmd_list
+
     cmd_list.append("-c %s" % stiff_conf)
     for param,value in pars.items():
         cmd_list.append("-%s %s" % (param,value))
-
-    if list:
-        cmd = cmd_list
-    else:
-        cmd = ' '.join(cmd_list)
+    cmd = ' '.join(cmd_list)
     return cmd
 
 
+class StiffExecutor(object):
+
+    """
+    Runs up to njobs stiff processes at the same time, without a shell.
+    The output of each run is collected and appended, together with its
+    exit status, to a single logfile. If given, done() is called after
+    a run succeeds. Call join() to wait for all of them, it returns the
+    list of (name, status) of the failed runs.
+    """
+
+    def __init__(self,njobs=1,logfile=None):
+        self.njobs = njobs
+        self.logfile = logfile
+        self.running = []
+        self.status = []
+
+    def submit(self,cmd,name,done=None):
+        """ Start cmd (a list) once there is a free slot """
+        while len(self.running) >= self.njobs:
+            self.wait_one()
+        log = tempfile.TemporaryFile()
+        # The free slot of the run, its track in the trace
+        slot = min(set(range(self.njobs)) - set([job[5] for job in self.running]))
+        proc = subprocess.Popen(cmd,stdout=log,stderr=subprocess.STDOUT)
+        self.running.append((name,proc,log,time.time(),done,slot))
+
+    def wait_one(self):
+        """ Wait for any of the running processes to finish """
+        while True:
+            for job in self.running:
+                if job[1].poll() is not None:
+                    self.running.remove(job)
+                    self.finish(job)
+                    return
+            time.sleep(0.01)
+
+    def finish(self,job):
+        name, proc, log, t0, done, slot = job
+        # The stiff runs overlap, each slot goes on its own track of the trace
+        metrics.METRICS.since('color',t0,span=False)
+        tracing.add_span('stiff',t0,tid=slot+1,thread_name="stiff %s" % (slot+1),
+                         output=os.path.basename(name),stiff_pid=proc.pid,status=proc.returncode)
+        self.status.append((name,proc.returncode))
+        log.seek(0)
+        text = log.read()
+        log.close()
+        if proc.returncode != 0:
+            SOUT.write("# ERROR: stiff failed with status %s for %s\n" % (proc.returncode,name))
+        elif done is not None:
+            done()
+        if self.logfile:
+            # A single write per run, so that runs from other processes do not mix
+            with open(self.logfile,'ab') as out:
+                header = "# %s status:%s time:%s\n" % (name,proc.returncode,elapsed_time(t0))
+                out.write(header.encode() + text)
+
+    def join(self):
+        while self.running:
+            self.wait_one()
+        return [(name,status) for name,status in self.status if status != 0]
+
+
 def get_colorset(avail_bands,color_set=None):
     """
     Get the optimal color set for DES Survey for a set of available bands
@@ -339,7 +907,8 @@ def get_colorset(avail_bands,color_set=None):
         CSET=False 
     return CSET
 
-def color_radec(ra,dec,avail_bands,prefix='DES',colorset=['i','r','g'], stiff_parameters={},outdir=os.getcwd(),verb=False):
+def color_radec(ra,dec,avail_bands,prefix='DES',colorset=['i','r','g'], stiff_parameters={},outdir=os.getcwd(),
+                verb=False,executor=None):
 
     t0 = time.time()
 
@@ -359,17 +928,43 @@ def color_radec(ra,dec,avail_bands,prefix='DES',colorset=['i','r','g'], stiff_pa
     # Set the names of the input files
     fitsfiles = []
     for BAND in CSET:
-        fitsthumb = get_thumbFitsName(ra,dec,BAND,prefix='DES',ext='fits',outdir=outdir)
+        fitsthumb = get_thumbFitsName(ra,dec,BAND,prefix=prefix,ext='fits',outdir=outdir)
         fitsfiles.append( "%s" % fitsthumb)
 
-    # Build the cmd to call
+    # Serve the color image from the cutout cache, keyed on the contents of the thumbnails
+    cache = cutoutcache.CUTOUT_CACHE
+    if cache is not None:
+        stiff_conf = os.path.join(os.environ['DESTHUMBS_DIR'],'etc','default.stiff')
+        pars = get_stiff_parameter_set('',**stiff_parameters)
+        key = cache.key('stiff',[cutoutcache.digest_file(f) for f in fitsfiles],sorted(pars.items()),
+                        cutoutcache.digest_file(stiff_conf))
+        if cache.get(key,tiffname):
+            if verb: SOUT.write("# Served %s from the cutout cache\n" % tiffname)
+            return
+
+    # stiff writes under a temporary name, moved into place (and then
+    # cached) only once it succeeded
+    tmpname = cutoutcache.get_tmpname(tiffname)
+    def done():
+        os.rename(tmpname,tiffname)
+        if cache is not None:
+            cache.put(key,tiffname)
+
+    # Build the cmd to call, and hand it to the executor if we have one
+    cmd = make_stiff_call(fitsfiles,tmpname,stiff_parameters=stiff_parameters,list=True)
+    if executor is not None:
+        executor.submit(cmd,tiffname,done=done)
+        return
+
     logfile = get_thumbLogName(ra,dec,prefix=prefix,ext='stifflog',outdir=outdir)
     log = open(logfile,"w")
-    cmd = make_stiff_call(fitsfiles,tiffname,stiff_parameters={},list=False)
-    status = subprocess.call(cmd,shell=True,stdout=log, stderr=log)
+    status = subprocess.call(cmd,stdout=log, stderr=log)
+    log.close()
+    metrics.METRICS.since('color',t0)
     if status > 0:
         SOUT.write("***\nERROR while running Stiff***\n")
     else:
+        done()
         if verb: SOUT.write("# Total stiff time: %s\n" % elapsed_time(t0))
 
     ## ----------------------------------- ##
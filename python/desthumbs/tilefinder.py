@@ -5,6 +5,7 @@ Schema) for a set of positions (ra,dec)
 F. Menanteau, NCSA July 2015
 """
 
+import os
 import numpy
 import despyastro
 import sys
@@ -47,43 +48,77 @@ def find_tilename_id(id,tablename,dbh,schema='prod'):
 
     tilenames_dict = despyastro.query2dict_of_columns(QUERY_TILENAME_ID[schema].format(ID=id,TABLENAME=tablename),dbh,array=False)
     if len(tilenames_dict)<1:
-        SOUT.write("# WARNING: No tile found at ra:%s, dec:%s\n" % (ra,dec))
-        return False
+        SOUT.write("# WARNING: No tile found for COADD_OBJECTS_ID:%s\n" % id)
+        return False,None,None
     else:
         return tilenames_dict['TILENAME'][0],tilenames_dict['RA'][0],tilenames_dict['DEC'][0]
     return
 
 
-def find_tilenames_id(id,tablename,dbh,schema='prod'):
-
-    import numpy
+def query_tilenames_id(id,tablename,dbh,schema='prod',chunksize=1000,verb=False):
 
     """
-    Find the tilename for each id and bundle them as dictionaries per tilename
+    Resolve the TILENAME, RA and DEC of a list of COADD_OBJECTS_ID in
+    chunks, with one bound IN-list per chunk. Returns arrays aligned with
+    id, where missing ids have TILENAME=False and RA,DEC=NaN
     """
 
-    indices = {}
-    tilenames = []
-    tilenames_matched = []
-    ras = []
-    decs = []
-    for k in range(len(id)):
-        
-        tilename,ra,dec = find_tilename_id(id[k],tablename,dbh,schema=schema)
-        tilenames_matched.append(tilename)
-        if not tilename: # No tilename found
-            # Here we could do something to store the failed (ra,dec) pairs
-            continue
-        ras.append(ra)
-        decs.append(dec)
-        # Store unique values and initialize list of indices grouped by tilename
-        if tilename not in tilenames:
-            indices[tilename]  = []
-            tilenames.append(tilename)
+    QUERY_TILENAME_IDS = {}
+    QUERY_TILENAME_IDS['des_admin'] = """
+    select COADD_OBJECTS_ID as ID,TILENAME,RA,DEC from des_admin.{TABLENAME}@dessci
+           where COADD_OBJECTS_ID in ({BINDS})"""
+
+    QUERY_TILENAME_IDS['prod'] = """
+    select ID,TILENAME,ALPHAWIN_J2000 as RA,DELTAWIN_J2000 as DEC from prod.{TABLENAME}
+           where ID in ({BINDS})"""
+
+    # Query each distinct id only once
+    uids, inverse = numpy.unique(numpy.asarray(id),return_inverse=True)
+    if len(uids) == 0:
+        return numpy.empty(0,dtype=object), numpy.zeros(0), numpy.zeros(0)
+    nchunk = min(chunksize,len(uids))
+    binds = ", ".join([":%d" % (k+1) for k in range(nchunk)])
+    query = QUERY_TILENAME_IDS[schema].format(TABLENAME=tablename,BINDS=binds)
+    if verb: SOUT.write("# Resolving %s COADD_OBJECTS_ID in chunks of %s\n" % (len(uids),nchunk))
+
+    tilename = numpy.empty(len(uids),dtype=object)
+    tilename[:] = False
+    ra = numpy.zeros(len(uids)) + numpy.nan
+    dec = numpy.zeros(len(uids)) + numpy.nan
+    cur = dbh.cursor()
+    for k in range(0,len(uids),nchunk):
+        chunk = uids[k:k+nchunk].tolist()
+        # Pad the last chunk, so the same SQL statement is used for all chunks
+        chunk = chunk + [chunk[-1]]*(nchunk-len(chunk))
+        cur.execute(query,chunk)
+        for rid,rtilename,rra,rdec in cur.fetchall():
+            j = numpy.searchsorted(uids,rid)
+            tilename[j] = rtilename
+            ra[j] = rra
+            dec[j] = rdec
+    cur.close()
 
-        indices[tilename].append(k)
+    # Report all of the missing ids at once
+    missing = uids[numpy.array([t is False for t in tilename],dtype=bool)]
+    if len(missing) > 0:
+        SOUT.write("# WARNING: %s COADD_OBJECTS_ID not found in %s: %s\n" %
+                   (len(missing),tablename,",".join([str(m) for m in missing])))
+
+    return tilename[inverse], ra[inverse], dec[inverse]
+
+
+def find_tilenames_id(id,tablename,dbh,schema='prod',chunksize=1000,verb=False):
+
+    """
+    Find the tilename for each id and bundle them as dictionaries per
+    tilename. The ras and decs returned are aligned with id
+    """
 
-    return tilenames, numpy.array(ras), numpy.array(decs), indices, tilenames_matched 
+    tilenames_matched, ras, decs = query_tilenames_id(id,tablename,dbh,schema=schema,
+                                                      chunksize=chunksize,verb=verb)
+    tilenames_matched = tilenames_matched.tolist()
+    tilenames, indices = group_by_tilename(tilenames_matched)
+    return tilenames, ras, decs, indices, tilenames_matched
 
 
 def find_tilename_radec(ra,dec,dbh,schema='prod'):
@@ -113,8 +148,9 @@ def find_tilename_radec(ra,dec,dbh,schema='prod'):
                  (CROSSRA0='Y' AND ({RA180} BETWEEN RACMIN-360 and RACMAX) AND ({DEC} BETWEEN DECCMIN and DECCMAX))
     """
 
+    # Wrap RA into (-180,180] to compare with tiles crossing RA=0
     if ra > 180:
-        ra180 = 360-ra
+        ra180 = ra-360
     else:
         ra180 = ra
     tilenames_dict = despyastro.query2dict_of_columns(QUERY_TILENAME_RADEC[schema].format(RA=ra,DEC=dec,RA180=ra180),dbh,array=False)
@@ -155,6 +191,304 @@ def find_tilenames_radec(ra,dec,dbh,schema='prod'):
     return tilenames, indices, tilenames_matched
 
 
+# Tile geometry (TILENAME, CROSSRA0, RACMIN, RACMAX, DECCMIN, DECCMAX) per
+# schema. For CROSSRA0='Y' tiles positions are matched against RACMIN-360 and RACMAX.
+# The old des_admin.COADDTILE table keeps the boundaries as URALL/URAUR/UDECLL/UDECUR
+TILEGEOM_TABLE = {}
+TILEGEOM_TABLE['des_admin'] = """(
+    select c.TILENAME, g.CROSSRA0,
+           c.URALL as RACMIN,
+           case when g.CROSSRA0='Y' then c.URAUR-360 else c.URAUR end as RACMAX,
+           c.UDECLL as DECCMIN, c.UDECUR as DECCMAX
+      from des_admin.COADDTILE c, prod.COADDTILE_GEOM g
+           where c.TILENAME=g.TILENAME)"""
+TILEGEOM_TABLE['prod'] = "prod.COADDTILE_GEOM"
+TILEGEOM_TABLE['dr1'] = "des_admin.DR1_TILE_INFO"
+
+# Global temporary table to upload positions, see make_tables.sql
+RADEC_TMPTABLE = "DESTHUMBS_RADEC"
+
+
+def get_tilegeom(dbh,schema='prod',verb=False):
+
+    """
+    Get the geometry of all tiles in a single query, sorted by TILENAME
+    """
+
+    QUERY_TILEGEOM = """
+    select TILENAME, CROSSRA0, RACMIN, RACMAX, DECCMIN, DECCMAX
+      from {TILEGEOM} order by TILENAME
+    """
+    query = QUERY_TILEGEOM.format(TILEGEOM=TILEGEOM_TABLE[schema])
+    if verb:
+        SOUT.write("# Getting the tile geometry with SQL query:\n********\n** %s\n********\n" % query)
+    rec = despyastro.query2rec(query,dbh)
+    return fix_tilegeom(rec)
+
+
+def find_tilenames_radec_batch(ra,dec,dbh,schema='prod',chunksize=50000,verb=False):
+
+    """
+    Find the tilename for each ra,dec with a single join on the DB
+    side. All positions are uploaded with executemany() into the global
+    temporary table RADEC_TMPTABLE and matched against the tile
+    geometry in one query, streamed back grouped by TILENAME. Returns
+    the same as find_tilenames_radec()
+    """
+
+    ra = numpy.atleast_1d(numpy.asarray(ra,dtype=numpy.float64))
+    dec = numpy.atleast_1d(numpy.asarray(dec,dtype=numpy.float64))
+    if (ra < 0).any():
+        exit("ERROR: Please provide RA>0 and RA<360")
+    # Wrap RA into (-180,180] to compare with tiles crossing RA=0
+    ra180 = numpy.where(ra > 180,ra-360,ra)
+
+    INSERT_RADEC = "insert into {TMPTABLE} (IDX, RA, DEC, RA180) values (:1, :2, :3, :4)"
+
+    QUERY_TILENAME_RADEC = """
+    select p.IDX, g.TILENAME from {TMPTABLE} p, {TILEGEOM} g
+           where (g.CROSSRA0='N' AND (p.RA BETWEEN g.RACMIN and g.RACMAX) AND (p.DEC BETWEEN g.DECCMIN and g.DECCMAX)) OR
+                 (g.CROSSRA0='Y' AND (p.RA180 BETWEEN g.RACMIN-360 and g.RACMAX) AND (p.DEC BETWEEN g.DECCMIN and g.DECCMAX))
+           order by g.TILENAME, p.IDX
+    """
+
+    cur = dbh.cursor()
+    # Upload all of the positions with bind arrays -- one parse for all rows
+    insert = INSERT_RADEC.format(TMPTABLE=RADEC_TMPTABLE)
+    rows = list(zip(range(len(ra)),ra.tolist(),dec.tolist(),ra180.tolist()))
+    for k in range(0,len(rows),chunksize):
+        cur.executemany(insert,rows[k:k+chunksize])
+    if verb: SOUT.write("# Uploaded %s positions into %s\n" % (len(rows),RADEC_TMPTABLE))
+
+    query = QUERY_TILENAME_RADEC.format(TMPTABLE=RADEC_TMPTABLE,TILEGEOM=TILEGEOM_TABLE[schema])
+    if verb: SOUT.write("# Will execute the SQL query:\n********\n** %s\n********\n" % query)
+    cur.arraysize = chunksize
+    cur.execute(query)
+
+    # Rows come grouped by TILENAME; when tiles overlap the first TILENAME wins
+    itile = numpy.zeros(len(ra),dtype=int) - 1
+    names = []
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            break
+        for idx,tilename in rows:
+            if not names or names[-1] != tilename:
+                names.append(tilename)
+            if itile[idx] < 0:
+                itile[idx] = len(names)-1
+    cur.close()
+    # The temporary table is emptied on commit
+    dbh.commit()
+
+    names = numpy.array(names,dtype=object)
+    matched = numpy.empty(len(ra),dtype=object)
+    matched[:] = False
+    found = itile >= 0
+    matched[found] = names[itile[found]]
+    for k in numpy.nonzero(~found)[0]:
+        SOUT.write("# WARNING: No tile found at ra:%s, dec:%s\n" % (ra[k],dec[k]))
+
+    tilenames, indices = group_by_tileindex(itile,names)
+    return tilenames, indices, matched.tolist()
+
+
+def fix_tilegeom(rec):
+
+    """
+    Cast a tile geometry record array into fixed-width types, so it can
+    be saved with numpy and used by TileGeomIndex
+    """
+    tilename = numpy.array([str(t).strip() for t in rec['TILENAME']])
+    crossra0 = numpy.array([str(c).strip() for c in rec['CROSSRA0']])
+    cols = [tilename, crossra0]
+    for name in ('RACMIN','RACMAX','DECCMIN','DECCMAX'):
+        cols.append(numpy.asarray(rec[name],dtype=numpy.float64))
+    return numpy.rec.fromarrays(cols,names='TILENAME,CROSSRA0,RACMIN,RACMAX,DECCMIN,DECCMAX')
+
+
+def write_tilegeom(filename,tilegeom):
+    """ Write a snapshot of the tile geometry into a .npy file """
+    numpy.save(filename,numpy.asarray(tilegeom))
+    SOUT.write("# Wrote tile geometry snapshot to: %s\n" % filename)
+    return
+
+
+def read_tilegeom(filename):
+    """ Read a snapshot of the tile geometry written by write_tilegeom() """
+    return numpy.load(filename).view(numpy.recarray)
+
+
+def load_tilegeom(dbh=None,schema='prod',snapshot=None,verb=False):
+
+    """
+    Load the tile geometry once, either from a snapshot file or from
+    the DB. If snapshot is given but does not exist yet, it will be
+    written after querying the DB.
+    """
+    if snapshot and os.path.exists(snapshot):
+        if verb: SOUT.write("# Reading tile geometry snapshot: %s\n" % snapshot)
+        return read_tilegeom(snapshot)
+
+    tilegeom = get_tilegeom(dbh,schema=schema,verb=verb)
+    if snapshot:
+        write_tilegeom(snapshot,tilegeom)
+    return tilegeom
+
+
+def group_by_tilename(tilenames_matched):
+
+    """
+    Bundle the positions matched to each tilename, preserving the order
+    in which each tilename first appears
+    """
+    matched = numpy.asarray(tilenames_matched,dtype=object)
+    found = numpy.array([t is not False for t in matched],dtype=bool)
+    itile = numpy.zeros(len(matched),dtype=int) - 1
+    if not found.any():
+        return [], {}
+    uniq, itile[found] = numpy.unique(matched[found].astype(str),return_inverse=True)
+    return group_by_tileindex(itile,uniq)
+
+
+def group_by_tileindex(itile,names):
+
+    """
+    Same as group_by_tilename(), but for the integer index itile of each
+    position into names (-1 if not matched)
+    """
+    k_found = numpy.nonzero(itile >= 0)[0]
+    if len(k_found) == 0:
+        return [], {}
+
+    # Sort positions by tile keeping their input order within each tile
+    order = numpy.argsort(itile[k_found],kind='mergesort')
+    keys = itile[k_found][order]
+    starts = numpy.nonzero(numpy.r_[True,keys[1:] != keys[:-1]])[0]
+    bounds = numpy.r_[starts,len(keys)]
+
+    indices = {}
+    for u in range(len(starts)):
+        indices[str(names[keys[starts[u]]])] = k_found[order[bounds[u]:bounds[u+1]]]
+    # The first position of each tile comes first after the stable sort
+    first = k_found[order[starts]]
+    tilenames = [str(names[keys[starts[u]]]) for u in numpy.argsort(first)]
+    return tilenames, indices
+
+
+class TileGeomIndex(object):
+
+    """
+    In-memory index of the tile geometry to resolve the tilename of
+    many (ra,dec) positions in one vectorized pass. Tiles are bucketed
+    into cells of cellsize x cellsize degrees, so each position is only
+    tested against the few tiles overlapping its own cell.
+    """
+
+    def __init__(self,tilegeom,cellsize=1.0):
+
+        self.tilegeom = tilegeom
+        self.tilenames = numpy.asarray(tilegeom['TILENAME']).astype(str)
+        self.crossra0 = numpy.asarray(tilegeom['CROSSRA0']).astype(str) == 'Y'
+        self.racmin = numpy.asarray(tilegeom['RACMIN'],dtype=numpy.float64)
+        self.racmax = numpy.asarray(tilegeom['RACMAX'],dtype=numpy.float64)
+        self.deccmin = numpy.asarray(tilegeom['DECCMIN'],dtype=numpy.float64)
+        self.deccmax = numpy.asarray(tilegeom['DECCMAX'],dtype=numpy.float64)
+        self.cellsize = cellsize
+        self.nra = int(numpy.ceil(360./cellsize))
+        self.ndec = int(numpy.ceil(180./cellsize))
+
+        # RA interval of each tile, starting below zero for CROSSRA0 tiles
+        ralo = numpy.where(self.crossra0,self.racmin-360,self.racmin)
+        ira1 = numpy.floor(ralo/cellsize).astype(int)
+        ira2 = numpy.floor(self.racmax/cellsize).astype(int)
+        idec1 = self.dec_cell(self.deccmin)
+        idec2 = self.dec_cell(self.deccmax)
+
+        # Build the (cell, tile) pairs, sorted by cell and then tile
+        cells = []
+        tiles = []
+        for k in range(len(self.tilenames)):
+            ira = numpy.arange(ira1[k],ira2[k]+1) % self.nra
+            idec = numpy.arange(idec1[k],idec2[k]+1)
+            c = (idec[:,None]*self.nra + ira[None,:]).ravel()
+            cells.append(c)
+            tiles.append(numpy.zeros(len(c),dtype=int)+k)
+        cells = numpy.concatenate(cells) if cells else numpy.zeros(0,dtype=int)
+        tiles = numpy.concatenate(tiles) if tiles else numpy.zeros(0,dtype=int)
+        order = numpy.lexsort((tiles,cells))
+        self.cell_tiles = tiles[order]
+        self.cell_start = numpy.searchsorted(cells[order],numpy.arange(self.nra*self.ndec+1))
+
+    def dec_cell(self,dec):
+        idec = numpy.floor((numpy.asarray(dec)+90.)/self.cellsize).astype(int)
+        return numpy.clip(idec,0,self.ndec-1)
+
+    def ra_cell(self,ra):
+        return numpy.floor(numpy.asarray(ra)/self.cellsize).astype(int) % self.nra
+
+    def match(self,ra,dec):
+
+        """
+        Return the row in the tile geometry for each ra,dec, or -1 if no
+        tile contains it. When tiles overlap, the first one by TILENAME wins
+        """
+        ra = numpy.atleast_1d(numpy.asarray(ra,dtype=numpy.float64))
+        dec = numpy.atleast_1d(numpy.asarray(dec,dtype=numpy.float64))
+        # Wrap RA into (-180,180] to compare with tiles crossing RA=0
+        ra180 = numpy.where(ra > 180,ra-360,ra)
+
+        cell = self.dec_cell(dec)*self.nra + self.ra_cell(ra)
+        start = self.cell_start[cell]
+        ncand = self.cell_start[cell+1] - start
+        itile = numpy.zeros(len(ra),dtype=int) - 1
+        for j in range(ncand.max() if len(ra) > 0 else 0):
+            k = numpy.nonzero((itile < 0) & (ncand > j))[0]
+            if len(k) == 0:
+                break
+            t = self.cell_tiles[start[k]+j]
+            inside_dec = (dec[k] >= self.deccmin[t]) & (dec[k] <= self.deccmax[t])
+            inside_ra = numpy.where(self.crossra0[t],
+                                    (ra180[k] >= self.racmin[t]-360) & (ra180[k] <= self.racmax[t]),
+                                    (ra[k] >= self.racmin[t]) & (ra[k] <= self.racmax[t]))
+            inside = inside_dec & inside_ra
+            itile[k[inside]] = t[inside]
+        return itile
+
+    def find_tilenames(self,ra,dec):
+
+        """
+        Find the tilename for each ra,dec and bundle them as dictionaries
+        per tilename, same as find_tilenames_radec()
+        """
+        ra = numpy.atleast_1d(numpy.asarray(ra,dtype=numpy.float64))
+        dec = numpy.atleast_1d(numpy.asarray(dec,dtype=numpy.float64))
+        if (ra < 0).any():
+            exit("ERROR: Please provide RA>0 and RA<360")
+
+        itile = self.match(ra,dec)
+        matched = numpy.empty(len(ra),dtype=object)
+        matched[:] = False
+        found = itile >= 0
+        matched[found] = self.tilenames[itile[found]]
+        for k in numpy.nonzero(~found)[0]:
+            SOUT.write("# WARNING: No tile found at ra:%s, dec:%s\n" % (ra[k],dec[k]))
+
+        tilenames, indices = group_by_tileindex(itile,self.tilenames)
+        return tilenames, indices, matched.tolist()
+
+
+def find_tilenames_radec_tilegeom(ra,dec,tilegeom):
+
+    """
+    Find the tilename for each ra,dec using the tile geometry loaded in
+    memory (see load_tilegeom) instead of one query per position
+    """
+    if not isinstance(tilegeom,TileGeomIndex):
+        tilegeom = TileGeomIndex(tilegeom)
+    return tilegeom.find_tilenames(ra,dec)
+
+
 def get_coaddfiles_tilename_bytag(tilename,dbh,tag,bands='all',schema='prod'):
 
 
@@ -223,6 +557,90 @@ def get_coaddfiles_tilename_bytag(tilename,dbh,tag,bands='all',schema='prod'):
     # Return a record array with the query
     return rec 
 
+def get_coaddfiles_tilenames_bytag(tilenames,dbh,tag,bands='all',schema='prod',chunksize=1000,verb=False):
+
+    """
+    Bulk version of get_coaddfiles_tilename_bytag() for a list of
+    tilenames. The file rows for all tiles are fetched in chunks with a
+    bound IN-list, and returned as a dictionary of record arrays keyed
+    by tilename, with the COMPRESSION already fixed. Tiles without files
+    in the tag are not present in the dictionary.
+    """
+
+    QUERY_COADDFILES = {}
+
+    QUERY_COADDFILES['des_admin'] = """
+    select distinct f.path, TILENAME, BAND from des_admin.COADD c, des_admin.filepath_desar f
+             where
+             {and_BANDS}
+             c.TILENAME in ({BINDS}) and
+             f.ID=c.ID and
+             c.RUN in (select RUN from des_admin.RUNTAG where TAG='{TAG}')"""
+
+    QUERY_COADDFILES['prod'] = """
+    select c.FILENAME, c.TILENAME, c.BAND, f.PATH, f.COMPRESSION from prod.COADD c, prod.PROCTAG, prod.FILE_ARCHIVE_INFO f
+            where
+              {and_BANDS}
+              prod.PROCTAG.TAG='{TAG}' and
+              c.PFW_ATTEMPT_ID=PROCTAG.PFW_ATTEMPT_ID and
+              f.FILENAME=c.FILENAME and
+              c.TILENAME in ({BINDS})"""
+
+    QUERY_COADDFILES['dr1'] = """
+    select TILENAME, {FITS_IMAGES}
+       from des_admin.DR1_TILE_INFO
+       where TILENAME in ({BINDS})
+       """
+
+    if bands == 'all':
+        and_BANDS = {'des_admin': "c.BAND IS NOT NULL and", 'prod': "", 'dr1': ""}[schema]
+        fits_images = ", ".join(["FITS_IMAGE_{}".format(band) for band in ['DET','G','R','I','Z','Y']])
+    else:
+        sbands = "'" + "','".join(bands) + "'"  # trick to format
+        and_BANDS = "c.BAND in ({BANDS}) and".format(BANDS=sbands)
+        fits_images = ", ".join(["FITS_IMAGE_{}".format(band.upper()) for band in bands])
+
+    tilenames = list(tilenames)
+    if len(tilenames) == 0:
+        return {}
+    nchunk = min(chunksize,len(tilenames))
+    binds = ", ".join([":%d" % (k+1) for k in range(nchunk)])
+    query = QUERY_COADDFILES[schema].format(TAG=tag,and_BANDS=and_BANDS,FITS_IMAGES=fits_images,BINDS=binds)
+    if verb:
+        SOUT.write("# Getting files for %s tiles in chunks of %s with the SQL query:\n********\n** %s\n********\n" %
+                   (len(tilenames),nchunk,query))
+
+    cur = dbh.cursor()
+    cur.arraysize = 5000
+    tuples = []
+    for k in range(0,len(tilenames),nchunk):
+        chunk = tilenames[k:k+nchunk]
+        # Pad the last chunk, so the same SQL statement is used for all chunks
+        chunk = chunk + [chunk[-1]]*(nchunk-len(chunk))
+        cur.execute(query,chunk)
+        tuples.extend(cur.fetchall())
+    names = [d[0].upper() for d in cur.description]
+    cur.close()
+
+    if not tuples:
+        return {}
+    rec = fix_compression(numpy.rec.array(tuples,names=names))
+
+    # Split into one record array per tile
+    uniq, inverse = numpy.unique(rec['TILENAME'].astype(str),return_inverse=True)
+    order = numpy.argsort(inverse,kind='mergesort')
+    bounds = numpy.searchsorted(inverse[order],numpy.arange(len(uniq)+1))
+    coaddfiles = {}
+    for u in range(len(uniq)):
+        tile_rec = rec[order[bounds[u]:bounds[u+1]]]
+        if schema == 'dr1':
+            # Keep the same layout as get_coaddfiles_tilename_bytag()
+            cols = [n for n in names if n != 'TILENAME']
+            tile_rec = numpy.rec.fromarrays([tile_rec[n] for n in cols],names=cols)
+        coaddfiles[str(uniq[u])] = tile_rec
+    return coaddfiles
+
+
 def get_avail_bands_dr1(filenames):
     ''' Get the available bands for the DR1 query '''
 
@@ -0,0 +1,146 @@
+"""
+Timeline tracing of a run (--trace): a span for each timed stage (DB
+queries, file open, section read, cutting, write, color and each stiff
+call) and for each task, tagged with the tile, band and kind of task,
+on the process and thread where it ran. Each process appends its spans
+to its own JSON lines file after each task, and they are merged at the
+end of the run into one trace in the Chrome trace event format, which
+can be loaded in chrome://tracing or https://ui.perfetto.dev
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import threading
+
+SOUT = sys.stdout
+
+# The directory of the per-process spans, None when not tracing. Set
+# before the workers start, so that they inherit it and TRACE_T0
+TRACING = None
+TRACE_T0 = 0.0
+
+# The tracer of this process
+TRACER = None
+
+TRACE_NAME = 'desthumbs_trace.json'
+
+
+class Tracer(object):
+
+    """
+    The spans of one process, as Chrome trace 'X' (complete) events,
+    kept in memory until flush() appends them to
+    desthumbs_trace_<pid>.jsonl in dirname. The tags of each thread
+    are added to the args of the spans it adds
+    """
+
+    def __init__(self,dirname):
+        self.pid = os.getpid()
+        self.filename = os.path.join(dirname,"desthumbs_trace_%s.jsonl" % self.pid)
+        self.events = []
+        self.tags = {}
+        self.threads = {}
+
+    def add(self,name,t0,t1=None,tid=None,thread_name=None,**args):
+        """ Add the span name from t0 to t1 (now by default), on thread tid (this one by default) """
+        if t1 is None:
+            t1 = time.time()
+        thread = threading.current_thread()
+        args = dict(self.tags.get(thread.ident,{}),**args)
+        if tid is None:
+            tid, thread_name = thread.ident, thread.name
+        if tid not in self.threads:
+            self.threads[tid] = thread_name
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                'args': {'name': thread_name or str(tid)}})
+        self.events.append({'name': name, 'cat': 'desthumbs', 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                            'ts': round((t0-TRACE_T0)*1e6,1), 'dur': round((t1-t0)*1e6,1),
+                            'args': args})
+
+    def set_tags(self,**tags):
+        """ Tag the spans of this thread from now on """
+        self.tags.setdefault(threading.current_thread().ident,{}).update(tags)
+
+    def clear_tags(self):
+        self.tags.pop(threading.current_thread().ident,None)
+
+    def flush(self):
+        events, self.events = self.events, []
+        if len(events) == 0:
+            return
+        with open(self.filename,'a') as out:
+            out.write(''.join([json.dumps(event) + "\n" for event in events]))
+
+
+def set_tracing(dirname=None):
+
+    """
+    Turn on tracing into dirname, or off if None. Must be called
+    before the worker processes are started
+    """
+    global TRACING, TRACE_T0, TRACER
+    TRACER = None
+    if dirname is None:
+        TRACING = None
+        return
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    # Remove the spans of an earlier run
+    for filename in glob.glob(os.path.join(dirname,'desthumbs_trace_*.jsonl')):
+        os.remove(filename)
+    TRACING = dirname
+    TRACE_T0 = time.time()
+
+
+def get_tracer():
+    """ The Tracer of this process, None when not tracing """
+    global TRACER
+    if TRACING is None:
+        return None
+    # Forked workers start their own, without the spans of the parent
+    if TRACER is None or TRACER.pid != os.getpid():
+        TRACER = Tracer(TRACING)
+    return TRACER
+
+
+def add_span(name,t0,t1=None,**kwargs):
+    """ Add a span to the tracer of this process when tracing """
+    if TRACING is None:
+        return
+    get_tracer().add(name,t0,t1,**kwargs)
+
+
+def set_tags(**tags):
+    """ Tag the spans of this thread when tracing """
+    if TRACING is None:
+        return
+    get_tracer().set_tags(**tags)
+
+
+def merge_traces(dirname,filename,sout=None):
+
+    """
+    Merge the spans of all of the processes in dirname into filename,
+    as a Chrome trace with the processes named parent and worker
+    """
+    sout = sout or SOUT
+    parts = sorted(glob.glob(os.path.join(dirname,'desthumbs_trace_*.jsonl')))
+    nspans = 0
+    with open(filename,'w') as out:
+        out.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        for k,part in enumerate(parts):
+            pid = int(os.path.basename(part).split('_')[-1].split('.')[0])
+            name = 'parent' if pid == os.getpid() else 'worker'
+            out.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                                  'args': {'name': "%s %s" % (name,pid)}}))
+            for line in open(part):
+                if line.strip():
+                    out.write(",\n" + line.strip())
+                    nspans += 1
+            out.write(",\n" if k < len(parts)-1 else "\n")
+        out.write(']}\n')
+    sout.write("# Wrote %s trace events of %s processes to: %s\n" % (nspans,len(parts),filename))
+    return filename
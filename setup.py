@@ -11,9 +11,10 @@ setup(name='desthumbs',
       description = "A python module to make FITS files cutouts/thumbnails for DES",
       author = "Felipe Menanteau",
       author_email = "felipe@illinois.edu",
-      packages = ['desthumbs'],
+      packages = ['desthumbs','desthumbs.benchmarks'],
       package_dir = {'': 'python'},
-      scripts =  ['bin/makeDESthumbs'],
+      scripts =  ['bin/makeDESthumbs','bin/makeDESthumbsCatalog','bin/benchDESthumbsCutouts',
+                   'bin/benchDESthumbsTilematch'],
       data_files=[('ups',['ups/desthumbs.table']),
                   ('etc',  glob.glob("etc/*.*")),
                   ],
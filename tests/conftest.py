@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Use the package in the tree, after any already in the path
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'python'))
@@ -0,0 +1,44 @@
+"""
+The non-finite pixels of an extension written as scaled int16 must
+come back as NaN, and the finite ones within the scaling step.
+"""
+
+import os
+import glob
+import numpy
+import fitsio
+
+from desthumbs import thumbslib
+from desthumbs.benchmarks import synthetic
+
+
+def make_tile_with_nans(dirname):
+    files = synthetic.make_synthetic_tiles(str(dirname),bands=['g'],size=600,variants=['fits'])
+    filename = os.path.join(str(dirname),'nans.fits')
+    with fitsio.FITS(files['fits']['g']) as fits, fitsio.FITS(filename,'rw',clobber=True) as out:
+        for hdu in fits:
+            image, header = hdu.read(), hdu.read_header()
+            if header['EXTNAME'].strip() == 'SCI':
+                image[250:350,250:350] = numpy.nan
+                image[300,:] = numpy.inf
+            out.write(image,header=header,extname=header['EXTNAME'].strip())
+    return filename
+
+
+def test_int16_blank_pixels(tmpdir):
+    filename = make_tile_with_nans(tmpdir.join('tile'))
+    ra = numpy.array([10.0,10.004])
+    dec = numpy.array([0.0,0.004])
+    outdir = str(tmpdir.mkdir('out'))
+    stamps = thumbslib.fitscutter(filename,ra,dec,xsize=0.5,ysize=0.5,outdir=outdir,tilename='DES0000+0000',
+                                  output='mef',ext_options={'SCI': {'dtype': 'int16'}},return_sci=True)
+    container = glob.glob(os.path.join(outdir,'*_cutouts.fits'))[0]
+    index = thumbslib.read_cutout_index(container)
+    for k,name in enumerate(stamps['names']):
+        image, header = thumbslib.read_cutout(container,name,index)['SCI']
+        expected = stamps['sci'][k]
+        assert image.dtype == numpy.float32
+        good = numpy.isfinite(expected)
+        assert (~good).any()
+        assert numpy.array_equal(numpy.isnan(image),~good)
+        assert numpy.abs(image[good]-expected[good]).max() <= header['BSCALE']
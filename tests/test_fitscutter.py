@@ -0,0 +1,78 @@
+"""
+The cutouts of a file written by a single fitscutter call, from the
+header templates shared by all of them, must be byte for byte the same
+as the ones written one at a time, each from a fresh template, and away
+from the edges as the ones with the headers from update_wcs_matrix().
+"""
+
+import os
+import filecmp
+import numpy
+import fitsio
+
+from despyastro import astrometry
+from desthumbs import thumbslib
+from desthumbs.benchmarks import synthetic
+
+
+def make_tile(dirname):
+    files = synthetic.make_synthetic_tiles(str(dirname),bands=['g'],size=600,variants=['fits'])
+    return files['fits']['g']
+
+
+def test_cutouts_identical_to_single_writes(tmpdir):
+    filename = make_tile(tmpdir.join('tile'))
+    rng = numpy.random.RandomState(3)
+    ra = 10.0 + rng.uniform(-0.01,0.01,10)
+    dec = rng.uniform(-0.01,0.01,10)
+
+    together = str(tmpdir.mkdir('together'))
+    thumbslib.fitscutter(filename,ra,dec,xsize=0.3,ysize=0.3,outdir=together,tilename='DES0000+0000')
+    single = str(tmpdir.mkdir('single'))
+    for k in range(len(ra)):
+        thumbslib.fitscutter(filename,ra[k:k+1],dec[k:k+1],xsize=0.3,ysize=0.3,outdir=single,tilename='DES0000+0000')
+
+    names = sorted(os.listdir(single))
+    assert len(names) == len(ra)
+    assert sorted(os.listdir(together)) == names
+    for name in names:
+        assert filecmp.cmp(os.path.join(together,name),os.path.join(single,name),shallow=False), name
+
+
+def write_baseline_cutout(filename,ra,dec,size,outdir,tilename):
+    """ Write a cutout the way fitscutter did before the header templates """
+    header, hdunum = thumbslib.get_headers_hdus(filename)
+    tile_rec = {'name': 'TILENAME', 'value': tilename, 'comment': 'Name of DES parent TILENAME'}
+    if 'TILENAME' not in header['SCI']:
+        for EXTNAME in header.keys():
+            header[EXTNAME].add_record(tile_rec)
+    pixelscale = astrometry.get_pixelscale(header['SCI'],units='arcsec')
+    x0,y0 = thumbslib.wcsutil.WCS(header['SCI']).sky2image(ra,dec)
+    x0, y0 = round(x0), round(y0)
+    d = int(0.5*size*60/pixelscale)
+    outname = thumbslib.get_thumbFitsName(ra,dec,header['SCI']['BAND'].strip(),outdir=outdir)
+    with fitsio.FITS(filename) as ifits, fitsio.FITS(outname,'rw',clobber=True) as ofits:
+        for EXTNAME in header.keys():
+            image = ifits[hdunum[EXTNAME]][int(y0-d):int(y0+d),int(x0-d):int(x0+d)]
+            naxis2,naxis1 = image.shape
+            h = thumbslib.update_wcs_matrix(header[EXTNAME],x0,y0,naxis1,naxis2,ra,dec)
+            ofits.write(image,extname=EXTNAME,header=h)
+
+
+def test_cutouts_identical_to_update_wcs_matrix(tmpdir):
+    filename = make_tile(tmpdir.join('tile'))
+    rng = numpy.random.RandomState(5)
+    ra = 10.0 + rng.uniform(-0.01,0.01,10)
+    dec = rng.uniform(-0.01,0.01,10)
+
+    templates = str(tmpdir.mkdir('templates'))
+    thumbslib.fitscutter(filename,ra,dec,xsize=0.3,ysize=0.3,outdir=templates,tilename='DES0000+0000')
+    baseline = str(tmpdir.mkdir('baseline'))
+    for k in range(len(ra)):
+        write_baseline_cutout(filename,ra[k],dec[k],0.3,baseline,'DES0000+0000')
+
+    names = sorted(os.listdir(baseline))
+    assert len(names) == len(ra)
+    assert sorted(os.listdir(templates)) == names
+    for name in names:
+        assert filecmp.cmp(os.path.join(templates,name),os.path.join(baseline,name),shallow=False), name
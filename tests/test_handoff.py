@@ -0,0 +1,44 @@
+"""
+Each color task must only get the SCI sections of its own objects,
+whether they are passed as arrays or through shared memory.
+"""
+
+import numpy
+import pytest
+
+from desthumbs import handoff
+
+
+def make_stamps(band,names):
+    sci = [numpy.full((2+k,3),k,dtype='f4') for k in range(len(names))]
+    return {'band': band, 'names': list(names), 'sci': sci, 'header': None, 'cards': [None]*len(names)}
+
+
+def check_selection(stamps_list,names):
+    selected = handoff.select_stamps(stamps_list,names[1:3])
+    assert [stamps['names'] for stamps in selected] == [names[1:3]]*len(stamps_list)
+    shared = handoff.SharedStamps(selected)
+    try:
+        assert sorted(shared.images.keys()) == names[1:3]
+        for k in (1,2):
+            for stamps in stamps_list:
+                assert numpy.array_equal(shared.get(names[k])[stamps['band']],numpy.full((2+k,3),k,dtype='f4'))
+    finally:
+        shared.close()
+
+
+def test_select_arrays():
+    names = ['A','B','C','D']
+    check_selection([make_stamps('g',names),make_stamps('r',names)],names)
+
+
+@pytest.mark.skipif(handoff.shared_memory is None,reason="needs multiprocessing.shared_memory")
+def test_select_shared():
+    names = ['A','B','C','D']
+    stamps_list = [handoff.share_stamps(make_stamps('g',names)),handoff.share_stamps(make_stamps('r',names))]
+    try:
+        assert all(['sci' not in stamps for stamps in stamps_list])
+        check_selection(stamps_list,names)
+    finally:
+        for stamps in stamps_list:
+            handoff.release_stamps(stamps)
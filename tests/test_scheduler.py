@@ -0,0 +1,31 @@
+"""
+A task whose result cannot be sent back from its worker must be
+reported as failed, without leaving the scheduler waiting for it.
+"""
+
+import threading
+
+from desthumbs import scheduler
+
+
+def unpicklable(n):
+    return threading.Lock()
+
+
+def square(n):
+    return n*n
+
+
+def test_unpicklable_result_is_an_error():
+    tasks = scheduler.TileScheduler(nprocs=2)
+    tasks.add_tile('DES0000+0000',[(unpicklable,(1,),{}),(square,(2,),{})],[])
+    errors = []
+    waiter = threading.Thread(target=lambda: errors.extend(tasks.join()))
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(60)
+    assert not waiter.is_alive(), "join() did not return"
+    assert len(errors) == 1
+    tilename, kind, funcname, arg, value = errors[0]
+    assert (tilename,kind,funcname) == ('DES0000+0000','cut','unpicklable')
+    assert tasks.tiles['DES0000+0000']['ok']['cut'] == [1]